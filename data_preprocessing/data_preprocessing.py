@@ -60,6 +60,7 @@ cd into the git repo and run `git lfs install` and `git lfs pull`
 MODEL_SIZE = 'ViT-L/14@336px'  # Best models are (1st) ViT-L/14@336px and (2nd) ViT-L/14. I don't recommend going lower.  
 FRAME_SIZE_DIMENSION = 336
 NUM_FRAMES_TO_SAVE_PER_SEGMENT = 1
+MAX_FRAMES_TO_GRAB_INSTEAD_OF_SEEK = 250  # roughly one GOP. Further than this, a cap.set() seek is cheaper.
 
 def parse_cmd_line_args():
     """ Usage: 
@@ -217,6 +218,7 @@ class DataPreprocessor:
         amount_of_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
 
         segment_frames = []
+        curr_position = 0  # index of the frame the next cap.read() returns.
 
         for i, segment in enumerate(segments):
             start_time = segment['start']
@@ -233,7 +235,14 @@ class DataPreprocessor:
             
             sample_frame_idxs = np.linspace(0, end_frame-start_frame-1, num=self.num_frames, dtype=int)
             for frame_idx in sample_frame_idxs:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, (start_frame+frame_idx)-1)
+                target_position = (start_frame+frame_idx)-1
+                # segments are in time order, so usually just walk forward with grab() (decode only, no copy) instead of seeking.
+                if 0 <= target_position - curr_position <= MAX_FRAMES_TO_GRAB_INSTEAD_OF_SEEK:
+                    for _ in range(target_position - curr_position):
+                        cap.grab()
+                else:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, target_position)
+                curr_position = target_position + 1
                 # if self.debug:
                 #     print(f"reading frame {(start_frame+frame_idx)-1}")
                 res, frame = cap.read()
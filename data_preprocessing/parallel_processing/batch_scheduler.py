@@ -0,0 +1,77 @@
+'''
+Length-bucketed batching for the text encoders.
+
+Captions (and TVQA prompts) tokenize to very different lengths. A fixed batch size has to be small enough for the
+LONGEST possible batch, and every short caption gets padded up to its batch-mates. Instead:
+  1. sort pending work by token length (rounded into buckets), so batch-mates have similar length.
+  2. emit batches under a token budget: num_items * longest_item <= max_tokens_per_batch.
+  3. put results back into original db_index order before upload (so the uploader still sees contiguous runs).
+
+Usage:
+  batches = bucketed_batches(work_items, lengths, max_tokens_per_batch=32_768)
+  results = []
+  for batch in batches:
+    results.extend(encoder.encode_batch(batch))
+  results = restore_original_order(results)
+'''
+import math
+
+
+def bucketed_batches(work_items, lengths, max_tokens_per_batch, max_batch_size=None, bucket_width=8):
+  '''
+  param work_items: list of anything. Usually {'db_index': int, 'caption': str}
+  param lengths: list of int, token length of each work item (same order as work_items).
+  param max_tokens_per_batch: padded cost of a batch (num_items * longest_item) stays at or under this.
+  param max_batch_size: optional hard cap on number of items per batch.
+  param bucket_width: lengths are rounded UP to a multiple of this before sorting. Within a bucket, original order is kept.
+
+  returns: list of batches, each a list of work_items. Every work item appears exactly once.
+  An item longer than max_tokens_per_batch by itself still gets its own batch (size 1), we never drop work.
+  '''
+  assert len(work_items) == len(lengths), print(f"Need one length per work item. Got {len(work_items)} items and {len(lengths)} lengths.")
+  assert max_tokens_per_batch > 0, "max_tokens_per_batch must be positive."
+
+  bucketed_lengths = [int(math.ceil(length / bucket_width) * bucket_width) for length in lengths]
+  # sorted() is stable, so items in the same bucket keep their original (db_index) order.
+  order = sorted(range(len(work_items)), key=lambda i: bucketed_lengths[i])
+
+  batches = []
+  curr_batch = []
+  curr_max_len = 0
+  for i in order:
+    new_max_len = max(curr_max_len, lengths[i])
+    over_budget = (len(curr_batch) + 1) * new_max_len > max_tokens_per_batch
+    over_size = max_batch_size is not None and len(curr_batch) >= max_batch_size
+    if curr_batch and (over_budget or over_size):
+      batches.append(curr_batch)
+      curr_batch = []
+      new_max_len = lengths[i]
+    curr_batch.append(work_items[i])
+    curr_max_len = new_max_len
+  if curr_batch:
+    batches.append(curr_batch)
+  return batches
+
+
+def restore_original_order(results, key='db_index'):
+  '''
+  param results: list of dicts, each with a `key` field (default: 'db_index').
+  returns: results sorted by `key`, i.e. the order the work was originally handed out in.
+  '''
+  return sorted(results, key=lambda result: result[key])
+
+
+def padding_efficiency(batches, lengths_of):
+  '''
+  Fraction of computed tokens that are real (not padding). 1.0 means zero padding waste.
+  param lengths_of: function, work_item -> token length.
+  '''
+  real_tokens = 0
+  padded_tokens = 0
+  for batch in batches:
+    batch_lengths = [lengths_of(item) for item in batch]
+    real_tokens += sum(batch_lengths)
+    padded_tokens += len(batch_lengths) * max(batch_lengths)
+  if padded_tokens == 0:
+    return 1.0
+  return real_tokens / padded_tokens
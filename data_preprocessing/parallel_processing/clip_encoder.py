@@ -1,8 +1,10 @@
+import collections
 import concurrent.futures
 import inspect
 import os
 import pathlib
 import time
+import traceback
 from typing import List
 
 import accelerate
@@ -15,7 +17,13 @@ import torch
     # VideoReader, cpu)
 from PIL import Image
 # from termcolor import colored
+from frame_decode_pool import FrameDecodePool
+from frame_dedup_cache import NearDuplicateFrameCache, frame_thumbnail
+from frame_reader import read_frames_at_times
+from hidden_state_quantization import quantize_hidden_states
 from transformers import CLIPProcessor, CLIPVisionModel, logging
+from video_metadata_index import VideoMetadataIndex
+from visual_token_reduction import reduce_visual_tokens
 
 lt.monkey_patch()
 
@@ -41,9 +49,28 @@ NUM_FRAMES_TO_SAVE_PER_SEGMENT = 1
 
 class ClipEncoder:
 
-  def __init__(self, debug=False, num_frames_per_segment=1):
+  def __init__(self,
+               debug=False,
+               num_frames_per_segment=1,
+               use_batched_preprocess=True,
+               video_metadata_index_path=None,
+               num_decode_processes=0,
+               hidden_state_storage='fp32',
+               dedup_threshold=None,
+               visual_token_reduction=None):
     self.debug = debug
     self.num_frames_per_segment = num_frames_per_segment
+    self.use_batched_preprocess = use_batched_preprocess
+    # optional: cached fps + keyframes per video, so we don't probe the container again. See video_metadata_index.py
+    self.video_metadata_index = VideoMetadataIndex(video_metadata_index_path) if video_metadata_index_path else None
+    # optional: decode in a pool of processes (one decord reader each) instead of in this process. See frame_decode_pool.py
+    self.frame_decode_pool = FrameDecodePool(num_workers=num_decode_processes) if num_decode_processes > 0 else None
+    # storage mode of last_hidden_states in upload results: 'fp32', 'fp16' or 'int8'. See hidden_state_quantization.py
+    self.hidden_state_storage = hidden_state_storage
+    # optional: reuse embeddings of near-duplicate frames (same video) instead of running CLIP. See frame_dedup_cache.py
+    self.frame_cache = NearDuplicateFrameCache(threshold=dedup_threshold) if dedup_threshold is not None else None
+    # optional: fewer visual tokens in last_hidden_states, e.g. 'avgpool2' (577 -> 145). See visual_token_reduction.py
+    self.visual_token_reduction = visual_token_reduction
 
     # Load the model
     self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
@@ -56,6 +83,7 @@ class ClipEncoder:
         torch_dtype=torch.float32,
     ).to(self.device)
     self.clip_preprocess = CLIPProcessor.from_pretrained(MODEL_SIZE)
+    self.preprocess_config = get_clip_preprocess_config(self.clip_preprocess)
 
     # self.clip, self.clip_preprocess = clip.load(MODEL_SIZE, self.device)
     if '336' in MODEL_SIZE:
@@ -72,35 +100,182 @@ class ClipEncoder:
     '<full_filepath_video_1>':[ {'timestamp': midpoint, 'db_index': idx} ],  
     }
     '''
+    decoded_batch = self.decode_one_batch(batch_of_100_samples)
+    return self.run_clip_on_decoded_batch(decoded_batch)
 
+  def decode_one_batch(self, batch_of_100_samples):
+    '''
+    CPU half of run_clip_one_batch: extract frames from video and run CLIP preprocessing. No GPU work here,
+    so it's safe to run in decode threads while the GPU is busy with the previous batch.
+
+    returns: dict of {'frames', 'timestamps', 'db_indexes', 'video_filepaths', 'pixel_values'}, plus 'thumbnails' when
+             near-duplicate detection is on.
+    '''
     ## EXTRACT FRAMES
     all_frames = []
     all_timestamps = []
     all_db_indexes = []
+    all_video_filepaths = []
+    video_metadata = self.video_metadata_index.get_many(batch_of_100_samples.keys()) if self.video_metadata_index else {}
+    if self.frame_decode_pool:
+      # all videos of this batch decode at once, sharded across worker processes.
+      video_to_frames = self.frame_decode_pool.extract_frames({
+          video_filepath: ([segment_dict['timestamp'] for segment_dict in time_and_db_index_list], video_metadata.get(str(video_filepath)))
+          for video_filepath, time_and_db_index_list in batch_of_100_samples.items()
+      })
     for video_filepath, time_and_db_index_list in batch_of_100_samples.items():
       # can return None if any frame failes to extract from video...
-      curr_timestamps = [segment_dict['timestamp'] for segment_dict in time_and_db_index_list]
-      local_frames = extract_frames_from_video(video_filepath, curr_timestamps, use_multithreading=True)
-      if not (None in local_frames):
+      if self.frame_decode_pool:
+        local_frames = video_to_frames[video_filepath]
+      else:
+        curr_timestamps = [segment_dict['timestamp'] for segment_dict in time_and_db_index_list]
+        local_frames = extract_frames_from_video(video_filepath,
+                                                 curr_timestamps,
+                                                 use_multithreading=True,
+                                                 video_metadata=video_metadata.get(str(video_filepath)))
+      if local_frames is not None and not (None in local_frames):
         all_timestamps.extend([segment_dict['timestamp'] for segment_dict in time_and_db_index_list])
         all_db_indexes.extend([segment_dict['db_index'] for segment_dict in time_and_db_index_list])
+        all_video_filepaths.extend([video_filepath] * len(time_and_db_index_list))
         all_frames.extend(local_frames)
       else:
         print(f"🚨🚨 Warning (ok to happen occasionally w/ corrupted videos): failed to extract frames for video {video_filepath}")
-        print(f"len(local_frames) is {len(local_frames)}")
+        if local_frames is not None:
+          print(f"{sum(frame is None for frame in local_frames)} of {len(local_frames)} frames failed")
+
+    decoded_batch = {
+        'frames': all_frames,
+        'timestamps': all_timestamps,
+        'db_indexes': all_db_indexes,
+        'video_filepaths': all_video_filepaths,
+        'pixel_values': self.preprocess(all_frames),
+    }
+    if self.frame_cache is not None:
+      decoded_batch['thumbnails'] = [frame_thumbnail(frame) for frame in all_frames]
+    return decoded_batch
 
+  def run_clip_on_decoded_batch(self, decoded_batch):
+    '''
+    GPU half of run_clip_one_batch. Takes the output of decode_one_batch().
+    '''
     # RUN CLIP
-    all_pooled_clip_embeds, last_hidden_states = self.run_clip(all_frames)
+    if self.frame_cache is not None:
+      all_pooled_clip_embeds, last_hidden_states, last_hidden_states_scale = self._run_clip_skipping_duplicates(decoded_batch)
+    else:
+      all_pooled_clip_embeds, last_hidden_states, last_hidden_states_scale = self.run_clip_on_pixel_values(
+          decoded_batch['pixel_values'], hidden_state_storage=self.hidden_state_storage)
 
     results_dict = {
-        'frames': all_frames,
+        'frames': decoded_batch['frames'],
         'last_hidden_states': last_hidden_states,
         'pooled_clip_embeds': all_pooled_clip_embeds,
-        'timestamps': all_timestamps,
-        'db_indexes': all_db_indexes,
+        'timestamps': decoded_batch['timestamps'],
+        'db_indexes': decoded_batch['db_indexes'],
     }
+    if last_hidden_states_scale is not None:
+      results_dict['last_hidden_states_scale'] = last_hidden_states_scale
     return results_dict
 
+  def _run_clip_skipping_duplicates(self, decoded_batch):
+    '''
+    Same outputs as run_clip_on_pixel_values(..., hidden_state_storage=...), but CLIP only runs on frames that aren't
+    near-duplicates of the previous encoded frame of the same video. The others get copies of those embeddings.
+    '''
+    if len(decoded_batch['frames']) == 0:
+      return self.run_clip_on_pixel_values(decoded_batch['pixel_values'], hidden_state_storage=self.hidden_state_storage)
+    video_filepaths, thumbnails = decoded_batch['video_filepaths'], decoded_batch['thumbnails']
+    reuse = self.frame_cache.plan(video_filepaths, thumbnails)
+    encode_positions = [position for position, source in enumerate(reuse) if source is None]
+
+    encoded = {}  # {batch position: (pooled, last_hidden_states, scale or None)}
+    if encode_positions:
+      pooled, hidden_states, scales = self.run_clip_on_pixel_values(decoded_batch['pixel_values'][encode_positions],
+                                                                    hidden_state_storage=self.hidden_state_storage)
+      for row, position in enumerate(encode_positions):
+        encoded[position] = (pooled[row], hidden_states[row], scales[row] if scales is not None else None)
+
+    per_frame = [encoded[position] if source is None else (encoded[source] if isinstance(source, int) else source)
+                 for position, source in enumerate(reuse)]
+    self.frame_cache.update(video_filepaths, thumbnails, reuse,
+                            lambda position: tuple(t.clone() if t is not None else None for t in encoded[position]))
+    if self.debug:
+      print(f"♻️ Skipped {len(reuse) - len(encode_positions)} of {len(reuse)} near-duplicate frames. "
+            f"Total skipped: {self.frame_cache.frames_skipped} of {self.frame_cache.frames_seen}")
+
+    all_pooled_clip_embeds = torch.stack([frame[0] for frame in per_frame])
+    last_hidden_states = torch.stack([frame[1] for frame in per_frame])
+    last_hidden_states_scale = torch.stack([frame[2] for frame in per_frame]) if per_frame[0][2] is not None else None
+    return all_pooled_clip_embeds, last_hidden_states, last_hidden_states_scale
+
+  def run_clip_streaming(self, batch_iterator, num_decode_workers=4, num_prefetch_batches=4):
+    '''
+    Producer/consumer pipeline so the GPU never waits on video decode.
+    A pool of decode threads runs decode_one_batch() on the NEXT `num_prefetch_batches` batches (bounded, so we don't
+    blow up RAM), while the current batch runs through CLIP. Decord and the numpy/PIL preprocessing spend most of their
+    time outside the GIL, so threads are enough.
+
+    :param batch_iterator: iterable of batch_of_100_samples (same format as run_clip_one_batch).
+    :yields: results_dict (same format as run_clip_one_batch), in the same order as batch_iterator.
+    Batches that fail to decode or encode are printed and skipped, same as before.
+    '''
+    batch_iterator = iter(batch_iterator)
+    in_flight = collections.deque()  # futures of decoded batches, oldest first.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_decode_workers) as executor:
+
+      def submit_next_batch():
+        batch = next(batch_iterator, None)
+        if batch is not None:
+          in_flight.append(executor.submit(self.decode_one_batch, batch))
+
+      for _ in range(num_prefetch_batches):
+        submit_next_batch()
+
+      while in_flight:
+        future = in_flight.popleft()
+        submit_next_batch()  # keep the prefetch queue full while we wait on this one.
+        try:
+          decoded_batch = future.result()
+          if self.debug:
+            print(f"📦 Decoded batches ready or in progress: {len(in_flight)}")
+          yield self.run_clip_on_decoded_batch(decoded_batch)
+        except Exception as e:
+          print(f"❌❌ Error during {inspect.currentframe().f_code.co_name}: {e}")
+          traceback.print_exc()
+
+  def shutdown(self):
+    ''' Stop the frame decode processes (if any). Call once done with this encoder. '''
+    if self.frame_decode_pool:
+      self.frame_decode_pool.shutdown()
+      self.frame_decode_pool = None
+
+  def preprocess(self, all_frames):
+    '''
+    :param all_frames: list of np.ndarrays, (or list of PIL images I think is fine)
+    :returns: pixel_values, torch.FloatTensor on CPU. (batch_size, 3, 336, 336)
+
+    Uses the batched tensor path when every frame is a same-shape uint8 HWC array (always true for decord output),
+    otherwise falls back to the CLIPProcessor (PIL, image by image).
+    '''
+    start_time = time.monotonic()
+    if self.use_batched_preprocess and _is_stackable_uint8(all_frames):
+      pixel_values = batched_clip_preprocess(np.stack(all_frames), **self.preprocess_config)
+    else:
+      # optional improvement: send in a list of images instead. Just worried about convert_RGB in that case...
+      pixel_values = self.clip_preprocess(images=all_frames, return_tensors="pt")['pixel_values']
+    if self.debug:
+      print(f"⏰  Runtime of preprocessing: {(time.monotonic() - start_time):.2f} seconds")
+    return pixel_values
+
+  def max_preprocess_difference(self, all_frames):
+    '''
+    Sanity check: max absolute difference between batched_clip_preprocess() and the CLIPProcessor on the same frames.
+    On real (smooth) frames expect about 0.015, i.e. 1 uint8 level after normalization, from torch vs PIL bicubic rounding.
+    Pure random noise can show rare larger outliers (~0.3) but mean difference stays ~0.004.
+    '''
+    reference = self.clip_preprocess(images=list(all_frames), return_tensors="pt")['pixel_values']
+    batched = batched_clip_preprocess(np.stack(all_frames), **self.preprocess_config)
+    return (reference - batched).abs().max().item()
+
   def run_clip(self, all_frames, only_return_pooled_embeds=False):
     '''
     :param frames: list of np.ndarrays, (or list of PIL images I think is fine)
@@ -108,18 +283,22 @@ class ClipEncoder:
     
     :returns: List[np.ndarrays]
     '''
-    start_time = time.monotonic()
-    # optional improvement: send in a list of images instead. Just worried about convert_RGB in that case...
-    image_inputs = self.clip_preprocess(images=all_frames, return_tensors="pt").to(self.device)
+    return self.run_clip_on_pixel_values(self.preprocess(all_frames), only_return_pooled_embeds=only_return_pooled_embeds)
 
+  def run_clip_on_pixel_values(self, pixel_values, only_return_pooled_embeds=False, hidden_state_storage=None):
+    '''
+    :param pixel_values: output of self.preprocess()
+    :param only_return_pooled_embeds: bool -- if True, only return the pooled CLIP embeddings. Otherwise, return the pooled CLIP embeddings and the last hidden states.
+    :param hidden_state_storage: None, or a storage mode ('fp32', 'fp16', 'int8'). If set, last hidden states are quantized
+                                 on the GPU (smaller copy to CPU) and this returns (pooled, last_hidden_states, scales_or_None).
+    '''
     if self.debug:
-      print(f"⏰  Runtime of preprocessing: {(time.monotonic() - start_time):.2f} seconds")
       print("RIGHT before running clip 📸")
     start_time = time.monotonic()
     with torch.inference_mode():  # even faster than no_grad()
-      outputs = self.clip(**image_inputs, output_hidden_states=True, return_dict=True)
+      outputs = self.clip(pixel_values=pixel_values.to(self.device), output_hidden_states=True, return_dict=True)
     if self.debug:
-      print(f"⏰ CLIP Runtime on {len(all_frames)*self.num_frames_per_segment} images: {(time.monotonic() - start_time):.2f} seconds")
+      print(f"⏰ CLIP Runtime on {len(pixel_values)*self.num_frames_per_segment} images: {(time.monotonic() - start_time):.2f} seconds")
       # print("Clip all_pooled_clip_embeds.shape:")
       # print(all_pooled_clip_embeds.shape)
       # print("Clip last_hidden_states.shape:")
@@ -128,37 +307,108 @@ class ClipEncoder:
     if only_return_pooled_embeds:
       all_pooled_clip_embeds = outputs['pooler_output'].cpu()  #.numpy()
       return all_pooled_clip_embeds
+    # reduce on the GPU, before quantizing and the copy to CPU.
+    last_hidden_states = reduce_visual_tokens(outputs['last_hidden_state'], self.visual_token_reduction)
+    if hidden_state_storage is not None:
+      all_pooled_clip_embeds = outputs['pooler_output'].cpu()
+      last_hidden_states, scales = quantize_hidden_states(last_hidden_states, hidden_state_storage)
+      return all_pooled_clip_embeds, last_hidden_states.cpu(), (scales.cpu() if scales is not None else None)
     else:
       all_pooled_clip_embeds = outputs['pooler_output'].cpu()  #.numpy()  # (batch_size, hidden_size). FloatTensor
-      last_hidden_states = outputs['last_hidden_state'].cpu()  #.numpy()  # (batch_size, sequence_length, hidden_size). FloatTensor
+      last_hidden_states = last_hidden_states.cpu()  #.numpy()  # (batch_size, sequence_length, hidden_size). FloatTensor
       return all_pooled_clip_embeds, last_hidden_states
 
 
+def get_clip_preprocess_config(clip_processor):
+  '''
+  Read resize/crop/normalize params from a huggingface CLIPProcessor, so batched_clip_preprocess() always matches it.
+  Handles both old (int sizes, .feature_extractor) and new (dict sizes, .image_processor) transformers versions.
+  '''
+  image_processor = getattr(clip_processor, 'image_processor', None) or clip_processor.feature_extractor
+  size = image_processor.size
+  if not isinstance(size, int):
+    size = size['shortest_edge']  # dict (or dict-like SizeDict)
+  crop_size = image_processor.crop_size
+  if isinstance(crop_size, int):
+    crop_size = (crop_size, crop_size)
+  else:
+    crop_size = (crop_size['height'], crop_size['width'])
+  return {
+      'shortest_edge': int(size),
+      'crop_size': tuple(crop_size),
+      'image_mean': list(image_processor.image_mean),
+      'image_std': list(image_processor.image_std),
+  }
+
+
+def batched_clip_preprocess(frames, shortest_edge=336, crop_size=(336, 336), image_mean=None, image_std=None, device='cpu'):
+  '''
+  Tensor-native version of CLIPProcessor: resize (shortest edge, bicubic) -> center crop -> rescale -> normalize,
+  done as ONE batched op instead of PIL image by image. Works on CPU-only nodes, or pass device='cuda:0'.
+
+  :param frames: np.ndarray uint8 of shape (N, H, W, 3), e.g. (N, 360, 640, 3) from extract_frames_from_video()
+  :returns: torch.FloatTensor (N, 3, crop_h, crop_w) on `device`. Same as CLIPProcessor(...)['pixel_values'] within tolerance.
+  '''
+  if image_mean is None:
+    image_mean = [0.48145466, 0.4578275, 0.40821073]  # OpenAI CLIP defaults
+  if image_std is None:
+    image_std = [0.26862954, 0.26130258, 0.27577711]
+  crop_h, crop_w = crop_size
+  images = torch.from_numpy(np.ascontiguousarray(frames)).to(device).permute(0, 3, 1, 2).float()  # (N, 3, H, W)
+  if images.shape[0] == 0:
+    return torch.zeros((0, 3, crop_h, crop_w), dtype=torch.float32, device=device)
+
+  # resize so the SHORTEST edge == shortest_edge, keep aspect ratio (same rounding as huggingface: int())
+  height, width = images.shape[-2:]
+  short, long = (height, width) if height <= width else (width, height)
+  new_short, new_long = shortest_edge, int(shortest_edge * long / short)
+  new_h, new_w = (new_short, new_long) if height <= width else (new_long, new_short)
+  images = torch.nn.functional.interpolate(images, size=(new_h, new_w), mode='bicubic', align_corners=False, antialias=True)
+  # PIL resizes uint8 -> uint8, so round + clamp to match it.
+  images = images.round_().clamp_(0, 255)
+
+  # center crop
+  top = (new_h - crop_h) // 2
+  left = (new_w - crop_w) // 2
+  images = images[:, :, top:top + crop_h, left:left + crop_w]
+
+  # rescale + normalize
+  mean = torch.tensor(image_mean, dtype=torch.float32, device=device).view(1, 3, 1, 1) * 255
+  std = torch.tensor(image_std, dtype=torch.float32, device=device).view(1, 3, 1, 1) * 255
+  return ((images - mean) / std).contiguous()
+
+
+def _is_stackable_uint8(all_frames):
+  ''' True if all_frames is a non-empty list of same-shape (H, W, 3) uint8 np.ndarrays. '''
+  if len(all_frames) == 0 or not all(isinstance(frame, np.ndarray) for frame in all_frames):
+    return False
+  first_shape = all_frames[0].shape
+  return all(frame.dtype == np.uint8 and frame.shape == first_shape and frame.ndim == 3 for frame in all_frames)
+
+
 '''
 VIDEO PROCESSING ADAPTED FROM MERLOT RESERVE
 https://github.com/rowanz/merlot_reserve/blob/main/mreserve/preprocess.py
 '''
 
 
-def extract_frames_from_video(video_file, times, use_multithreading=False, blackbar_threshold=32, max_perc_to_trim=.20):
+def extract_frames_from_video(video_file, times, use_multithreading=False, blackbar_threshold=32, max_perc_to_trim=.20, video_metadata=None):
   """
   Extracts multiple things from the video and even handles black bars
   :param video_file: what we are loading
   :param times: timestamps to use
   :param use_multithreading: Whether to use multithreading
+  :param video_metadata: optional dict from VideoMetadataIndex. If given, its fps + keyframes are used instead of probing.
   :param use_rgb whether to use RGB (default) or BGR
   :param blackbar_threshold: Pixels must be this intense for us to not trim
   :param max_perc_to_trim: Will trim 20% by default of the image at most in each dimension
   :return: Frames that are trimmed to not have any black bars
   """
+  from decord import VideoReader, cpu  # imported here so TVQA (jpg frames only) doesn't need decord installed.
+
   # I had terrible "DecodeError" problems with num_threads > 1.. no idea why, no progress on GH issues: https://github.com/dmlc/decord/issues/124
   vr = VideoReader(str(video_file), ctx=cpu(0), num_threads=1)
-  fps = vr.get_avg_fps()
-  # timestamp in seconds -> frame_index
-  frame_indexes = []
-  for t in times:
-    frame_indexes.append(int(t * fps))
-  frames = vr.get_batch(frame_indexes).asnumpy()
+  frames = read_frames_at_times(vr, times, video_metadata=video_metadata)
   # print(f"⏰ Time to get {len(frame_indexes)} frames: {(time.monotonic() - start_time):.2f} seconds (time/frame = {((time.monotonic() - start_time)/len(frame_indexes)):.2f} sec)")
   return frames
   y1, y2, x1, x2 = _detect_black_bars_from_video(frames, blackbar_threshold=blackbar_threshold, max_perc_to_trim=max_perc_to_trim)
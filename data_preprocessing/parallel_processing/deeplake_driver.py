@@ -2,17 +2,23 @@
 # import asyncio
 import inspect
 import json
+import os
 import pathlib
 import pprint
+import shutil
 import time
 import traceback
 
 import deeplake as dl
+import numpy as np
 import ray
 import tqdm
+from embedding_codec import (EMBEDDING_TENSOR_NAMES, create_embedding_tensor, encode_embedding, maybe_decode_embedding)
+from hidden_state_quantization import SCALE_TENSOR_NAME
 from ray.util.queue import Queue
 # fancy
 from termcolor import colored
+from video_manifest import VideoManifest
 
 # pyright: reportGeneralTypeIssues=false
 # ^^ due to not understanding deeplake
@@ -20,11 +26,65 @@ from termcolor import colored
 # pyright: reportOptionalMemberAccess=false
 # ^^ due to not understanding ray
 
-
-@ray.remote(concurrency_groups={"upload_driver": 1, "single_thread_io": 1, "parallel_ingest": 4})
+# Typed columns for the numbers in `segment_metadata` (which is a JSON string). Written by the whisper uploader,
+# so batch planning (e.g. CLIP frame midpoints) is a vectorized numpy op instead of json.loads on every row.
+# `segment_metadata` is still written too, it holds the per-word timings.
+SEGMENT_COLUMNS = {
+    'segment_start': np.float32,
+    'segment_end': np.float32,
+    'segment_index': np.int32,
+    'total_segments': np.int32,
+    'video_id': np.int32,  # unique per video_filepath within a dataset
+}
+
+# Per-row completion bitmap for each stage that updates pre-filled rows. Written by the uploader with the data.
+# (whisper and tvqa-encode only ever append, so a row existing means it's done.)
+COMPLETION_TENSORS = {
+    'clip': 'done_clip_encode',
+    'text-encode': 'done_text_encode',
+}
+
+# Lazy allocation: instead of pre-filling every row with zeros (so in-place updates are fast), new datasets create the
+# result tensors EMPTY and the uploader appends results in arrival order. The index map tensor records which db_index
+# each appended result belongs to. A dataset is in this mode iff it has the index map tensor.
+RESULT_INDEX_TENSORS = {
+    'clip': 'clip_source_index',
+    'text-encode': 'caption_embedding_source_index',
+}
+RESULT_TENSORS = {
+    'clip': ['clip_pooled_embedding', 'clip_last_hidden_states', 'frames', 'timestamp', SCALE_TENSOR_NAME],  # scale: int8 only
+    'text-encode': ['caption_embedding'],
+}
+# settings of the encoder stages (parallel_clip.py, parallel_text_encoder.py), shared so both write the same layout.
+PREFILL_WITH_ZEROS = False  # False: lazy allocation, results are appended + an index map (see RESULT_INDEX_TENSORS). True: old zero pre-fill, in-place updates.
+EMBEDDING_CODEC_LEVEL = None  # e.g. 3: byte-shuffle + zstd (that level) for the embedding tensors, done in the encoder workers. None: stored as created. See embedding_codec.py
+assert EMBEDDING_CODEC_LEVEL is None or not PREFILL_WITH_ZEROS, "Encoded embeddings vary in size, they can't update zero pre-filled rows in place."
+# one row per Whisper segment, never appended to after the Whisper stage. Its length is the row count of every later stage.
+SOURCE_ROW_TENSOR = 'caption'
+
+# Pre-tokenized captions in db_index order, written once when a text-encode dataset is created (add_caption_token_columns).
+# Training and the zero pre-fill read these instead of re-tokenizing `caption`. t5, t5-v1_1 and flan-t5 share one vocabulary.
+CAPTION_TOKEN_COLUMNS = {
+    'caption_token_ids': np.int32,  # ragged, untruncated, ends with </s>
+    'caption_token_len': np.int32,
+}
+CAPTION_TOKENIZER_NAME = "google/flan-t5-large"
+CAPTION_TOKENIZE_BATCH_SIZE = 10_000
+
+
+@ray.remote(concurrency_groups={"upload_driver": 1, "single_thread_io": 1})
 class DeeplakeManager():
 
-  def __init__(self, preprocessor_type=None, database_path=None, upload_queue=None):
+  def __init__(self,
+               preprocessor_type=None,
+               database_path=None,
+               upload_queue=None,
+               video_manifest_path=None):
+    '''
+    ONE DeeplakeManager per dataset. Deeplake's tensor_meta, chunk_id_encoder and commit diff are single files every
+    writer rewrites, so concurrent writers to one dataset (even on disjoint rows) lose each other's updates.
+    video_manifest_path: whisper only. SQLite VideoManifest, updated after each video's upload commits.
+    '''
     assert preprocessor_type in ['whisper', 'clip', 'text-encode',
                                  'tvqa-encode'], "only these modes are supported due to custom upload function for each."
 
@@ -34,6 +94,8 @@ class DeeplakeManager():
     self.ds = dl.load(database_path, read_only=False, memory_cache_size=10_737)  # 10 GiB in MB
     print(self.ds.summary())
     self.upload_queue = upload_queue
+    self.next_video_id = None  # whisper only, see _whisper_results_to_deeplake
+    self.video_manifest = VideoManifest(video_manifest_path) if video_manifest_path is not None else None
     self.start_upload_driver(preprocessor_type)
 
   def start_upload_driver(self, preprocessor_type):
@@ -77,6 +139,7 @@ class DeeplakeManager():
         'pooled_clip_embeds': all_pooled_clip_embeds,
         'timestamps': all_timestamps,
         'db_indexes': all_db_indexes,
+        'last_hidden_states_scale': ...,  # only for int8 hidden state storage
     }
     '''
     try:
@@ -84,7 +147,7 @@ class DeeplakeManager():
         while self.upload_queue.qsize() > 0:
           print("🔁 Queue size:", self.upload_queue.qsize())
           start_time = time.monotonic()
-          results = self.upload_queue.get(block=True)
+          results = get_results_from_handle(self.upload_queue.get(block=True))
           print(f"🔁⏰ time to pull one result from queue: {(time.monotonic() - start_time):.2f} seconds")
           # todo: update via slice instead of iterating. Probably faster.
           # https://docs.deeplake.ai/en/latest/deeplake.core.tensor.html#deeplake.core.tensor.Tensor.__setitem__
@@ -108,10 +171,27 @@ class DeeplakeManager():
           assert last_idx - first_idx == (len(results['frames'])), print(
               f"Length of frames {len(results['frames'])} must equal {last_idx}-{first_idx} = {last_idx - first_idx}")
 
-          self.ds.clip_pooled_embedding[first_idx:last_idx] = results['pooled_clip_embeds']
-          self.ds.clip_last_hidden_states[first_idx:last_idx] = results['last_hidden_states']
-          self.ds.frames[first_idx:last_idx] = results['frames']
-          self.ds.timestamp[first_idx:last_idx] = results['timestamps']
+          if RESULT_INDEX_TENSORS['clip'] in self.ds.tensors:
+            # lazily allocated dataset: append in arrival order, plus the db_index of each result. All or none.
+            self.ds.extend(
+                {
+                    'clip_pooled_embedding': results['pooled_clip_embeds'],
+                    'clip_last_hidden_states': results['last_hidden_states'],
+                    'frames': results['frames'],
+                    'timestamp': results['timestamps'],
+                    RESULT_INDEX_TENSORS['clip']: np.arange(first_idx, last_idx, dtype=np.int64),
+                    **({SCALE_TENSOR_NAME: results['last_hidden_states_scale']} if SCALE_TENSOR_NAME in self.ds.tensors else {}),
+                },
+                skip_ok=True)
+          else:
+            self.ds.clip_pooled_embedding[first_idx:last_idx] = results['pooled_clip_embeds']
+            self.ds.clip_last_hidden_states[first_idx:last_idx] = results['last_hidden_states']
+            self.ds.frames[first_idx:last_idx] = results['frames']
+            self.ds.timestamp[first_idx:last_idx] = results['timestamps']
+            if SCALE_TENSOR_NAME in self.ds.tensors:  # int8 hidden states, see hidden_state_quantization.py
+              self.ds[SCALE_TENSOR_NAME][first_idx:last_idx] = results['last_hidden_states_scale']
+          # completion bitmap, same `with self.ds` block as the data. Used to resume without scanning embeddings.
+          self._mark_done('clip', first_idx, last_idx)
           print(f"⬆️⏰ Time to upload one batch: {(time.monotonic() - start_time):.2f} seconds. Time per frame = {((time.monotonic() - start_time)/len(results['frames'])):.2f}") # yapf: disable
           # for all_frames, last_hidden_states, all_pooled_clip_embeds, timestamp, db_index in zip(results['frames'], results['last_hidden_states'], results['pooled_clip_embeds'], results['timestamps'], results['db_indexes']):
           # update metadata
@@ -132,6 +212,11 @@ class DeeplakeManager():
       print(traceback.print_exc())
       print("Testing getting the name of the curr function: ", print(inspect.currentframe().f_code.co_name))
 
+  def _mark_done(self, stage, first_idx, last_idx):
+    ''' Set the completion bitmap for rows [first_idx, last_idx). Datasets from before the bitmaps have none, they resume by scanning embeddings. '''
+    if COMPLETION_TENSORS[stage] in self.ds.tensors:
+      self.ds[COMPLETION_TENSORS[stage]][first_idx:last_idx] = [True] * (last_idx - first_idx)
+
   @dl.compute
   def parallel_clip_encode_results_to_deeplake(sample_in, sample_out, todo_clip_results_nparray):
     '''
@@ -153,20 +238,30 @@ class DeeplakeManager():
           print("👉⬆️ Upload queue size:", self.upload_queue.qsize(), "⬆️👈")
           print(" STARTING AN ACTUAL UPLOAD... ")
           start = time.monotonic()
-          caption_embed_dict_list = self.upload_queue.get(block=True, timeout=120)
-          for input_dict in caption_embed_dict_list:
-
-            # True and true :)
-            # print("Should be same shape: ", self.ds.caption_embedding[input_dict['db_index']].numpy().shape, input_dict['last_hidden_states'].shape)
-            # print("Is continuous?", check_continuity([d['db_index'] for d in caption_embed_dict_list]))
-
-            # todo: it's already fast enough, but if I want to...
-            # todo: ...I confirmed it's okay to make this a batch-update operation (like clip), if db_index is continuous.
-            # todo: index_list = [d['db_index'] for d in caption_embed_dict_list]
-            # assert check_continuity(input_dict['db_index']), print("db_index must be continuous. This batch is not contiguous in Deeplake.")
-            # assert last_idx-first_idx == (len(input_dict['frames'])), print(f"Length of frames {len(input_dict['frames'])} must equal {last_idx}-{first_idx} = {last_idx - first_idx}")
-
-            self.ds.caption_embedding[input_dict['db_index']] = input_dict['last_hidden_states']
+          caption_embed_dict_list = get_results_from_handle(self.upload_queue.get(block=True, timeout=120))
+          # batch-update via slices: one write per contiguous run of db_index, single-index writes only for gaps.
+          caption_embed_dict_list = sorted(caption_embed_dict_list, key=lambda d: d['db_index'])
+          index_list = [d['db_index'] for d in caption_embed_dict_list]
+          if RESULT_INDEX_TENSORS['text-encode'] in self.ds.tensors:
+            # lazily allocated dataset: ONE append for the whole batch, plus the db_index of each embedding.
+            input_dict = caption_embed_dict_list[0]  # for error reporting
+            self.ds.extend(
+                {
+                    'caption_embedding': [d['last_hidden_states'] for d in caption_embed_dict_list],
+                    RESULT_INDEX_TENSORS['text-encode']: np.asarray(index_list, dtype=np.int64),
+                },
+                skip_ok=True)
+          list_offset = 0
+          for first_idx, last_idx in split_into_contiguous_runs(index_list):
+            run = caption_embed_dict_list[list_offset:list_offset + (last_idx - first_idx)]
+            list_offset += last_idx - first_idx
+            input_dict = run[0]  # for error reporting
+            if RESULT_INDEX_TENSORS['text-encode'] not in self.ds.tensors:
+              if len(run) == 1:
+                self.ds.caption_embedding[input_dict['db_index']] = input_dict['last_hidden_states']
+              else:
+                self.ds.caption_embedding[first_idx:last_idx] = [d['last_hidden_states'] for d in run]
+            self._mark_done('text-encode', first_idx, last_idx)
           print("✅ SUCCESSFULLY finished uploading to Deeplake! ✅")
           print(
               f"⬆️⬆️ Time to upload text-batch: {(time.monotonic() - start)/60:.2f} minutes. (time/segment): {((time.monotonic() - start)/len(caption_embed_dict_list)):.2f} sec"
@@ -212,14 +307,26 @@ class DeeplakeManager():
   @ray.method(concurrency_group="single_thread_io")
   def _whisper_results_to_deeplake(self):
     '''
-    param: whisper_one_video_results: list of dicts, each dict is a segment
+    param: whisper_one_video_results: list of dicts, each dict is a segment.
+           Or a status dict {'video_filepath', 'status', 'error'} for empty/failed videos, only recorded in the manifest.
     '''
+    whisper_one_video_results = None  # bound before the try, the except below reads it.
     try:
       while self.upload_queue.qsize() > 0:
         whisper_one_video_results = self.upload_queue.get(block=True)
+        if isinstance(whisper_one_video_results, dict):
+          if self.video_manifest is not None:
+            self.video_manifest.put(whisper_one_video_results['video_filepath'],
+                                    whisper_one_video_results['status'],
+                                    error=whisper_one_video_results.get('error'))
+          continue
+        first_row = self.ds.max_len
         with self.ds:
           # loop over upload queue (best done here to keep the 'with' context manager open)
           print("👉⬆️ STARTING AN ACTUAL UPLOAD... ⬆️👈")
+          has_segment_columns = all(tensor_name in self.ds.tensors for tensor_name in SEGMENT_COLUMNS)
+          if has_segment_columns and self.next_video_id is None:
+            self.next_video_id = int(self.ds.video_id.numpy().max()) + 1 if len(self.ds.video_id) > 0 else 0
           for segment in whisper_one_video_results:
             metadata = {
                 "start": str(segment["start"]),
@@ -228,17 +335,37 @@ class DeeplakeManager():
                 "segment_index": str(segment["segment_index"]),
                 "total_segments": str(segment["total_segments"])
             }
-            # atomic append. All work or none get added.
-            self.ds.append({
+            sample = {
                 'caption': segment['caption'],
                 'video_filename': segment["video_filename_name"],
                 'video_filepath': segment["video_filepath"],
                 'segment_metadata': json.dumps(dict(metadata)),  # just deleting the json.dumps() call
-            })
+            }
+            if has_segment_columns:
+              sample.update({
+                  'segment_start': np.float32(segment["start"]),
+                  'segment_end': np.float32(segment["end"]),
+                  'segment_index': np.int32(segment["segment_index"]),
+                  'total_segments': np.int32(segment["total_segments"]),
+                  'video_id': np.int32(self.next_video_id),
+              })
+            # atomic append. All work or none get added.
+            self.ds.append(sample)
+          if has_segment_columns:
+            self.next_video_id += 1
           print("✅ SUCCESSFULLY finished uploading to Deeplake! ✅")
           print(self.ds.summary())
         self.ds.flush()
+        if self.video_manifest is not None:
+          # after the commit: a crash in between means the video is re-done, never that it's skipped.
+          self.video_manifest.put(whisper_one_video_results[0]['video_filepath'],
+                                  'done',
+                                  num_segments=len(whisper_one_video_results),
+                                  first_row=first_row,
+                                  last_row=first_row + len(whisper_one_video_results))
     except Exception as e:
+      if self.video_manifest is not None and isinstance(whisper_one_video_results, list) and whisper_one_video_results:
+        self.video_manifest.put(whisper_one_video_results[0]['video_filepath'], 'error', error=f"upload failed: {e}")
       print("-----------❌❌❌❌------------START OF ERROR-----------❌❌❌❌------------")
       pprint.pprint(whisper_one_video_results)
       print("^^^ FULL WHISPER RESULTS ^^^")
@@ -248,73 +375,270 @@ class DeeplakeManager():
       print(traceback.print_exc())
 
 
-def compress_and_delete_dataset(dataset_path, destructive=False):
-  ''' After we finish processing a dataset, we should compress it once and for all. '''
-  # todo: implement destructive mode... Just delete original, and rename the new one.
+def create_segment_metadata_columns(ds):
+  ''' Create the typed segment columns (see SEGMENT_COLUMNS) on a dataset. Call inside `with ds:` '''
+  for tensor_name, dtype in SEGMENT_COLUMNS.items():
+    ds.create_tensor(tensor_name, htype='generic', dtype=dtype, sample_compression=None)
+
+
+def migrate_segment_metadata_to_columns(dataset_path):
+  '''
+  One-shot migration for datasets written before SEGMENT_COLUMNS existed: parse the `segment_metadata` JSON strings
+  ONCE and write typed columns (segment_start, segment_end, segment_index, total_segments, video_id).
+  Works on whisper results and on anything deepcopied from them (text-encode, CLIP). Safe to re-run, skips if done.
+  '''
+  ds = dl.load(dataset_path, read_only=False)
+  if all(tensor_name in ds.tensors for tensor_name in SEGMENT_COLUMNS):
+    print(colored(f"✅ {dataset_path} already has typed segment columns, nothing to do.", "green", attrs=["reverse", "bold"]))
+    return
+
+  print(colored(f"👉 Migrating segment_metadata JSON to typed columns: {dataset_path}", "cyan", attrs=["reverse", "bold"]))
+  start_time = time.monotonic()
+  all_metadata = ds.segment_metadata.data()['value']
+  all_video_filepaths = ds.video_filepath.data()['value']
+  columns = {tensor_name: np.zeros(len(all_metadata), dtype=dtype) for tensor_name, dtype in SEGMENT_COLUMNS.items()}
+  video_filepath_to_id = {}
+  total_errors = 0
+  for idx, (metadata, video_filepath) in enumerate(tqdm.tqdm(zip(all_metadata, all_video_filepaths), total=len(all_metadata))):
+    try:
+      metadata = json.loads(metadata)
+      columns['segment_start'][idx] = float(metadata['start'])
+      columns['segment_end'][idx] = float(metadata['end'])
+      columns['segment_index'][idx] = int(metadata['segment_index'])
+      columns['total_segments'][idx] = int(metadata['total_segments'])
+    except Exception as e:
+      total_errors += 1
+      print(f"❌ Corrupted segment_metadata at index {idx}: {e}")
+    columns['video_id'][idx] = video_filepath_to_id.setdefault(video_filepath, len(video_filepath_to_id))
+
+  with ds:
+    create_segment_metadata_columns(ds)
+    for tensor_name, values in columns.items():
+      ds[tensor_name].extend(values)
+  ds.flush()
+  print(ds.summary())
+  print(f"⏰ Migrated {len(all_metadata)} rows in {(time.monotonic() - start_time)/60:.2f} minutes. Corrupted rows: {total_errors}")
+
 
-  in_ds = dl.load(dataset_path)
+def add_caption_token_columns(ds, tokenizer_name=CAPTION_TOKENIZER_NAME):
+  '''
+  Tokenize every caption ONCE (fast tokenizer, CAPTION_TOKENIZE_BATCH_SIZE captions per call) and write
+  CAPTION_TOKEN_COLUMNS. Needs a writable ds. Safe to re-run (also the migration for older datasets): missing columns
+  are created, and an interrupted run resumes after the rows already written.
+  '''
+  from transformers import AutoTokenizer
+
+  num_rows = get_num_rows(ds)
+  if all(tensor_name in ds.tensors and len(ds[tensor_name]) == num_rows for tensor_name in CAPTION_TOKEN_COLUMNS):
+    print(colored(f"✅ Dataset already has caption token columns, nothing to do.", "green", attrs=["reverse", "bold"]))
+    return
+  start_time = time.monotonic()
+  tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+  with ds:
+    for tensor_name, dtype in CAPTION_TOKEN_COLUMNS.items():
+      if tensor_name not in ds.tensors:
+        ds.create_tensor(tensor_name, htype='generic', dtype=dtype, sample_compression=None)
+    assert ds.caption_token_ids.info.get('tokenizer', tokenizer_name) == tokenizer_name, print(
+        f"Resuming caption token columns written with {ds.caption_token_ids.info.get('tokenizer')}, not {tokenizer_name}")
+    ds.caption_token_ids.info.update(tokenizer=tokenizer_name)
+    # an interrupt can land between the two extends, so each column resumes from its own length.
+    num_done = {tensor_name: len(ds[tensor_name]) for tensor_name in CAPTION_TOKEN_COLUMNS}
+    resume_idx = min(num_done.values())
+    print(colored(f"👉 Tokenizing {num_rows - resume_idx} captions (from row {resume_idx}) with {tokenizer_name}", "cyan", attrs=["reverse", "bold"]))
+    for first_idx in tqdm.tqdm(range(resume_idx, num_rows, CAPTION_TOKENIZE_BATCH_SIZE)):
+      captions = ds.caption[first_idx:first_idx + CAPTION_TOKENIZE_BATCH_SIZE].data()['value']
+      captions = [captions] if isinstance(captions, str) else list(captions)
+      token_ids = [np.asarray(ids, dtype=np.int32) for ids in tokenizer(captions, padding=False, truncation=False).input_ids]
+      token_len = np.array([len(ids) for ids in token_ids], dtype=np.int32)
+      ds.caption_token_ids.extend(token_ids[max(num_done['caption_token_ids'] - first_idx, 0):])
+      ds.caption_token_len.extend(token_len[max(num_done['caption_token_len'] - first_idx, 0):])
+  ds.flush()
+  print(f"⏰ Time to tokenize captions: {(time.monotonic() - start_time)/60:.2f} minutes")
+
+
+# Output schema of compress_and_delete_dataset(). {tensor_name: (htype, dtype, sample_compression)}
+# Typed segment columns (SEGMENT_COLUMNS) and caption token columns (CAPTION_TOKEN_COLUMNS) are added when the input has them.
+COMPACT_TENSOR_SPECS = {
+    'caption': ('text', str, 'lz4'),
+    'caption_embedding': ('image', np.float16, 'lz4'),
+    'clip_last_hidden_states': ('image', np.float32, 'lz4'),
+    'clip_pooled_embedding': ('image', np.float32, 'lz4'),
+    'frames': ('image', np.uint8, 'jpeg'),
+    'segment_metadata': ('text', str, 'lz4'),
+    'timestamp': ('generic', float, 'lz4'),
+    'video_filename': ('text', str, None),
+    'video_filepath': ('text', str, None),
+}
+COMPACT_MAX_ROWS_PER_TASK = 128  # rows per compaction work item (~300 MB of clip_last_hidden_states).
+
+# per-worker-process cache of read-only input datasets, for _compact_rows. {dataset_path: ds}
+_compact_input_datasets = {}
+
+
+def compress_and_delete_dataset(dataset_path, destructive=False, num_workers=None, embedding_codec_level=None):
+  '''
+  After we finish processing a dataset, we should compress it once and for all.
+
+  Parallel compaction: the row range is split into chunk-aligned work items, each Ray worker reads whole chunks per
+  tensor (one slice read, not .data() per sample) and recompresses them into its own disjoint range of the output.
+  Lazily allocated results (see RESULT_INDEX_TENSORS) are put back in db_index order. Row counts are verified at the end.
+
+  destructive: atomically swap the compacted dataset in at `dataset_path`, see swap_in_dataset(). Only after verification.
+  embedding_codec_level: None keeps lz4 for the embedding tensors. An int stores them byte-shuffle + zstd at that level
+                         (see embedding_codec.py). Already-encoded inputs are decoded first either way.
+  '''
+  num_workers = num_workers or os.cpu_count()
+  in_ds = dl.load(dataset_path, read_only=True)
   p = pathlib.Path(dataset_path)
-  print(str(p.name))
   outpath = pathlib.Path(p.parent / (str(p.name) + '_compressed'))
   print(f"Creating dataset at path: {outpath}")
   out_ds = dl.empty(outpath, overwrite=True)
-  # ds.rechunk(scheduler='ray', num_workers=10) # no need
-  import numpy as np
+  tensor_specs = dict(COMPACT_TENSOR_SPECS)
+  if all(tensor_name in in_ds.tensors for tensor_name in SEGMENT_COLUMNS):
+    tensor_specs.update({tensor_name: ('generic', dtype, None) for tensor_name, dtype in SEGMENT_COLUMNS.items()})
+  if all(tensor_name in in_ds.tensors for tensor_name in CAPTION_TOKEN_COLUMNS):
+    tensor_specs.update({tensor_name: ('generic', dtype, 'lz4') for tensor_name, dtype in CAPTION_TOKEN_COLUMNS.items()})
+  hidden_states_dtype = _decoded_dtype(in_ds, 'clip_last_hidden_states')
+  if hidden_states_dtype != np.float32:
+    # keep the quantized storage mode (fp16, or int8 + scales). See hidden_state_quantization.py
+    tensor_specs['clip_last_hidden_states'] = ('generic', hidden_states_dtype, 'lz4')
+  if SCALE_TENSOR_NAME in in_ds.tensors:
+    tensor_specs[SCALE_TENSOR_NAME] = ('generic', np.float32, 'lz4')
   with out_ds:
-    out_ds.create_tensor('caption', htype='text', dtype=str, sample_compression='lz4')
-    out_ds.create_tensor('caption_embedding', htype='image', dtype=np.float16, sample_compression='lz4')
-    out_ds.create_tensor('clip_last_hidden_states', htype='image', dtype=np.float32, sample_compression='lz4')
-    out_ds.create_tensor('clip_pooled_embedding', htype='image', dtype=np.float32, sample_compression='lz4')
-    out_ds.create_tensor('frames', htype='image', dtype=np.uint8, sample_compression='jpeg')
-    out_ds.create_tensor('segment_metadata', htype='text', dtype=str, sample_compression='lz4')
-    out_ds.create_tensor('timestamp', htype='generic', dtype=float, sample_compression='lz4')
-    out_ds.create_tensor('video_filename', htype='text', dtype=str, sample_compression=None)
-    out_ds.create_tensor('video_filepath', htype='text', dtype=str, sample_compression=None)
+    for tensor_name, (htype, dtype, sample_compression) in tensor_specs.items():
+      codec_level = embedding_codec_level if tensor_name in EMBEDDING_TENSOR_NAMES else None
+      create_embedding_tensor(out_ds, tensor_name, codec_level, htype=htype, dtype=dtype, sample_compression=sample_compression)
+      # e.g. visual_token_reduction, tokenizer. The codec keys describe the output's own storage, set above.
+      out_ds[tensor_name].info.update({key: value for key, value in in_ds[tensor_name].info.items() if key not in ('codec', 'codec_level')})
     print("Created new ds")
     print(out_ds.summary())
 
-  print(colored(f"👉 Start creating the new, compressed, dataset", "cyan", attrs=["reverse", "bold"]))
-  total_errors = 0
-  with out_ds:
-    for sample in tqdm.tqdm(in_ds):
-
-      # full_sample = {
-      #   'caption': sample.caption.data()['value'],
-      #   'caption_embedding': sample.caption_embedding.data()['value'],
-      #   'clip_last_hidden_states': sample.clip_last_hidden_states.data()['value'],
-      #   'clip_pooled_embedding': sample.clip_pooled_embedding.data()['value'],
-      #   'frames': sample.frames.data()['value'],
-      #   'segment_metadata': sample.segment_metadata.data()['value'],
-      #   'timestamp': sample.timestamp.data()['value'],
-      #   'video_filename': sample.video_filename.data()['value'],
-      #   'video_filepath': sample.video_filepath.data()['value'],
-      # }
-      # print(full_sample)
-      # my_pickled_object = pickle.dumps(full_sample)
-      # my_pickled_object.a_dict = None
-
-      # file_to_deeplake().eval(my_pickled_object, out_ds, num_workers=2)# scheduler='ray', num_workers=11)
-      try:
-        out_ds.append({
-            'caption': sample.caption.data()['value'],
-            'caption_embedding': sample.caption_embedding.data()['value'],
-            'clip_last_hidden_states': sample.clip_last_hidden_states.data()['value'],
-            'clip_pooled_embedding': sample.clip_pooled_embedding.data()['value'],
-            'frames': sample.frames.data()['value'],
-            'segment_metadata': sample.segment_metadata.data()['value'],
-            'timestamp': sample.timestamp.data()['value'],
-            'video_filename': sample.video_filename.data()['value'],
-            'video_filepath': sample.video_filepath.data()['value'],
-        })
-      except Exception as e:
-        total_errors += 1
-        print(f"❌❌ Error {inspect.currentframe().f_code.co_name}: {e}")
-        print(traceback.print_exc())
-
-    out_ds.flush()
-    print(out_ds.summary())
-    print(colored(f"✅ Successfully created compressed dataset at path: {outpath}", "green", attrs=["reverse", "bold"]))
-    print(f"Total errors: {total_errors}")
+  # lazily allocated results are stored in arrival order, read them by position.
+  positions = {}
+  for stage in ['clip', 'text-encode']:
+    if RESULT_INDEX_TENSORS[stage] in in_ds.tensors:
+      stage_positions = get_result_positions(in_ds, stage)
+      assert (stage_positions >= 0).all(), f"{int((stage_positions < 0).sum())} rows have no {stage} result yet. Finish {stage} before compacting."
+      positions.update({tensor_name: stage_positions for tensor_name in RESULT_TENSORS[stage] if tensor_name in in_ds.tensors})
+
+  # work items split at the chunk boundaries of every tensor read by row (positioned tensors are read in arrival order).
+  work_items = []
+  row_tensor_names = [tensor_name for tensor_name in tensor_specs if tensor_name not in positions]
+  for first_idx, last_idx in get_chunk_row_ranges(in_ds, row_tensor_names, max_rows=COMPACT_MAX_ROWS_PER_TASK):
+    work_items.append({
+        'first_idx': first_idx,
+        'last_idx': last_idx,
+        'positions': {tensor_name: tensor_positions[first_idx:last_idx] for tensor_name, tensor_positions in positions.items()},
+    })
+
+  print(colored(f"👉 Start creating the new, compressed, dataset. {len(work_items)} work items, {num_workers} workers", "cyan", attrs=["reverse", "bold"]))
+  start_time = time.monotonic()
+  _compact_rows(dataset_path=str(dataset_path), tensor_names=list(tensor_specs),
+                embedding_codec_level=embedding_codec_level).eval(work_items, out_ds, scheduler='ray', num_workers=num_workers)
+  out_ds.flush()
+  print(out_ds.summary())
+  num_rows = get_num_rows(in_ds)
+  print(f"⏰ Time to compact {num_rows} rows: {(time.monotonic() - start_time)/60:.2f} minutes")
+
+  # verify before anything destructive happens
+  wrong_lengths = {tensor_name: len(out_ds[tensor_name]) for tensor_name in tensor_specs if len(out_ds[tensor_name]) != num_rows}
+  assert not wrong_lengths, f"Compacted dataset has the wrong number of rows (expected {num_rows}): {wrong_lengths}"
+  print(colored(f"✅ Successfully created compressed dataset at path: {outpath}", "green", attrs=["reverse", "bold"]))
+
+  if destructive:
+    del in_ds, out_ds
+    swap_in_dataset(outpath, dataset_path)
+
+
+def get_chunk_row_ranges(ds, tensor_names, max_rows):
+  '''
+  Split [0, get_num_rows(ds)) at the union of the chunk boundaries of `tensor_names`, grouping whole pieces up to
+  `max_rows` per range. A piece bigger than max_rows is cut every max_rows rows: no range is ever longer than max_rows.
+  returns: list of (first_idx, last_idx), last_idx exclusive.
+  '''
+  num_rows = get_num_rows(ds)
+  boundaries = {num_rows}
+  for tensor_name in tensor_names:
+    # chunk_id_encoder rows are [chunk_id, last_index_in_chunk]
+    last_indexes = ds[tensor_name].chunk_engine.chunk_id_encoder.array[:, 1]
+    boundaries.update(int(last_index) + 1 for last_index in last_indexes if 0 < int(last_index) + 1 < num_rows)
+  ranges = []
+  first_idx = prev_boundary = 0
+  for boundary in sorted(boundaries):
+    if boundary - first_idx > max_rows and prev_boundary > first_idx:
+      ranges.append((first_idx, prev_boundary))
+      first_idx = prev_boundary
+    while boundary - first_idx > max_rows:
+      ranges.append((first_idx, first_idx + max_rows))
+      first_idx += max_rows
+    prev_boundary = boundary
+  if num_rows > first_idx:
+    ranges.append((first_idx, num_rows))
+  return ranges
+
+
+def swap_in_dataset(new_path, dataset_path):
+  '''
+  Atomically replace the dataset at `dataset_path` with the one at `new_path` (local paths, same filesystem).
+  `dataset_path` is a symlink to a versioned directory (<name>_v<time_ns>). The new dataset is renamed to a new version,
+  then a temp symlink to it is os.replace()'d over `dataset_path`, so a concurrent dl.load() gets the old or the new
+  dataset, never neither. The previous version is kept for readers that loaded it before the swap, older ones are deleted.
+
+  A `dataset_path` that is still a plain directory is converted on the first swap (renamed to a version, then linked).
+  That one rename is NOT atomic: run the first swap with no readers or writers of the dataset.
+  '''
+  dataset_path = pathlib.Path(dataset_path)
+  version_prefix = f"{dataset_path.name}_v"
+  if not dataset_path.is_symlink():
+    first_version = dataset_path.parent / f"{version_prefix}{time.time_ns()}"
+    os.rename(dataset_path, first_version)
+    os.symlink(first_version.name, dataset_path)
+    print(colored(f"👉 Converted {dataset_path} to a symlink to {first_version.name}", "cyan", attrs=["reverse", "bold"]))
+  previous_version = (dataset_path.parent / os.readlink(dataset_path)).resolve()
+  new_version = dataset_path.parent / f"{version_prefix}{time.time_ns()}"
+  os.rename(new_path, new_version)
+  tmp_link = dataset_path.parent / f".{dataset_path.name}_swap_{os.getpid()}"
+  os.symlink(new_version.name, tmp_link)  # relative, like the first link
+  os.replace(tmp_link, dataset_path)
+  for version in dataset_path.parent.glob(f"{version_prefix}*"):
+    if version.name[len(version_prefix):].isdigit() and version.resolve() not in (new_version.resolve(), previous_version):
+      shutil.rmtree(version)
+  print(colored(f"✅ Swapped compacted dataset into {dataset_path} (-> {new_version.name}, previous: {previous_version.name})", "green", attrs=["reverse", "bold"]))
+
+
+def _decoded_dtype(ds, tensor_name):
+  ''' dtype of the samples in `tensor_name` after decoding (embedding_codec tensors are stored as uint8 blobs). '''
+  if ds[tensor_name].info.get('codec') is None or len(ds[tensor_name]) == 0:
+    return ds[tensor_name].dtype
+  return maybe_decode_embedding(ds[tensor_name][0].numpy()).dtype
+
+
+@dl.compute
+def _compact_rows(work_item, sample_out, dataset_path, tensor_names, embedding_codec_level=None):
+  '''
+  One compaction work item: slice-read every tensor for rows [first_idx, last_idx), extend the output with them.
+  '''
+  if dataset_path not in _compact_input_datasets:
+    _compact_input_datasets[dataset_path] = dl.load(dataset_path, read_only=True)
+  in_ds = _compact_input_datasets[dataset_path]
+  rows = slice(work_item['first_idx'], work_item['last_idx'])
+  for tensor_name in tensor_names:
+    if tensor_name in work_item['positions']:
+      index = [int(position) for position in work_item['positions'][tensor_name]]
+    else:
+      index = rows
+    tensor = in_ds[tensor_name][index]
+    if in_ds[tensor_name].htype == 'text':
+      values = tensor.data()['value']
+      values = [values] if isinstance(values, str) else list(values)
+    else:
+      values = tensor.numpy(aslist=True)
+    if tensor_name in EMBEDDING_TENSOR_NAMES:
+      values = [maybe_decode_embedding(value) for value in values]
+      if embedding_codec_level is not None:
+        values = [encode_embedding(value, level=embedding_codec_level) for value in values]
+    sample_out[tensor_name].extend(values)
+  return sample_out
 
 
 # @dl.compute
@@ -341,6 +665,82 @@ def upload_dataset_to_s3(dataset_path):
   dl.deepcopy(dataset_path, f's3://handpicked_only/{ds_name}')
 
 
+def put_results_in_object_store(results):
+  '''
+  Encoder side. Put a results payload into the Ray object store ONCE, return a tiny handle for the upload queue.
+  The ray.util.queue.Queue is an actor, so anything put on it directly gets pickled + copied through that actor
+  (~70 MB per CLIP batch). The handle is just an ObjectRef (wrapped in a dict, so Ray doesn't resolve it in transit).
+
+  Tensors are converted to numpy first: numpy arrays come back out of the object store as zero-copy (read-only) views.
+  '''
+  if isinstance(results, dict):
+    results = {key: _to_numpy(value) for key, value in results.items()}
+  return {'results_ref': ray.put(results)}
+
+
+def get_results_from_handle(queue_item):
+  '''
+  Uploader side. Resolve a handle from put_results_in_object_store(). Anything else (old-style payloads) passes through.
+  '''
+  if isinstance(queue_item, dict) and 'results_ref' in queue_item:
+    return ray.get(queue_item['results_ref'])
+  return queue_item
+
+
+def _to_numpy(value):
+  if hasattr(value, 'numpy') and hasattr(value, 'detach'):
+    return value.detach().cpu().numpy()  # torch.Tensor
+  if isinstance(value, list) and len(value) > 0 and all(isinstance(item, np.ndarray) for item in value):
+    if all(item.shape == value[0].shape for item in value):
+      return np.stack(value)  # e.g. the list of frames -> one contiguous buffer
+  return value
+
+
+def get_todo_indexes(ds, completion_tensor_name):
+  '''
+  Resume helper. ONE vectorized read of a per-row completion bitmap (bool tensor, e.g. `done_clip_encode`), instead of
+  reading every embedding to check if it's still all zeros.
+  returns: np.ndarray of db_indexes that are NOT done yet, ascending.
+  '''
+  start_time = time.monotonic()
+  done = np.asarray(ds[completion_tensor_name].numpy()).reshape(-1).astype(bool)
+  todo_indexes = np.flatnonzero(~done)
+  print(f"⏰ Read `{completion_tensor_name}` bitmap in {(time.monotonic() - start_time):.2f} seconds. {len(todo_indexes)} of {len(done)} rows still to do.")
+  return todo_indexes
+
+
+def create_lazy_result_tensors(ds, stage):
+  '''
+  Lazy allocation. Create the index map tensor for `stage` (see RESULT_INDEX_TENSORS). The result tensors themselves
+  must be created EMPTY by the caller, no placeholder rows. Call inside `with ds:`
+  '''
+  ds.create_tensor(RESULT_INDEX_TENSORS[stage], htype='generic', dtype=np.int64, sample_compression=None)
+
+
+def get_num_rows(ds):
+  '''
+  Number of rows (db_indexes) of a dataset, the length of SOURCE_ROW_TENSOR. Not len(ds), that's the SHORTEST tensor (0
+  while lazy result tensors are empty). Not ds.max_len either: a lazy result tensor holds duplicate appends after a crash.
+  '''
+  return len(ds[SOURCE_ROW_TENSOR])
+
+
+def get_result_positions(ds, stage):
+  '''
+  Map each db_index to the position of its result in the RESULT_TENSORS of `stage`.
+  Pre-filled datasets: the identity. Lazily allocated datasets: inverted index map, -1 where nothing was written yet.
+  If a row was written twice (crash between the append and the completion bitmap), the later append wins.
+
+  returns: np.ndarray of int64, length get_num_rows(ds).
+  '''
+  if RESULT_INDEX_TENSORS[stage] not in ds.tensors:
+    return np.arange(get_num_rows(ds), dtype=np.int64)
+  source_indexes = np.asarray(ds[RESULT_INDEX_TENSORS[stage]].numpy()).reshape(-1).astype(np.int64)
+  positions = np.full(get_num_rows(ds), -1, dtype=np.int64)
+  positions[source_indexes] = np.arange(len(source_indexes), dtype=np.int64)
+  return positions
+
+
 def check_continuity(my_list):
   '''
   https://stackoverflow.com/questions/48596542/how-to-check-all-the-integers-in-the-list-are-continuous
@@ -348,5 +748,27 @@ def check_continuity(my_list):
   return all(a + 1 == b for a, b in zip(my_list, my_list[1:]))
 
 
+def split_into_contiguous_runs(my_list):
+  '''
+  Group a SORTED list of db_indexes into runs of consecutive integers, so each run can be written with one slice.
+  Duplicates are not allowed (each db_index is written once).
+
+  returns: list of (first_idx, last_idx) tuples. last_idx is exclusive, like a slice.
+  Example: [3, 4, 5, 9, 10, 12] --> [(3, 6), (9, 11), (12, 13)]
+  '''
+  runs = []
+  if len(my_list) == 0:
+    return runs
+  first_idx = prev_idx = my_list[0]
+  for idx in my_list[1:]:
+    assert idx > prev_idx, print(f"db_indexes must be sorted and unique. Got {prev_idx} then {idx}")
+    if idx != prev_idx + 1:
+      runs.append((first_idx, prev_idx + 1))
+      first_idx = idx
+    prev_idx = idx
+  runs.append((first_idx, prev_idx + 1))
+  return runs
+
+
 if __name__ == "__main__":
   pass
\ No newline at end of file
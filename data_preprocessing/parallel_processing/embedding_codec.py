@@ -0,0 +1,149 @@
+'''
+Float-aware compression for embedding tensors: byte shuffle, then zstd.
+
+Deeplake's only byte compression is lz4, which finds almost nothing to match in float payloads. Shuffling the bytes
+first (all 1st bytes of every float, then all 2nd bytes, ...) groups the sign/exponent bytes together, which zstd
+compresses well. Deeplake can't run a custom codec, so we do it ourselves:
+  * encoder workers call encode_embedding() before results go on the upload queue (the uploader only writes bytes).
+  * the blob goes in a generic uint8 tensor with sample_compression=None (see create_embedding_tensor).
+  * blobs carry a small header (magic, dtype, shape), so readers can decode without knowing the tensor's settings.
+    is_encoded_embedding() / maybe_decode_embedding() make decoding transparent.
+
+Needs `pip install zstandard`. Benchmark against lz4 on a real dataset:
+  python embedding_codec.py /mnt/teton/vpt/data/yt-1b_deeplake/feb_25_CLIP_encode_results_yt1b-val
+'''
+import struct
+import sys
+import time
+
+import numpy as np
+
+EMBEDDING_TENSOR_NAMES = ['clip_pooled_embedding', 'clip_last_hidden_states', 'caption_embedding']
+DEFAULT_ZSTD_LEVEL = 3
+
+# header: magic, shuffle flag, dtype str (e.g. '<f4', padded to 8 bytes), ndim. Then ndim x int64 shape.
+_MAGIC = b'EMBZ'
+_HEADER = struct.Struct('<4sB8sB')
+
+
+def encode_embedding(array, level=DEFAULT_ZSTD_LEVEL, shuffle=True):
+  '''
+  param array: np.ndarray (any numeric dtype, any shape). Torch tensors: call .numpy() first.
+  returns: np.ndarray uint8, 1-D. The blob to store.
+  '''
+  import zstandard
+
+  array = np.ascontiguousarray(array)
+  payload = array.view(np.uint8).reshape(-1, array.dtype.itemsize)
+  payload = payload.T.copy() if shuffle and array.dtype.itemsize > 1 else payload
+  header = _HEADER.pack(_MAGIC, int(shuffle), array.dtype.str.encode(), array.ndim) + struct.pack(f'<{array.ndim}q', *array.shape)
+  compressed = zstandard.ZstdCompressor(level=level).compress(payload.tobytes())
+  return np.frombuffer(header + compressed, dtype=np.uint8)
+
+
+def decode_embedding(blob):
+  '''
+  Inverse of encode_embedding().
+  returns: np.ndarray with the original dtype and shape.
+  '''
+  import zstandard
+
+  blob = np.asarray(blob, dtype=np.uint8).tobytes()
+  magic, shuffle, dtype, ndim = _HEADER.unpack_from(blob)
+  assert magic == _MAGIC, "Not an encode_embedding() blob."
+  shape = struct.unpack_from(f'<{ndim}q', blob, _HEADER.size)
+  dtype = np.dtype(dtype.rstrip(b'\x00').decode())
+  payload = np.frombuffer(zstandard.ZstdDecompressor().decompress(blob[_HEADER.size + 8 * ndim:]), dtype=np.uint8)
+  if shuffle and dtype.itemsize > 1:
+    payload = payload.reshape(dtype.itemsize, -1).T
+  return np.ascontiguousarray(payload).view(dtype).reshape(shape)
+
+
+def is_encoded_embedding(array):
+  return isinstance(array, np.ndarray) and array.dtype == np.uint8 and array.ndim == 1 and array[:4].tobytes() == _MAGIC
+
+
+def maybe_decode_embedding(array):
+  ''' Decode if it's an encode_embedding() blob, otherwise return as-is. For readers that accept both. '''
+  return decode_embedding(array) if is_encoded_embedding(array) else array
+
+
+def encode_embedding_batch(batch, level=DEFAULT_ZSTD_LEVEL):
+  '''
+  param batch: np.ndarray / torch.Tensor (batch_size, ...) or list of arrays (e.g. variable-length caption embeddings).
+  returns: list of uint8 blobs, one per sample.
+  '''
+  if hasattr(batch, 'detach'):
+    batch = batch.detach().cpu().numpy()
+  return [encode_embedding(np.asarray(sample), level=level) for sample in batch]
+
+
+def create_embedding_tensor(ds, tensor_name, codec_level=None, **create_tensor_kwargs):
+  '''
+  codec_level=None: normal tensor (create_tensor_kwargs, e.g. dtype + sample_compression='lz4').
+  codec_level=int: uint8 blob tensor for encode_embedding() output, at that zstd level.
+  '''
+  if codec_level is None:
+    return ds.create_tensor(tensor_name, **create_tensor_kwargs)
+  tensor = ds.create_tensor(tensor_name, htype='generic', dtype=np.uint8, sample_compression=None)
+  tensor.info.update(codec='byte-shuffle-zstd', codec_level=codec_level)
+  return tensor
+
+
+def assert_codec_level_matches(ds, tensor_name, codec_level):
+  '''
+  Resume check, so one tensor never mixes encoded and plain samples. The level is recorded in the tensor info by
+  create_embedding_tensor(). None: a plain (lz4 / uncompressed) tensor, also every dataset from before the codec.
+  '''
+  stored_level = ds[tensor_name].info.get('codec_level')
+  assert stored_level == codec_level, print(f"EMBEDDING_CODEC_LEVEL={codec_level} but the existing `{tensor_name}` was written with codec level {stored_level}")
+
+
+def benchmark_codecs(samples, zstd_levels=(1, 3, 9)):
+  '''
+  Compare lz4 (what deeplake does with sample_compression='lz4') against byte-shuffle + zstd, and plain zstd.
+  param samples: list of np.ndarrays (real embeddings).
+  returns: {codec_name: {'ratio', 'encode_MBps', 'decode_MBps'}}
+  '''
+  import numcodecs.lz4
+  import zstandard
+
+  raw_bytes = sum(sample.nbytes for sample in samples)
+  codecs = {'lz4': (lambda a: numcodecs.lz4.compress(np.ascontiguousarray(a)), numcodecs.lz4.decompress)}
+  for level in zstd_levels:
+    codecs[f'zstd-{level}'] = (lambda a, level=level: zstandard.ZstdCompressor(level=level).compress(np.ascontiguousarray(a).tobytes()),
+                               lambda b: zstandard.ZstdDecompressor().decompress(b))
+    codecs[f'shuffle-zstd-{level}'] = (lambda a, level=level: encode_embedding(a, level=level), decode_embedding)
+
+  report = {}
+  for codec_name, (encode, decode) in codecs.items():
+    start_time = time.monotonic()
+    encoded = [encode(sample) for sample in samples]
+    encode_seconds = time.monotonic() - start_time
+    start_time = time.monotonic()
+    for blob in encoded:
+      decode(blob)
+    decode_seconds = time.monotonic() - start_time
+    report[codec_name] = {
+        'ratio': raw_bytes / sum(len(blob) for blob in encoded),
+        'encode_MBps': raw_bytes / 1e6 / max(encode_seconds, 1e-9),
+        'decode_MBps': raw_bytes / 1e6 / max(decode_seconds, 1e-9),
+    }
+  return report
+
+
+def benchmark_on_dataset(dataset_path, tensor_names=EMBEDDING_TENSOR_NAMES, num_samples=64):
+  import deeplake as dl
+
+  ds = dl.load(dataset_path, read_only=True)
+  for tensor_name in tensor_names:
+    if tensor_name not in ds.tensors:
+      continue
+    samples = [maybe_decode_embedding(sample) for sample in ds[tensor_name][0:min(num_samples, len(ds[tensor_name]))].numpy(aslist=True)]
+    print(f"👉 {tensor_name}: {len(samples)} samples, dtype {samples[0].dtype}, shape {samples[0].shape}")
+    for codec_name, stats in benchmark_codecs(samples).items():
+      print(f"  {codec_name:>16}: ratio {stats['ratio']:.2f}x, encode {stats['encode_MBps']:.0f} MB/s, decode {stats['decode_MBps']:.0f} MB/s")
+
+
+if __name__ == '__main__':
+  benchmark_on_dataset(sys.argv[1])
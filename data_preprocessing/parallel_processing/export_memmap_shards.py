@@ -0,0 +1,159 @@
+'''
+Export a finished CLIP + text-encode dataset to fixed-layout NumPy memmap shards, for training without Deeplake.
+
+ds.pytorch() decompresses every sample and runs Python transforms in the training hot path. These shards are plain
+.npy files (np.load(mmap_mode=...) is zero-copy, page-cache friendly), read by MemmapShardDataset in
+model/models_and_training/YT1B_pretrain/memmap_shard_dataset.py.
+
+Layout, one directory per shard (shard_00000, shard_00001, ...):
+  clip_pooled_embedding.npy          (N, 1024) float32
+  clip_last_hidden_states.npy        (N, 577, 1024) in the dataset's storage dtype (fp32 / fp16 / int8)
+  clip_last_hidden_states_scale.npy  (N, 577) float32, only for int8 (see hidden_state_quantization.py)
+  caption_embedding.npy              (total_caption_tokens, 1024) float16, ragged: rows of sample i are
+  caption_embedding_offsets.npy      (N + 1,) int64                           offsets[i]:offsets[i + 1]
+  caption_token_ids.npy              (total_label_tokens,) int32, ragged, the dataset's caption_token_ids column if it has
+                                     one, otherwise the full caption tokenized with `tokenizer_name`
+  caption_token_offsets.npy          (N + 1,) int64
+  metadata.json                      num_rows, source rows, dtypes, tokenizer_name
+
+Usage:
+  python export_memmap_shards.py <dataset_path> <output_dir>
+'''
+import json
+import os
+import pathlib
+import sys
+import time
+
+import deeplake as dl
+import numpy as np
+import ray
+from deeplake_driver import get_num_rows, get_result_positions
+from embedding_codec import maybe_decode_embedding
+from hidden_state_quantization import SCALE_TENSOR_NAME
+from termcolor import colored
+
+# pyright: reportGeneralTypeIssues=false
+# ^^ due to not understanding deeplake
+# pyright: reportPrivateImportUsage=false
+# pyright: reportOptionalMemberAccess=false
+# ^^ due to not understanding ray
+
+ROWS_PER_SHARD = 8_192  # ~19 GB of fp32 hidden states per shard.
+ROWS_PER_READ = 256  # rows read from Deeplake at once while filling a shard.
+TOKENIZER_NAME = "google/t5-v1_1-large"  # must match the VPT_model being trained.
+
+
+def export_memmap_shards(dataset_path, output_dir, rows_per_shard=ROWS_PER_SHARD, tokenizer_name=TOKENIZER_NAME):
+  '''
+  One Ray task per shard (needs ray.init() first). Safe to re-run: shards that already have metadata.json are skipped.
+  returns: list of shard directories, in row order.
+  '''
+  ds = dl.load(dataset_path, read_only=True)
+  num_rows = get_num_rows(ds)
+  output_dir = pathlib.Path(output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
+  shard_dirs = []
+  futures = []
+  for shard, first_idx in enumerate(range(0, num_rows, rows_per_shard)):
+    shard_dir = output_dir / f"shard_{shard:05d}"
+    shard_dirs.append(shard_dir)
+    if (shard_dir / 'metadata.json').exists():
+      continue
+    futures.append(export_shard.remote(str(dataset_path), str(shard_dir), first_idx, min(first_idx + rows_per_shard, num_rows), tokenizer_name))
+  print(colored(f"👉 Exporting {num_rows} rows to {len(shard_dirs)} shards ({len(futures)} to do) in {output_dir}", "cyan", attrs=["reverse", "bold"]))
+  start_time = time.monotonic()
+  ray.get(futures)
+  print(f"⏰ Time to export shards: {(time.monotonic() - start_time)/60:.2f} minutes")
+  return shard_dirs
+
+
+@ray.remote(num_cpus=1)
+def export_shard(dataset_path, shard_dir, first_idx, last_idx, tokenizer_name):
+  return write_shard(dataset_path, shard_dir, first_idx, last_idx, tokenizer_name)
+
+
+def write_shard(dataset_path, shard_dir, first_idx, last_idx, tokenizer_name=TOKENIZER_NAME):
+  '''
+  Write rows [first_idx, last_idx) of the dataset as one shard. metadata.json is written LAST, it marks the shard done.
+  '''
+  from transformers import AutoTokenizer
+
+  ds = dl.load(dataset_path, read_only=True)
+  pretokenized = 'caption_token_ids' in ds.tensors  # written at text-encode time, see add_caption_token_columns().
+  if pretokenized:
+    tokenizer_name = ds.caption_token_ids.info.get('tokenizer', tokenizer_name)
+  else:
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+  shard_dir = pathlib.Path(shard_dir)
+  shard_dir.mkdir(parents=True, exist_ok=True)
+  num_rows = last_idx - first_idx
+  # lazily allocated results are stored in arrival order (see RESULT_INDEX_TENSORS).
+  clip_positions = get_result_positions(ds, 'clip')[first_idx:last_idx]
+  text_positions = get_result_positions(ds, 'text-encode')[first_idx:last_idx]
+  assert (clip_positions >= 0).all() and (text_positions >= 0).all(), f"Rows {first_idx}:{last_idx} aren't fully CLIP + text encoded yet."
+
+  # fixed-size tensors go straight into preallocated memmaps. Ragged ones are collected, then written once.
+  first_hidden_states = maybe_decode_embedding(ds.clip_last_hidden_states[int(clip_positions[0])].numpy())
+  pooled_out = np.lib.format.open_memmap(shard_dir / 'clip_pooled_embedding.npy', mode='w+', dtype=np.float32, shape=(num_rows, 1024))
+  hidden_out = np.lib.format.open_memmap(shard_dir / 'clip_last_hidden_states.npy',
+                                         mode='w+',
+                                         dtype=first_hidden_states.dtype,
+                                         shape=(num_rows,) + first_hidden_states.shape)
+  has_scales = SCALE_TENSOR_NAME in ds.tensors
+  if has_scales:
+    scale_out = np.lib.format.open_memmap(shard_dir / f'{SCALE_TENSOR_NAME}.npy', mode='w+', dtype=np.float32, shape=(num_rows, first_hidden_states.shape[0]))
+  caption_embeddings = []
+  caption_token_ids = []
+
+  for read_start in range(0, num_rows, ROWS_PER_READ):
+    read_end = min(read_start + ROWS_PER_READ, num_rows)
+    clip_index = [int(position) for position in clip_positions[read_start:read_end]]
+    text_index = [int(position) for position in text_positions[read_start:read_end]]
+    pooled_out[read_start:read_end] = [maybe_decode_embedding(sample) for sample in ds.clip_pooled_embedding[clip_index].numpy(aslist=True)]
+    hidden_out[read_start:read_end] = [maybe_decode_embedding(sample) for sample in ds.clip_last_hidden_states[clip_index].numpy(aslist=True)]
+    if has_scales:
+      scale_out[read_start:read_end] = ds[SCALE_TENSOR_NAME][clip_index].numpy()
+    caption_embeddings.extend(
+        maybe_decode_embedding(sample).astype(np.float16, copy=False) for sample in ds.caption_embedding[text_index].numpy(aslist=True))
+    if pretokenized:
+      caption_token_ids.extend(ds.caption_token_ids[first_idx + read_start:first_idx + read_end].numpy(aslist=True))
+    else:
+      captions = ds.caption[first_idx + read_start:first_idx + read_end].data()['value']
+      captions = [captions] if isinstance(captions, str) else list(captions)
+      caption_token_ids.extend(tokenizer(captions, padding=False, truncation=True).input_ids)
+
+  pooled_out.flush()
+  hidden_out.flush()
+  if has_scales:
+    scale_out.flush()
+  _write_ragged(shard_dir, 'caption_embedding', caption_embeddings, 'caption_embedding_offsets', dtype=np.float16)
+  _write_ragged(shard_dir, 'caption_token_ids', [np.asarray(ids, dtype=np.int32) for ids in caption_token_ids], 'caption_token_offsets', dtype=np.int32)
+
+  metadata = {
+      'num_rows': num_rows,
+      'source_dataset': str(dataset_path),
+      'source_rows': [first_idx, last_idx],
+      'clip_last_hidden_states_dtype': first_hidden_states.dtype.str,
+      'has_hidden_state_scales': has_scales,
+      'tokenizer_name': tokenizer_name,
+  }
+  with open(shard_dir / 'metadata.json', 'w') as f:
+    json.dump(metadata, f, indent=2)
+  return str(shard_dir)
+
+
+def _write_ragged(shard_dir, name, samples, offsets_name, dtype):
+  lengths = np.array([len(sample) for sample in samples], dtype=np.int64)
+  offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+  row_shape = samples[0].shape[1:] if samples else ()
+  out = np.lib.format.open_memmap(shard_dir / f'{name}.npy', mode='w+', dtype=dtype, shape=(int(offsets[-1]),) + row_shape)
+  for sample, start, end in zip(samples, offsets[:-1], offsets[1:]):
+    out[start:end] = sample
+  out.flush()
+  np.save(shard_dir / f'{offsets_name}.npy', offsets)
+
+
+if __name__ == '__main__':
+  ray.init(num_cpus=os.cpu_count(), include_dashboard=False, ignore_reinit_error=True)
+  export_memmap_shards(sys.argv[1], sys.argv[2])
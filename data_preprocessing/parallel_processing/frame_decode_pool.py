@@ -0,0 +1,117 @@
+'''
+Multi-process frame decode service for ClipEncoder.
+
+decord is pinned to num_threads=1 because of the DecodeError bug (https://github.com/dmlc/decord/issues/124), and the
+old `use_multithreading` path in extract_frames_from_video was dead code. So instead of threads INSIDE decord, we run
+many single-threaded decord readers in separate processes:
+  * one shared ProcessPoolExecutor, so every idle worker takes the next video. (A batch covers only a few videos, pinning
+    videos to workers left most of them idle.) Each worker keeps a small LRU of open VideoReaders, which still hits when
+    consecutive batches of a video land on the same worker.
+  * workers only import frame_reader.py (decord + numpy), not clip_encoder's torch / transformers.
+  * frames come back through POSIX shared memory, not pickled through a pipe. The parent copies them straight into
+    its batch and frees the block.
+
+Usage:
+  pool = FrameDecodePool(num_workers=32)
+  video_to_frames = pool.extract_frames({video_filepath: (timestamps, video_metadata_or_None), ...})
+  pool.shutdown()  # ClipEncoder.shutdown() does this for its pool.
+'''
+import collections
+import concurrent.futures
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+from frame_reader import read_frames_at_times
+
+READER_CACHE_SIZE = 4  # open VideoReaders kept per worker process.
+
+# per-worker-process LRU of open decord VideoReaders. {video_filepath: VideoReader}
+_reader_cache = collections.OrderedDict()
+
+
+class FrameDecodePool():
+
+  def __init__(self, num_workers, reader_cache_size=READER_CACHE_SIZE):
+    self.num_workers = num_workers
+    self.reader_cache_size = reader_cache_size
+    # 'spawn' because the parent has CUDA initialized, forking that is asking for trouble.
+    self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+
+  def extract_frames(self, video_to_times):
+    '''
+    :param video_to_times: dict of {video_filepath: (timestamps, video_metadata)}. video_metadata may be None.
+    :returns: dict of {video_filepath: np.ndarray (num_timestamps, H, W, 3)}, or None for videos that failed to decode.
+    '''
+    futures = {}
+    for video_filepath, (timestamps, video_metadata) in video_to_times.items():
+      futures[video_filepath] = self.executor.submit(_decode_to_shared_memory, str(video_filepath), list(timestamps), video_metadata,
+                                                     self.reader_cache_size)
+
+    video_to_frames = {}
+    for video_filepath, future in futures.items():
+      try:
+        video_to_frames[video_filepath] = _read_from_shared_memory(future.result())
+      except Exception as e:
+        print(f"❌ Failed to decode frames from {video_filepath} in FrameDecodePool: {e}")
+        video_to_frames[video_filepath] = None
+    return video_to_frames
+
+  def shutdown(self):
+    self.executor.shutdown(wait=True)
+
+
+def _read_from_shared_memory(handle):
+  '''
+  param handle: (shm_name, shape, dtype_str) from _decode_to_shared_memory.
+  returns: np.ndarray, a private copy. The shared memory block is freed.
+  '''
+  shm_name, shape, dtype = handle
+  shm = shared_memory.SharedMemory(name=shm_name)
+  try:
+    frames = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).copy()
+  finally:
+    shm.close()
+    shm.unlink()
+  return frames
+
+
+########################################
+##### RUNS INSIDE WORKER PROCESSES #####
+########################################
+
+
+def _get_cached_reader(video_filepath, reader_cache_size):
+  from decord import VideoReader, cpu
+
+  if video_filepath in _reader_cache:
+    _reader_cache.move_to_end(video_filepath)
+    return _reader_cache[video_filepath]
+  # num_threads=1, see module docstring.
+  vr = VideoReader(video_filepath, ctx=cpu(0), num_threads=1)
+  _reader_cache[video_filepath] = vr
+  while len(_reader_cache) > reader_cache_size:
+    _reader_cache.popitem(last=False)  # evict least recently used
+  return vr
+
+
+def _decode_to_shared_memory(video_filepath, timestamps, video_metadata, reader_cache_size):
+  '''
+  Decode frames in this worker, write them into a NEW shared memory block.
+  returns: (shm_name, shape, dtype_str). The parent is responsible for unlinking the block.
+  '''
+  try:
+    vr = _get_cached_reader(video_filepath, reader_cache_size)
+    frames = read_frames_at_times(vr, timestamps, video_metadata=video_metadata)
+  except Exception:
+    # reader may be in a bad state, drop it from the cache before re-raising to the parent.
+    _reader_cache.pop(video_filepath, None)
+    traceback.print_exc()
+    raise
+
+  shm = shared_memory.SharedMemory(create=True, size=max(frames.nbytes, 1))
+  np.ndarray(frames.shape, dtype=frames.dtype, buffer=shm.buf)[...] = frames
+  handle = (shm.name, frames.shape, frames.dtype.str)
+  shm.close()
+  return handle
@@ -0,0 +1,93 @@
+'''
+Near-duplicate frame cache for ClipEncoder.
+
+Slideshows, talking heads and static screens give nearly identical midpoint frames for consecutive segments. Before
+running CLIP, each frame's small grayscale thumbnail is compared to the last frame we actually ENCODED for the same
+video (the anchor). If it's within `threshold`, we reuse the anchor's embeddings instead of running the GPU on it.
+Comparing against the last encoded frame (not the last frame seen) means slow drift can't chain many skips together.
+
+Usage (ClipEncoder does this when dedup_threshold is set):
+  cache = NearDuplicateFrameCache(threshold=2.0)
+  reuse = cache.plan(video_filepaths, thumbnails)   # per frame: None (encode), int (copy a frame in this batch), or cached embeddings
+  ... run CLIP on the frames where reuse is None ...
+  cache.update(video_filepaths, thumbnails, reuse, embeddings_of_position)
+  print(cache.frames_skipped, cache.frames_seen)
+'''
+import collections
+
+import numpy as np
+
+THUMBNAIL_SIZE = 32  # thumbnails are THUMBNAIL_SIZE x THUMBNAIL_SIZE grayscale, independent of frame resolution.
+MAX_CACHED_VIDEOS = 32  # anchors kept (LRU). One anchor is ~2.4 MB (fp32 hidden states), batches only span a few videos.
+
+
+class NearDuplicateFrameCache():
+
+  def __init__(self, threshold, max_videos=MAX_CACHED_VIDEOS):
+    '''
+    threshold: max mean absolute difference between thumbnails, in gray levels (0-255), to count as a duplicate.
+               ~1-3 catches re-encoded static frames. 0 only skips pixel-identical thumbnails.
+    '''
+    self.threshold = threshold
+    self.max_videos = max_videos
+    self.anchors = collections.OrderedDict()  # {video_filepath: (thumbnail, embeddings tuple)}
+    self.frames_seen = 0
+    self.frames_skipped = 0
+
+  def plan(self, video_filepaths, thumbnails):
+    '''
+    Decide, frame by frame, which frames need CLIP.
+    returns: list, one per frame. None: run CLIP on it. int: copy the embeddings of that (encoded) position in this
+             batch. tuple: reuse these cached embeddings (from an earlier batch).
+    '''
+    reuse = []
+    batch_anchors = {}  # {video_filepath: (thumbnail, position)} of the latest frame to be encoded in this batch.
+    for position, (video_filepath, thumbnail) in enumerate(zip(video_filepaths, thumbnails)):
+      self.frames_seen += 1
+      anchor = batch_anchors.get(video_filepath) or self.anchors.get(video_filepath)
+      if anchor is not None and thumbnail_distance(thumbnail, anchor[0]) <= self.threshold:
+        reuse.append(anchor[1])
+        self.frames_skipped += 1
+      else:
+        reuse.append(None)
+        batch_anchors[video_filepath] = (thumbnail, position)
+    return reuse
+
+  def update(self, video_filepaths, thumbnails, reuse, embeddings_of_position):
+    '''
+    After CLIP ran: the last encoded frame of each video becomes its anchor for the next batches.
+    embeddings_of_position: function, batch position -> tuple of that frame's embeddings (kept as-is, so copy/clone them).
+    '''
+    last_encoded = {}
+    for position, (video_filepath, source) in enumerate(zip(video_filepaths, reuse)):
+      if source is None:
+        last_encoded[video_filepath] = position
+    for video_filepath, position in last_encoded.items():
+      self.anchors[video_filepath] = (thumbnails[position], embeddings_of_position(position))
+      self.anchors.move_to_end(video_filepath)
+    while len(self.anchors) > self.max_videos:
+      self.anchors.popitem(last=False)  # evict least recently used
+
+  def skipped_fraction(self):
+    return self.frames_skipped / self.frames_seen if self.frames_seen else 0.0
+
+
+def frame_thumbnail(frame, size=THUMBNAIL_SIZE):
+  '''
+  param frame: np.ndarray (H, W, 3) or (H, W), uint8.
+  returns: np.ndarray float32 (size, size), grayscale block means.
+  '''
+  gray = np.asarray(frame, dtype=np.float32)
+  if gray.ndim == 3:
+    gray = gray.mean(axis=2)
+  height, width = gray.shape
+  row_edges = (np.arange(size) * height) // size
+  col_edges = (np.arange(size) * width) // size
+  block_sums = np.add.reduceat(np.add.reduceat(gray, row_edges, axis=0), col_edges, axis=1)
+  block_sizes = np.outer(np.diff(np.append(row_edges, height)), np.diff(np.append(col_edges, width)))
+  return block_sums / np.maximum(block_sizes, 1)
+
+
+def thumbnail_distance(thumbnail_a, thumbnail_b):
+  ''' Mean absolute difference, in gray levels. '''
+  return float(np.abs(thumbnail_a - thumbnail_b).mean())
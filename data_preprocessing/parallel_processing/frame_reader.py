@@ -0,0 +1,83 @@
+'''
+Frame reading from an open decord VideoReader: timestamps -> frame indexes, decoded GOP by GOP.
+
+Only numpy + bisect (the reader is passed in), so decode processes (frame_decode_pool.py) can import this without
+torch / transformers / CLIP. ClipEncoder uses the same functions in-process.
+'''
+import bisect
+
+import numpy as np
+
+
+def read_frames_at_times(vr, times, video_metadata=None):
+  '''
+  :param vr: open decord.VideoReader
+  :param times: timestamps in seconds
+  :param video_metadata: optional dict from VideoMetadataIndex (cached fps + keyframes).
+  :return: np.ndarray (len(times), H, W, 3)
+  '''
+  fps = video_metadata['fps'] if video_metadata else vr.get_avg_fps()
+  key_indices = video_metadata['keyframes'] if video_metadata else None
+  # timestamp in seconds -> frame_index
+  frame_indexes = []
+  for t in times:
+    frame_indexes.append(int(t * fps))
+  return read_frames_by_gop(vr, frame_indexes, key_indices=key_indices)
+
+
+def group_frame_indexes_by_gop(frame_indexes, key_indices):
+  '''
+  :param frame_indexes: frame indexes to read, any order, duplicates ok.
+  :param key_indices: sorted keyframe indexes of the video (decord: vr.get_key_indices()).
+  :return: list of lists. Sorted, de-duplicated frame indexes, one list per GOP (group of pictures, keyframe to next keyframe).
+  Example: frame_indexes [70, 5, 12, 5, 130], key_indices [0, 60, 120] --> [[5, 12], [70], [130]]
+  '''
+  gops = []
+  curr_gop_start = None
+  for idx in sorted(set(frame_indexes)):
+    gop_start = key_indices[bisect.bisect_right(key_indices, idx) - 1] if len(key_indices) > 0 and idx >= key_indices[0] else 0
+    if gop_start != curr_gop_start:
+      gops.append([])
+      curr_gop_start = gop_start
+    gops[-1].append(idx)
+  return gops
+
+
+def read_frames_by_gop(vr, frame_indexes, key_indices=None):
+  '''
+  Seek-minimizing frame extraction. Sort + de-duplicate the requested frames, group them by GOP, then decode each GOP
+  ONCE: seek to the first requested frame of the GOP, then walk forward with skip_frames() (decodes, but skips the
+  resize/copy) to each later frame in that GOP. With one midpoint frame per 15-word segment many requests share a GOP,
+  so this avoids re-decoding from the keyframe for every single frame.
+
+  :param vr: open decord.VideoReader
+  :param frame_indexes: list of int, frame indexes in the CALLER'S order (duplicates ok).
+  :param key_indices: optional cached keyframe indexes (from VideoMetadataIndex). Otherwise asked from decord.
+  :return: np.ndarray (len(frame_indexes), H, W, 3), in the caller's order.
+  '''
+  num_frames = len(vr)
+  # clamp: int(t * fps) on the very last timestamp can land one past the end.
+  frame_indexes = [min(max(int(idx), 0), num_frames - 1) for idx in frame_indexes]
+  if key_indices is None:
+    try:
+      key_indices = list(vr.get_key_indices())
+    except Exception:
+      key_indices = []
+  if len(key_indices) == 0:
+    # no keyframe info (some containers), let decord handle it. Still sorted + unique.
+    unique_indexes = sorted(set(frame_indexes))
+    unique_frames = vr.get_batch(unique_indexes).asnumpy()
+    idx_to_frame = dict(zip(unique_indexes, unique_frames))
+    return np.stack([idx_to_frame[idx] for idx in frame_indexes])
+
+  idx_to_frame = {}
+  for gop in group_frame_indexes_by_gop(frame_indexes, key_indices):
+    vr.seek_accurate(gop[0])
+    idx_to_frame[gop[0]] = vr.next().asnumpy()
+    curr_position = gop[0] + 1  # position of the NEXT frame vr.next() returns
+    for idx in gop[1:]:
+      if idx > curr_position:
+        vr.skip_frames(idx - curr_position)
+      idx_to_frame[idx] = vr.next().asnumpy()
+      curr_position = idx + 1
+  return np.stack([idx_to_frame[idx] for idx in frame_indexes])
@@ -0,0 +1,99 @@
+'''
+Storage modes for `clip_last_hidden_states` (577 x 1024 per segment, 2.3 MB as float32, lz4 barely helps on floats).
+
+  'fp32': unchanged.
+  'fp16': half the bytes. CLIP ViT-L activations are well inside fp16 range.
+  'int8': a quarter of the bytes, plus one float32 scale per token (symmetric, per-token absmax / 127).
+          Scales are stored in `clip_last_hidden_states_scale`, shape (577,).
+
+Quantize on the encoder side (ClipEncoder, before upload), dequantize in the training transform.
+Pick a mode per dataset with the reconstruction error report:
+  python hidden_state_quantization.py /mnt/teton/vpt/data/yt-1b_deeplake/feb_25_CLIP_encode_results_yt1b-val
+'''
+import sys
+
+import numpy as np
+import torch
+
+HIDDEN_STATE_STORAGE_DTYPES = {
+    'fp32': np.float32,
+    'fp16': np.float16,
+    'int8': np.int8,
+}
+SCALE_TENSOR_NAME = 'clip_last_hidden_states_scale'  # only exists for 'int8' datasets.
+
+
+def quantize_hidden_states(hidden_states, mode):
+  '''
+  param hidden_states: torch.FloatTensor (batch_size, num_tokens, hidden_size), any device.
+  returns: (values, scales). values in the storage dtype, same device. scales is (batch_size, num_tokens) float32 for
+           'int8', otherwise None.
+  '''
+  assert mode in HIDDEN_STATE_STORAGE_DTYPES, print(f"Unknown hidden state storage mode {mode}, expected one of {list(HIDDEN_STATE_STORAGE_DTYPES)}")
+  if mode == 'fp32':
+    return hidden_states.float(), None
+  if mode == 'fp16':
+    return hidden_states.half(), None
+  hidden_states = hidden_states.float()
+  scales = hidden_states.abs().amax(dim=-1).clamp(min=1e-8) / 127.0
+  values = torch.round(hidden_states / scales.unsqueeze(-1)).clamp(-127, 127).to(torch.int8)
+  return values, scales
+
+
+def dequantize_hidden_states(values, scales=None):
+  '''
+  Inverse of quantize_hidden_states(), on numpy arrays (what deeplake gives the training transform).
+  Works on one sample (num_tokens, hidden_size) or a batch. fp32 input is returned as-is.
+  returns: np.ndarray float32
+  '''
+  if values.dtype == np.int8:
+    assert scales is not None, f"int8 hidden states need their `{SCALE_TENSOR_NAME}`"
+    return values.astype(np.float32) * np.asarray(scales, dtype=np.float32)[..., None]
+  return values.astype(np.float32, copy=False)
+
+
+def reconstruction_error_report(hidden_states, modes=('fp16', 'int8')):
+  '''
+  Quantize + dequantize fp32 hidden states in every mode and compare to the original.
+  param hidden_states: np.ndarray float32 (batch_size, num_tokens, hidden_size)
+  returns: {mode: {bytes_per_sample, size_vs_fp32, max_abs_error, mean_abs_error, relative_rmse, mean_token_cosine, min_token_cosine}}
+  '''
+  reference = np.asarray(hidden_states, dtype=np.float32)
+  fp32_bytes_per_sample = reference[0].nbytes
+  report = {}
+  for mode in modes:
+    values, scales = quantize_hidden_states(torch.from_numpy(reference), mode)
+    values = values.numpy()
+    scales = scales.numpy() if scales is not None else None
+    restored = dequantize_hidden_states(values, scales)
+    error = restored - reference
+    cosine = (restored * reference).sum(-1) / (np.linalg.norm(restored, axis=-1) * np.linalg.norm(reference, axis=-1) + 1e-12)
+    bytes_per_sample = values[0].nbytes + (scales[0].nbytes if scales is not None else 0)
+    report[mode] = {
+        'bytes_per_sample': int(bytes_per_sample),
+        'size_vs_fp32': bytes_per_sample / fp32_bytes_per_sample,
+        'max_abs_error': float(np.abs(error).max()),
+        'mean_abs_error': float(np.abs(error).mean()),
+        'relative_rmse': float(np.sqrt((error**2).mean()) / (np.sqrt((reference**2).mean()) + 1e-12)),
+        'mean_token_cosine': float(cosine.mean()),
+        'min_token_cosine': float(cosine.min()),
+    }
+  return report
+
+
+def report_on_dataset(dataset_path, num_samples=64):
+  '''
+  Print the reconstruction error report for the first `num_samples` rows of an fp32 CLIP results dataset.
+  '''
+  import deeplake as dl
+
+  ds = dl.load(dataset_path, read_only=True)
+  assert ds.clip_last_hidden_states.dtype == np.float32, "Need an fp32 dataset as the baseline."
+  hidden_states = np.stack(ds.clip_last_hidden_states[0:min(num_samples, len(ds.clip_last_hidden_states))].numpy(aslist=True))
+  print(f"Reconstruction error vs fp32, {len(hidden_states)} samples of shape {hidden_states.shape[1:]}:")
+  for mode, stats in reconstruction_error_report(hidden_states).items():
+    print(f"  {mode}: " + ", ".join(f"{key}={value:.4g}" for key, value in stats.items()))
+
+
+if __name__ == '__main__':
+  report_on_dataset(sys.argv[1])
@@ -18,10 +18,15 @@ import numpy as np
 import psutil
 import ray
 from clip_encoder import ClipEncoder
-from deeplake_driver import DeeplakeManager
+from deeplake_driver import (COMPLETION_TENSORS, EMBEDDING_CODEC_LEVEL, PREFILL_WITH_ZEROS, SEGMENT_COLUMNS, DeeplakeManager,
+                             create_lazy_result_tensors, get_num_rows, get_todo_indexes, put_results_in_object_store)
+from embedding_codec import assert_codec_level_matches, create_embedding_tensor, encode_embedding_batch
+from hidden_state_quantization import HIDDEN_STATE_STORAGE_DTYPES, SCALE_TENSOR_NAME
 from ray.util.queue import Queue
 from termcolor import colored
 from tqdm import tqdm
+from video_metadata_index import VideoMetadataIndex
+from visual_token_reduction import num_visual_tokens
 
 # TODO: Set max_restarts and max_task_retries to enable retry when the task crashes due to OOM.
 os.environ["RAY_memory_monitor_refresh_ms"] = "0"  # prevents ray from killing the process when it runs out of memory
@@ -52,6 +57,7 @@ global GPU_PER_PROCESS
 BATCH_NAME = 'yt1b-val'
 INPUT_DATASET_PATH = f'/mnt/teton/vpt/data/yt-1b_deeplake/feb_25_text_encode_results_{BATCH_NAME}'
 RESULTS_DATASET_PATH = f'/mnt/teton/vpt/data/yt-1b_deeplake/feb_25_CLIP_encode_results_{BATCH_NAME}'
+VIDEO_METADATA_INDEX_PATH = '/mnt/teton/vpt/data/yt-1b_deeplake/video_metadata_index.sqlite'  # shared by CLIP + Whisper
 
 # THIS is GREAT balance on delta GPU, 4X GPU with clip running
 # NUM_PARALLEL_PROCESSES = 20      # Number of parallel processes (limited by DRAM and SRAM)
@@ -64,6 +70,13 @@ NUM_CPU_CORES = psutil.cpu_count()  # Numer of available physical cores to use (
 NUM_GPUS = 1  # Number of physical GPUs to use (use max)
 GPU_PER_PROCESS = 1  # threads per GPU, limited by OOM errors while also maximizing spread.
 BATCH_SIZE = 30  # 30 * 2 threads. good on 11GB
+NUM_DECODE_WORKERS = 4  # threads per ClipEncoder decoding + preprocessing upcoming batches while the GPU runs.
+NUM_DECODE_PROCESSES = max(NUM_CPU_CORES // NUM_PARALLEL_PROCESSES - NUM_DECODE_WORKERS, 1)  # decord processes per ClipEncoder.
+NUM_PREFETCH_BATCHES = 4  # max decoded batches waiting for the GPU (bounds RAM usage).
+DEDUP_THRESHOLD = None  # e.g. 2.0: reuse embeddings for frames within this mean gray-level difference of the previous encoded frame of the same video. None: off.
+HIDDEN_STATE_STORAGE = 'fp32'  # 'fp32', 'fp16' or 'int8' (+ per-token scales) for clip_last_hidden_states. Pick with hidden_state_quantization.py's report.
+VISUAL_TOKEN_REDUCTION = None  # e.g. 'avgpool2': store 1 + 144 instead of 577 visual tokens per frame. None: all. See visual_token_reduction.py
+NUM_VISUAL_TOKENS = num_visual_tokens(VISUAL_TOKEN_REDUCTION)
 
 # rough GPU-mem per image is 22*3 / 11 = 6 images per gig.
 
@@ -94,23 +107,43 @@ class ParallelEncode:
     Main function for parallel clip. 
     '''
     start = time.monotonic()
-    process = ClipEncoder(debug=False)
-    while self.work_queue.qsize() > 0:
-      print(f"📌 {self.work_queue.qsize()} batches remaining")
-      batch = self.work_queue.get(block=True, timeout=120)
-      try:
-        results_dict = process.run_clip_one_batch(batch)
-        self.upload_queue.put(results_dict)  # nearly instant, v fast 🏎💨
-      except Exception as e:
-        print(f"❌❌ Error during {inspect.currentframe().f_code.co_name}: {e}")
-        traceback.print_exc()
-
+    process = ClipEncoder(debug=False,
+                          video_metadata_index_path=VIDEO_METADATA_INDEX_PATH,
+                          num_decode_processes=NUM_DECODE_PROCESSES,
+                          hidden_state_storage=HIDDEN_STATE_STORAGE,
+                          dedup_threshold=DEDUP_THRESHOLD,
+                          visual_token_reduction=VISUAL_TOKEN_REDUCTION)
+    # decode threads prefetch the next batches from the work queue while the current one runs on the GPU.
+    for results_dict in process.run_clip_streaming(self._iter_work_queue(),
+                                                   num_decode_workers=NUM_DECODE_WORKERS,
+                                                   num_prefetch_batches=NUM_PREFETCH_BATCHES):
+      if EMBEDDING_CODEC_LEVEL is not None:
+        # compress here, in parallel across workers, so the single uploader thread only writes bytes.
+        results_dict['pooled_clip_embeds'] = encode_embedding_batch(results_dict['pooled_clip_embeds'], level=EMBEDDING_CODEC_LEVEL)
+        results_dict['last_hidden_states'] = encode_embedding_batch(results_dict['last_hidden_states'], level=EMBEDDING_CODEC_LEVEL)
+      # only a handle goes through the queue, the arrays stay in the Ray object store (no copy through the queue actor).
+      self.upload_queue.put(put_results_in_object_store(results_dict))  # nearly instant, v fast 🏎💨
       print(
           f"⏰ OVERALL TIME: clip-encoded {BATCH_SIZE} segments in {(time.monotonic() - start)/60:.2f} minutes. (time/frame = {((time.monotonic() - start)/BATCH_SIZE):.2f} sec)"
       )
+      if process.frame_cache is not None:
+        print(f"♻️ Near-duplicate frames skipped so far: {process.frame_cache.frames_skipped} of {process.frame_cache.frames_seen} ({100 * process.frame_cache.skipped_fraction():.1f}%)")
       start = time.monotonic()
+    process.shutdown()
     print(f"Worker done in {inspect.currentframe().f_code.co_name} (work queue empty), exiting! 😎")
 
+  def _iter_work_queue(self):
+    '''
+    Yield batches from the shared work queue until it's empty. Feeds ClipEncoder.run_clip_streaming().
+    '''
+    while self.work_queue.qsize() > 0:
+      print(f"📌 {self.work_queue.qsize()} batches remaining")
+      try:
+        yield self.work_queue.get(block=True, timeout=120)
+      except Exception as e:
+        # it'll raise Empty after timeout, so just test while loop condition
+        print("Timeout waiting for work from work_queue. This is expected near end of job as workers finish.")
+
   def get_upload_queue_size(self):
     '''
     These 'get queue size' are used in main() to ensure we finish all work before exiting.
@@ -132,6 +165,15 @@ def main():
   if os.path.exists(RESULTS_DATASET_PATH):
     print(f"Loading existing dataset from {RESULTS_DATASET_PATH}")
     ds = dl.load(RESULTS_DATASET_PATH, read_only=True)
+    for tensor_name in ['clip_pooled_embedding', 'clip_last_hidden_states']:
+      assert_codec_level_matches(ds, tensor_name, EMBEDDING_CODEC_LEVEL)
+    # encoded tensors are uint8 blobs, their dtype is in the blob header. Check the recorded storage mode instead.
+    assert ds.clip_last_hidden_states.info.get('hidden_state_storage', HIDDEN_STATE_STORAGE) == HIDDEN_STATE_STORAGE, print(
+        f"HIDDEN_STATE_STORAGE={HIDDEN_STATE_STORAGE} but the existing dataset stores {ds.clip_last_hidden_states.info.get('hidden_state_storage')}")
+    assert EMBEDDING_CODEC_LEVEL is not None or ds.clip_last_hidden_states.dtype == HIDDEN_STATE_STORAGE_DTYPES[HIDDEN_STATE_STORAGE], print(
+        f"HIDDEN_STATE_STORAGE={HIDDEN_STATE_STORAGE} but the existing dataset stores {ds.clip_last_hidden_states.dtype}")
+    assert ds.clip_last_hidden_states.info.get('visual_token_reduction') == VISUAL_TOKEN_REDUCTION, print(
+        f"VISUAL_TOKEN_REDUCTION={VISUAL_TOKEN_REDUCTION} but the existing dataset used {ds.clip_last_hidden_states.info.get('visual_token_reduction')}")
     segment_batch_list = add_samples_to_dict(ds, do_filtering=True)
   else:
     # create dataset
@@ -143,25 +185,41 @@ def main():
     # CLIP produces FP32 embeddings.
     # inspo --> if 'clip_pooled_embedding' not in ds.tensors.keys():
     with ds:
-      ds.create_tensor('clip_pooled_embedding', htype='generic', dtype=np.float32, sample_compression='lz4')
-      ds.create_tensor('clip_last_hidden_states', htype='generic', dtype=np.float32, sample_compression='lz4')
+      create_embedding_tensor(ds, 'clip_pooled_embedding', EMBEDDING_CODEC_LEVEL, htype='generic', dtype=np.float32, sample_compression='lz4')
+      create_embedding_tensor(ds,
+                              'clip_last_hidden_states',
+                              EMBEDDING_CODEC_LEVEL,
+                              htype='generic',
+                              dtype=HIDDEN_STATE_STORAGE_DTYPES[HIDDEN_STATE_STORAGE],
+                              sample_compression='lz4')
+      ds.clip_last_hidden_states.info.update(visual_token_reduction=VISUAL_TOKEN_REDUCTION, hidden_state_storage=HIDDEN_STATE_STORAGE)  # checked on resume, read by training (visual_token_reduction_for_dataset).
+      if HIDDEN_STATE_STORAGE == 'int8':
+        ds.create_tensor(SCALE_TENSOR_NAME, htype='generic', dtype=np.float32, sample_compression='lz4')
       ds.create_tensor('frames', htype='image', dtype=np.uint8, sample_compression='jpeg')
       ds.create_tensor('timestamp', htype='generic', dtype=float, sample_compression='lz4')
-      # populate with none, so we can send it to the parallel workers.
-
-      print("Filling clip properties with all `None` so we can index and populate it")
-      start_time = time.monotonic()
-      all_nones = [None] * ds.max_len  # previous method took 75 seconds
-      ds.clip_pooled_embedding.extend(all_nones)
-      ds.clip_last_hidden_states.extend(all_nones)
-      ds.frames.extend(all_nones)
-      ds.timestamp.extend(all_nones)
-      print(ds.summary(), flush=True)
-      print(f"⏰ Time to fill with Nones: {(time.monotonic() - start_time):.2f} seconds")
-
-      start_time = time.monotonic()
-      populate_ds_with_zeros().eval(ds, scheduler="ray", num_workers=NUM_CPU_CORES, skip_ok=True)
-      print(f"⏰ Parallel.eval() Time to populate empty np arrays: {((time.monotonic() - start_time)/60):.2f} minutes")
+      ds.create_tensor(COMPLETION_TENSORS['clip'], htype='generic', dtype=bool, sample_compression=None)
+      ds[COMPLETION_TENSORS['clip']].extend([False] * get_num_rows(ds))  # completion bitmap, set by the uploader.
+
+      if not PREFILL_WITH_ZEROS:
+        # result tensors stay empty, the uploader appends to them. No placeholder data is ever written.
+        create_lazy_result_tensors(ds, 'clip')
+      else:
+        # populate with none, so we can send it to the parallel workers.
+        print("Filling clip properties with all `None` so we can index and populate it")
+        start_time = time.monotonic()
+        all_nones = [None] * get_num_rows(ds)  # previous method took 75 seconds
+        ds.clip_pooled_embedding.extend(all_nones)
+        ds.clip_last_hidden_states.extend(all_nones)
+        if HIDDEN_STATE_STORAGE == 'int8':
+          ds[SCALE_TENSOR_NAME].extend(all_nones)
+        ds.frames.extend(all_nones)
+        ds.timestamp.extend(all_nones)
+        print(ds.summary(), flush=True)
+        print(f"⏰ Time to fill with Nones: {(time.monotonic() - start_time):.2f} seconds")
+
+        start_time = time.monotonic()
+        populate_ds_with_zeros().eval(ds, scheduler="ray", num_workers=NUM_CPU_CORES, skip_ok=True)
+        print(f"⏰ Parallel.eval() Time to populate empty np arrays: {((time.monotonic() - start_time)/60):.2f} minutes")
 
       # # todo: could make this parallel like in text-encoder.
       # for _ in tqdm(range(ds.max_len),
@@ -182,6 +240,10 @@ def main():
     segment_batch_list = add_samples_to_dict(ds, do_filtering=False)
     print(f"⏰ add_samples_to_dict Filtering. Time to filter: {((time.monotonic() - start_time)/60):.2f} minutes")
 
+  # probe every video once (cached on disk across runs), so decode workers can skip re-reading fps + keyframes.
+  all_video_filepaths = {video_filepath for batch in segment_batch_list for video_filepath in batch.keys()}
+  VideoMetadataIndex(VIDEO_METADATA_INDEX_PATH).build(list(all_video_filepaths))
+
   # segment_batch_list = segment_batch_list[:50] # for testing
   print("Num batches: ", len(segment_batch_list))
   print("Starting parallel batches")
@@ -207,7 +269,9 @@ def populate_ds_with_zeros(sample_in, sample_out):
   Pre-populate the dataset with zeros of proper shape. This makes it 100x faster to update later via indexing. 
   '''
   sample_out.clip_pooled_embedding.append(np.zeros(1024, dtype=np.float32))
-  sample_out.clip_last_hidden_states.append(np.zeros((577, 1024), dtype=np.float32))
+  sample_out.clip_last_hidden_states.append(np.zeros((NUM_VISUAL_TOKENS, 1024), dtype=HIDDEN_STATE_STORAGE_DTYPES[HIDDEN_STATE_STORAGE]))
+  if HIDDEN_STATE_STORAGE == 'int8':
+    sample_out[SCALE_TENSOR_NAME].append(np.zeros(NUM_VISUAL_TOKENS, dtype=np.float32))
   sample_out.frames.append(np.zeros((360, 640, 3), dtype=np.uint8))
   sample_out.timestamp.append(float(0))
   return sample_out
@@ -228,15 +292,28 @@ def add_samples_to_dict(ds, do_filtering):
   print("Starting filtering")
   start_time = time.monotonic()
 
-  def add_one_sample(sample, batch, list_of_batches, total_samples):
+  has_segment_columns = all(tensor_name in ds.tensors for tensor_name in SEGMENT_COLUMNS)
+  has_completion_bitmap = COMPLETION_TENSORS['clip'] in ds.tensors
+  if has_segment_columns and (has_completion_bitmap or not do_filtering):
+    todo_indexes = get_todo_indexes(ds, COMPLETION_TENSORS['clip']) if do_filtering else np.arange(get_num_rows(ds))
+    list_of_batches = plan_batches_from_segment_columns(ds, todo_indexes)
+    print(f"⏰ Time to plan batches from segment columns: {(time.monotonic() - start_time):.2f} seconds")
+    assert len(list_of_batches) != 0, "Error: list_of_batches is empty. nothing to process..."
+    print(colored(f"✅ Already processed {get_num_rows(ds) - len(todo_indexes)}", "green", attrs=["reverse", "bold"]))
+    print(colored(f"👉 Total CLIP segments to process {len(todo_indexes)}", "cyan", attrs=["reverse", "bold"]))
+    return list_of_batches
+
+  # Old datasets without typed segment columns: json.loads every row. (See migrate_segment_metadata_to_columns)
+  # Reads single tensors by row, never ds[idx] / iterating ds: len(ds) is the SHORTEST tensor, 0 while the lazy result tensors are empty.
+  def add_one_sample(idx, batch, list_of_batches, total_samples):
     try:
-      metadata = json.loads(sample['segment_metadata'].data()['value'])
+      metadata = json.loads(ds.segment_metadata[idx].data()['value'])
       seg_start_time = float(metadata['start'])
       seg_end_time = float(metadata['end'])
       midpoint = (seg_end_time + seg_start_time) / 2
 
       # add to dict {'<filepath>': [<frame_timestamp>, ...]}
-      video_filepath = sample['video_filepath'].data()['value']
+      video_filepath = ds.video_filepath[idx].data()['value']
       if video_filepath not in batch.keys():
         batch[video_filepath] = []
       batch[video_filepath].append({'timestamp': midpoint, 'db_index': idx})
@@ -249,24 +326,29 @@ def add_samples_to_dict(ds, do_filtering):
         list_of_batches.append(batch)
         batch = {}
       total_samples += 1
-      return sample, batch, list_of_batches, total_samples
+      return batch, list_of_batches, total_samples
     except Exception as e:
       print("in Add_one_sample (might be a corrupted Deeplake?): ", e)
-      return None, None, None, None
+      return batch, list_of_batches, total_samples
 
   # DO FILTERING HERE:
   batch = {}
   list_of_batches = []
   total_samples = 0
-  for idx, sample in enumerate(ds):
-    # filter already completed CLIP results.
-    if do_filtering:
-      # Test if numpy array contains only zeros (they're initialized that way)
-      if not sample.clip_pooled_embedding.numpy().any():
-        sample, batch, list_of_batches, total_samples = add_one_sample(sample, batch, list_of_batches, total_samples)
-    else:
-      # just add everything
-      sample, batch, list_of_batches, total_samples = add_one_sample(sample, batch, list_of_batches, total_samples)
+  if do_filtering and COMPLETION_TENSORS['clip'] in ds.tensors:
+    # fast resume: one vectorized read of the completion bitmap, then only touch rows that aren't done.
+    for idx in get_todo_indexes(ds, COMPLETION_TENSORS['clip']):
+      batch, list_of_batches, total_samples = add_one_sample(int(idx), batch, list_of_batches, total_samples)
+  else:
+    for idx in range(get_num_rows(ds)):
+      # filter already completed CLIP results. (Old zero pre-filled datasets without a completion bitmap)
+      if do_filtering:
+        # Test if numpy array contains only zeros (they're initialized that way)
+        if not ds.clip_pooled_embedding[idx].numpy().any():
+          batch, list_of_batches, total_samples = add_one_sample(idx, batch, list_of_batches, total_samples)
+      else:
+        # just add everything
+        batch, list_of_batches, total_samples = add_one_sample(idx, batch, list_of_batches, total_samples)
 
   # catch last batch, when smaller than BATCH_SIZE.
   if batch != {}:
@@ -275,11 +357,28 @@ def add_samples_to_dict(ds, do_filtering):
 
   print(f"⏰ Time to filter completed results: {(time.monotonic() - start_time):.2f} seconds")
   assert len(list_of_batches) != 0 and batch == {}, "Error: list_of_batches is empty. nothing to process..."
-  print(colored(f"✅ Already processed {ds.max_len - total_samples}", "green", attrs=["reverse", "bold"]))
+  print(colored(f"✅ Already processed {get_num_rows(ds) - total_samples}", "green", attrs=["reverse", "bold"]))
   print(colored(f"👉 Total CLIP segments to process {total_samples}", "cyan", attrs=["reverse", "bold"]))
   return list_of_batches
 
 
+def plan_batches_from_segment_columns(ds, todo_indexes):
+  '''
+  Same output as add_samples_to_dict(), but from the typed segment columns: midpoints for ALL rows are one vectorized
+  numpy op over whole columns, no per-row json.loads.
+  param todo_indexes: ascending np.ndarray of db_indexes to process.
+  '''
+  midpoints = (ds.segment_start.numpy().reshape(-1).astype(np.float64) + ds.segment_end.numpy().reshape(-1)) / 2
+  video_filepaths = ds.video_filepath.data()['value']  # one read of the whole column
+  list_of_batches = []
+  for batch_start in range(0, len(todo_indexes), BATCH_SIZE):
+    batch = {}
+    for idx in todo_indexes[batch_start:batch_start + BATCH_SIZE]:
+      batch.setdefault(video_filepaths[idx], []).append({'timestamp': float(midpoints[idx]), 'db_index': int(idx)})
+    list_of_batches.append(batch)
+  return list_of_batches
+
+
 def print_cluster_stats():
   print("Querying size of Ray cluster...\n")
 
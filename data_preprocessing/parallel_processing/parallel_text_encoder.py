@@ -15,13 +15,15 @@ import more_itertools
 import numpy as np
 import psutil
 import ray
-from deeplake_driver import DeeplakeManager
+from batch_scheduler import bucketed_batches, restore_original_order
+from deeplake_driver import (COMPLETION_TENSORS, EMBEDDING_CODEC_LEVEL, PREFILL_WITH_ZEROS, DeeplakeManager, add_caption_token_columns,
+                             create_lazy_result_tensors, get_num_rows, get_todo_indexes, put_results_in_object_store)
+from embedding_codec import assert_codec_level_matches, create_embedding_tensor, encode_embedding
 from PIL import Image
 from ray.util.queue import Queue
 from termcolor import colored
 from text_encoder import FlanT5Encoder
 from tqdm import tqdm
-from transformers import T5Tokenizer
 
 # TODO: Set max_restarts and max_task_retries to enable retry when the task crashes due to OOM.
 os.environ["RAY_memory_monitor_refresh_ms"] = "0"  # prevents ray from killing the process when it runs out of memory
@@ -33,7 +35,6 @@ os.environ["RAY_memory_monitor_refresh_ms"] = "0"  # prevents ray from killing t
 # ^^ due to not understanding ray
 
 # for ray OOM errors: export RAY_DISABLE_MEMORY_MONITOR=1
-GLOBAL_TOKENIZER = T5Tokenizer.from_pretrained("google/flan-t5-large")
 
 # BATCH_NAME = "TVQA_BBT"
 # INPUT_DATASET_PATH = f"/mnt/teton/vpt/data/benchmark_datasets/TVQA/_deeplake/whisper_results_bbt_audios"
@@ -44,9 +45,10 @@ INPUT_DATASET_PATH = f'/mnt/teton/vpt/data/yt-1b_deeplake/feb_25_whisper_results
 RESULTS_DATASET_PATH = f'/mnt/teton/vpt/data/yt-1b_deeplake/feb_25_text_encode_results_{BATCH_NAME}'
 
 NUM_GPUS = 1
-NUM_PARALLEL_PROCESSES = 16  # 16 works on 4090, but util is average 5%.
+NUM_PARALLEL_PROCESSES = 2  # with batched encode, 2 saturates a 4090. (Batch size 1 needed 16, and util was still average 5%.)
 NUM_CPU_CORES = psutil.cpu_count()
-BATCH_SIZE = 512
+BATCH_SIZE = 512  # captions handed to a worker at once. Split into length-bucketed sub-batches under MAX_TOKENS_PER_BATCH.
+MAX_TOKENS_PER_BATCH = 32_768  # padded tokens per forward pass (num_captions * longest_caption). Lower this on OOM.
 
 # batch_size 38 was max on 1080ti.
 
@@ -75,11 +77,22 @@ class ParallelEncode:
     ds = dl.load(RESULTS_DATASET_PATH, read_only=True)  # read-only enables multiple to be open at once.
     print('ds loaded in queue')
     max_len = ds.max_len
-    for i, sample in enumerate(ds):
-      if not sample.done_text_encode.data()['value']:
-        self.work_queue.put({'caption': sample.caption.text(), 'db_index': i})
-      if i % 100 == 0:
+    # one vectorized read of the completion bitmap (written by the uploader), instead of checking row by row.
+    todo_indexes = get_todo_indexes(ds, COMPLETION_TENSORS['text-encode'])
+    # token counts were computed once at dataset creation, workers bucket by them without re-tokenizing.
+    caption_token_lens = np.asarray(ds.caption_token_len.numpy()).reshape(-1)
+    # feed whole batches (list of BATCH_SIZE dicts), so each GPU forward pass sees many captions.
+    batch = []
+    for i, idx in enumerate(todo_indexes):
+      idx = int(idx)
+      batch.append({'caption': ds.caption[idx].text(), 'db_index': idx, 'num_tokens': int(caption_token_lens[idx])})
+      if len(batch) == BATCH_SIZE:
+        self.work_queue.put(batch)
+        batch = []
+      if i % 10_000 == 0:
         print(f"📌 {self.work_queue.qsize()} batches. Still adding more...")
+    if batch:
+      self.work_queue.put(batch)  # last batch, when smaller than BATCH_SIZE.
     print("DONE POPULATING WORK QUEUE!")
 
     # block until work is done.
@@ -106,20 +119,29 @@ class ParallelEncode:
         continue
 
       try:
-        # returns: list of np.arrays, each of different shape [NUM_TOKENS, 1024]
-        last_hidden_states_batch = process.encode(batch)
+        # sort by token length into sub-batches, so we don't pad short captions up to long ones.
+        lengths = [input_dict['num_tokens'] for input_dict in batch]
+        last_hidden_states_batch = []
+        for sub_batch in bucketed_batches(batch, lengths, max_tokens_per_batch=MAX_TOKENS_PER_BATCH):
+          # returns: list of np.arrays, each of different shape [NUM_TOKENS, 1024]
+          last_hidden_states_batch.extend(process.encode_batch(sub_batch))
+        # back to db_index order, so the uploader can write contiguous slices.
+        last_hidden_states_batch = restore_original_order(last_hidden_states_batch)
         caption_embed_dict_list = []
         for embed in last_hidden_states_batch:
+          if EMBEDDING_CODEC_LEVEL is not None:
+            # compress here, in parallel across workers, so the uploader only writes bytes.
+            embed["last_hidden_states"] = encode_embedding(embed["last_hidden_states"], level=EMBEDDING_CODEC_LEVEL)
           caption_embed_dict_list.append({"db_index": embed["db_index"], "last_hidden_states": embed["last_hidden_states"]})
         ## ADD TO DATASET (via upload queue)
-        self.upload_queue.put(caption_embed_dict_list)
+        self.upload_queue.put(put_results_in_object_store(caption_embed_dict_list))
         # print("Added to Queue!")
       except Exception as e:
         print("❌❌Error during text-encode: ", e)
         traceback.print_exc()
         # pprint.pprint(caption_embed_dict_list)
       print(f"⏰ Time to Text-encode file: {(time.monotonic() - start)/60:.2f} minutes."
-            "(time/segment): {((time.monotonic() - start)/BATCH_SIZE):.2f} sec")
+            f"(time/segment): {((time.monotonic() - start)/BATCH_SIZE):.2f} sec")
 
   def get_upload_queue_size(self):
     '''
@@ -137,10 +159,9 @@ class ParallelEncode:
 @dl.compute
 def populate_ds_with_zeros(sample_in, sample_out):
   # assert type(sample_in_caption) == str or type(sample_in_caption) == np.str_, print(f"expecting just the pure caption. got {type(sample_in_caption)}")
-  caption = sample_in.caption.data()["value"]
-  tokenized = GLOBAL_TOKENIZER(caption, return_tensors="pt", truncation=False).input_ids
-  # sample_out.caption_embedding.append(np.negative(np.ones((len(tokenized[0]), 1024)), dtype=np.float16))
-  sample_out.caption_embedding.append(np.zeros((len(tokenized[0]), 1024), dtype=np.float16))
+  # caption_token_len is written by add_caption_token_columns(), no need to tokenize again here.
+  caption_token_len = int(np.asarray(sample_in.caption_token_len.numpy()).reshape(-1)[0])
+  sample_out.caption_embedding.append(np.zeros((caption_token_len, 1024), dtype=np.float16))
   return sample_out
 
 
@@ -187,7 +208,9 @@ def main():
   index_caption_pairs = []  # list of: {'db_index': int, 'caption': str}
   # todo: check for completed segments (that already have a caption_embedding)
   if os.path.exists(RESULTS_DATASET_PATH):
-    pass
+    assert_codec_level_matches(dl.load(RESULTS_DATASET_PATH, read_only=True), 'caption_embedding', EMBEDDING_CODEC_LEVEL)
+    # datasets created before caption token columns existed: add them (skips if done).
+    add_caption_token_columns(dl.load(RESULTS_DATASET_PATH, read_only=False))
     # ds = dl.load(RESULTS_DATASET_PATH)
     # print(ds.summary())
     # index_caption_pairs = filter_completed_text_encodes(ds)
@@ -198,17 +221,23 @@ def main():
     output_ds = dl.deepcopy(INPUT_DATASET_PATH, RESULTS_DATASET_PATH, overwrite=True)
     with output_ds:
       # tf_bfloat16 = _pywrap_bfloat16.TF_bfloat16_type() # couldn't get this working weird imports.
-      output_ds.create_tensor("caption_embedding", htype="generic", dtype=np.float16, sample_compression=None)
-      output_ds.create_tensor("done_text_encode", htype="generic", dtype=bool, sample_compression=None)
-      output_ds.caption_embedding.extend([np.float16(0)] * output_ds.max_len)  # make equal size (fastest way)
-      output_ds.done_text_encode.extend([False] * output_ds.max_len)  # set all to false (fastest way)
+      create_embedding_tensor(output_ds, "caption_embedding", EMBEDDING_CODEC_LEVEL, htype="generic", dtype=np.float16, sample_compression=None)
+      output_ds.create_tensor(COMPLETION_TENSORS['text-encode'], htype="generic", dtype=bool, sample_compression=None)
+      output_ds[COMPLETION_TENSORS['text-encode']].extend([False] * get_num_rows(output_ds))  # completion bitmap, set by the uploader.
+      if not PREFILL_WITH_ZEROS:
+        # `caption_embedding` stays empty, the uploader appends to it. No placeholder data is ever written.
+        create_lazy_result_tensors(output_ds, 'text-encode')
+      else:
+        output_ds.caption_embedding.extend([np.float16(0)] * get_num_rows(output_ds))  # make equal size (fastest way)
       output_ds.flush()
-    with output_ds:
-      print("Prepopulating `caption_embedding` tensor with custom-tokenized np.zeros((custom_token_len, 1024).")
-      print(output_ds.summary())
-      populate_ds_with_zeros().eval(output_ds, scheduler="ray", num_workers=NUM_CPU_CORES, skip_ok=True)
-      print("Output ds after prepopulating")
-      print(output_ds.summary())
+    add_caption_token_columns(output_ds)  # tokenize every caption once: caption_token_ids, caption_token_len.
+    if PREFILL_WITH_ZEROS:
+      with output_ds:
+        print("Prepopulating `caption_embedding` tensor with custom-tokenized np.zeros((custom_token_len, 1024).")
+        print(output_ds.summary())
+        populate_ds_with_zeros().eval(output_ds, scheduler="ray", num_workers=NUM_CPU_CORES, skip_ok=True)
+        print("Output ds after prepopulating")
+        print(output_ds.summary())
 
     del output_ds  # hopefully this closes connection?
     # print(colored(f"TODO: I need to write code to populate index_caption_pairs", "red", attrs=["reverse", "bold"]))
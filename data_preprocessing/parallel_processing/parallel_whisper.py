@@ -15,10 +15,12 @@ import numpy as np
 import psutil
 import ray
 import tqdm
-from deeplake_driver import DeeplakeManager
+from deeplake_driver import DeeplakeManager, create_segment_metadata_columns
 from PIL import Image
 from ray.util.queue import Queue
 from termcolor import colored
+from video_manifest import VideoManifest
+from video_metadata_index import VideoMetadataIndex
 
 sys.path.append("../whisper_audio")
 from CaptionPreprocessing import CaptionPreprocessing
@@ -38,12 +40,16 @@ BATCH_NAME = 'yt1b-val'
 INPUT_VIDEOS_PATH = f'/mnt/teton/vpt/data/yt-1b/yt1b-val'
 WHISPER_RESULTS_DATASET_PATH = f'/mnt/teton/vpt/data/yt-1b_deeplake/feb_25_whisper_results_{BATCH_NAME}'
 LOCAL_VIDEO_DIR = f'/tmp/{BATCH_NAME}'  # used for wavs
+VIDEO_METADATA_INDEX_PATH = '/mnt/teton/vpt/data/yt-1b_deeplake/video_metadata_index.sqlite'  # shared by CLIP + Whisper
 
 # BATCH_NAME = 'bbt_audios'
 # INPUT_VIDEOS_PATH = f'/mnt/teton/vpt/data/benchmark_datasets/TVQA/uncompressed_audio/bbt_new/{BATCH_NAME}'
 # WHISPER_RESULTS_DATASET_PATH = f'/mnt/teton/vpt/data/benchmark_datasets/TVQA/_deeplake/whisper_results_{BATCH_NAME}'
 # LOCAL_VIDEO_DIR = f'/tmp/{BATCH_NAME}'  # used for wavs
 
+VIDEO_MANIFEST_PATH = WHISPER_RESULTS_DATASET_PATH + '_video_manifest.sqlite'  # per-video done/empty/error, for resume.
+RETRY_FAILED_VIDEOS = True  # on resume, re-run videos whose status is 'error'. ('done' and 'empty' are always skipped)
+
 NUM_GPUS = 2
 NUM_PARALLEL_INSTANCES = 2  # 2 for 1080ti, 6 for 4090.
 NUM_CPU_CORES = psutil.cpu_count()
@@ -58,7 +64,8 @@ class ParallelWhisper:
     self.upload_queue = Queue()
     self.db_manager = DeeplakeManager.remote(preprocessor_type='whisper',
                                              database_path=WHISPER_RESULTS_DATASET_PATH,
-                                             upload_queue=self.upload_queue)
+                                             upload_queue=self.upload_queue,
+                                             video_manifest_path=VIDEO_MANIFEST_PATH)
 
   @ray.method(concurrency_group="parallel_whisper_instances"
              )  # .70 and 1/30 equals 65% DRAM usage right immediately. Can't really go any higher.
@@ -80,7 +87,8 @@ class ParallelWhisper:
         # If there are no captions/if it is non-english
         if not whisper_one_video_results:
           print("File is empty!")
-          write_error(file)
+          # status only, goes through the uploader so the manifest has a single writer.
+          self.upload_queue.put({'video_filepath': str(file), 'status': 'empty'})
         else:
           ## ADD TO DATASET (via upload queue)
           print("🔥 About to add work to queue")
@@ -88,30 +96,16 @@ class ParallelWhisper:
           print("Added to Queue!")
       except Exception as e:
         print(file)
-        # write failed files to jsonlines
+        # record failed files in the video manifest
         print(f"❌❌ Error during whisper: {e}")
         traceback.print_exc()
-        failed_file_json_object = json.dumps(str(file))
-        error_filepath = LOCAL_VIDEO_DIR + "_whisper_errors.jsonl"
-        if not os.path.exists(error_filepath):
-          pathlib.Path(error_filepath).touch()
-        with jsonlines.open(error_filepath, mode='a') as writer:
-          writer.write({"video_filepath": failed_file_json_object, "error": str(e)})
+        self.upload_queue.put({'video_filepath': str(file), 'status': 'error', 'error': str(e)})
 
       # one file done
       print(
           f"⏰ Time to Whisper the file: {(time.monotonic() - start)/60:.2f} minutes\nVideo filesize: {os.path.getsize(file)/1e6:.2f} MB\n")
 
 
-def write_error(file):
-  failed_file_json_object = json.dumps(str(file))
-  empty_filepath = LOCAL_VIDEO_DIR + "_whisper_empty.jsonl"
-  if not os.path.exists(empty_filepath):
-    pathlib.Path(empty_filepath).touch()
-  with jsonlines.open(empty_filepath, mode='a') as writer:
-    writer.write({"video_filepath": failed_file_json_object})
-
-
 def find_files(directory: os.PathLike):
   filepaths = []
   for root, dirs, files in os.walk(directory):
@@ -165,28 +159,23 @@ def main():
   files = [str(file) for file in files if not str(file).endswith(('.txt', '.vtt', 'json'))]
   print("After filtering -- Number of files:", len(files))
   if os.path.exists(WHISPER_RESULTS_DATASET_PATH):
-    # Filter files that we need to process
+    # Filter files that we need to process: set difference against the per-video manifest, no dataset scan.
     print(f'Number of files before filtering completed files {len(files)}')
-    ds_completed = dl.load(WHISPER_RESULTS_DATASET_PATH, read_only=True)
-    ds_completed.summary()
-    try:
-      completed_videos = set()
-      for index, data_row in enumerate(ds_completed):
-        try:
-          completed_videos.add(data_row.video_filepath.data()['value'])
-        except Exception as e:
-          print(colored(f"⚠️ CORRUPTED INDEX IN Deeplake Database.", "yellow", attrs=["reverse", "bold"]))
-          print("Datalake unable to load index", index, "error is", e)
-      print("⭐️😁 num videos already processed:", len(list(completed_videos)))
-      files = set(files) - completed_videos
-      files = list(files)
-      print(f'Number of files after filtering completed files {len(files)}')
-    except Exception as e:
-      print("Error", e)
-      print("There is an empty database already created")
+    video_manifest = VideoManifest(VIDEO_MANIFEST_PATH)
+    if video_manifest.is_empty():
+      # run from before the manifest existed. One-time migration from the dataset + old jsonl files.
+      video_manifest.bootstrap(ds=dl.load(WHISPER_RESULTS_DATASET_PATH, read_only=True),
+                               empty_jsonl_path=LOCAL_VIDEO_DIR + "_whisper_empty.jsonl",
+                               errors_jsonl_path=LOCAL_VIDEO_DIR + "_whisper_errors.jsonl")
+    finished_videos = video_manifest.finished_videos(retry_errors=RETRY_FAILED_VIDEOS)
+    print("⭐️😁 num videos already processed:", len(finished_videos))
+    files = list(set(files) - finished_videos)
+    print(f'Number of files after filtering completed files {len(files)}')
   else:
     # Create completed files database
     ds = dl.empty(WHISPER_RESULTS_DATASET_PATH, overwrite=True)
+    if os.path.exists(VIDEO_MANIFEST_PATH):
+      os.remove(VIDEO_MANIFEST_PATH)  # left over from a previous dataset at this path, would skip videos.
     # todo: change to chunk_compression -- NOOO Chunk has BUGS as confirmed by devs. Use common compression types only.
     # don't use ANY compression on json fields. Always buggy.
     with ds:
@@ -194,12 +183,19 @@ def main():
       ds.create_tensor('segment_metadata', htype='text', dtype=str, sample_compression=None)
       ds.create_tensor('video_filename', htype='text', dtype=str, sample_compression=None)
       ds.create_tensor('video_filepath', htype='text', dtype=str, sample_compression=None)
+      create_segment_metadata_columns(ds)  # typed start/end/indexes/video_id, for vectorized batch planning downstream.
+
+  # plan work before opening any video: longest first, dealt round-robin, so every whisper instance gets equal minutes of audio.
+  video_metadata_index = VideoMetadataIndex(VIDEO_METADATA_INDEX_PATH)
+  video_metadata_index.build(files)
+  video_metadata = video_metadata_index.get_many(files)
+  files = sorted(files, key=lambda file: (video_metadata[file]['duration'] or 0) if file in video_metadata else 0, reverse=True)
 
   # split files into batches
   if NUM_PARALLEL_INSTANCES == 1:
     batches = [files]
   else:
-    batches = list(more_itertools.divide(NUM_PARALLEL_INSTANCES, files))
+    batches = [list(batch) for batch in more_itertools.distribute(NUM_PARALLEL_INSTANCES, files)]
   # print batch stats
   print("Num batches: ", len(batches))
   assert len(batches) == (NUM_PARALLEL_INSTANCES), "there is supposed to be one Ray thread per batch"
@@ -44,27 +44,36 @@ class FlanT5Encoder:
     #                                                 1: "0GiB",
     #                                             })
 
-  def encode(self, input_dict):  #batch):
+  def encode(self, input_dict):
     """
-    OLD param batch: list of {'db_index': int, 'caption': str}
     param input_dict: dict of {'db_index': int, 'caption': str}. batch_size is 1
     return: list of np.arrays, each of different shape [NUM_TOKENS, 1024]
 
-    Important to pad to "max_length" so we can stack the inputs.
+    Prefer encode_batch(), this is kept for single-caption callers.
+    """
+    return self.encode_batch([input_dict])
+
+  def encode_batch(self, batch):
+    """
+    param batch: list of {'db_index': int, 'caption': str}
+    return: list of {'last_hidden_states': np.array, 'db_index': int}. Each array has different shape [NUM_TOKENS, 1024], float16.
+
+    Tokenize the whole batch with padding (to the longest caption), run ONE forward pass, then strip the padding
+    per row using the attention mask. T5 pads on the right, so the real tokens are always the first NUM_TOKENS rows.
     keeping truncation=False for now because we really don't expect to go over length (with 15-word sequences), and I want to see errors if we do.
     """
-    last_hidden_states_batch = []
-    # for input_dict in batch:
+    captions = [input_dict["caption"] for input_dict in batch]
     with torch.inference_mode():
-      # print("ABOUT TO ENCODE CAPTION: ", input_dict["caption"])
-      tokens = self.tokenizer(input_dict["caption"], return_tensors="pt", padding=False, truncation=False).to(self.device)
-      # print("TOKENS: ", tokens)
+      tokens = self.tokenizer(captions, return_tensors="pt", padding='longest', truncation=False).to(self.device)
       lhs = self.model(**tokens).last_hidden_state
 
       # CAST FROM 32 to 16 bit via .half() !!
-      lhs = lhs.half().detach().cpu().numpy().reshape(-1, 1024)
-      # print("LAST HIDDEN STATE: ", lhs)
-      last_hidden_states_batch.append({'last_hidden_states': lhs, 'db_index': input_dict['db_index']})
+      lhs = lhs.half().cpu().numpy()  # (batch_size, max_num_tokens, 1024)
+      num_tokens_per_row = tokens.attention_mask.sum(dim=1).cpu().tolist()
+
+    last_hidden_states_batch = []
+    for input_dict, row, num_tokens in zip(batch, lhs, num_tokens_per_row):
+      last_hidden_states_batch.append({'last_hidden_states': row[:num_tokens].copy(), 'db_index': input_dict['db_index']})
     # return: list of np.arrays, each of different shape [NUM_TOKENS, 1024]
     return last_hidden_states_batch
 
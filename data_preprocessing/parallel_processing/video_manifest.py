@@ -0,0 +1,126 @@
+'''
+Per-video completion manifest for the Whisper stage.
+
+Resuming used to rebuild the set of finished videos by reading `video_filepath` from EVERY row of the results dataset,
+and empty (non-English) and failed videos were only in `_whisper_empty.jsonl` / `_whisper_errors.jsonl`.
+This is one SQLite table with one row per video, written by the whisper DeeplakeManager after each upload commits:
+  status 'done':  segments were appended, `first_row`:`last_row` (exclusive) is where they live in the dataset.
+  status 'empty': whisper found no usable (English) captions.
+  status 'error': whisper or the upload failed, `error` holds the message.
+
+Usage:
+  manifest = VideoManifest(WHISPER_RESULTS_DATASET_PATH + '_video_manifest.sqlite')
+  todo = set(all_video_filepaths) - manifest.finished_videos()
+'''
+import json
+import sqlite3
+import threading
+import time
+
+import jsonlines
+import more_itertools
+from termcolor import colored
+
+STATUSES = ('done', 'empty', 'error')
+
+
+class VideoManifest():
+
+  def __init__(self, db_path):
+    self.db_path = str(db_path)
+    self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.lock, self.conn:
+      self.conn.execute('''CREATE TABLE IF NOT EXISTS video_manifest (
+                              video_filepath TEXT PRIMARY KEY,
+                              status TEXT,
+                              num_segments INTEGER,
+                              first_row INTEGER,
+                              last_row INTEGER,
+                              error TEXT,
+                              updated_at REAL)''')
+
+  def put(self, video_filepath, status, num_segments=0, first_row=None, last_row=None, error=None):
+    self.put_many([{
+        'video_filepath': video_filepath,
+        'status': status,
+        'num_segments': num_segments,
+        'first_row': first_row,
+        'last_row': last_row,
+        'error': error,
+    }])
+
+  def put_many(self, entries):
+    for entry in entries:
+      assert entry['status'] in STATUSES, print(f"Unknown manifest status {entry['status']}, expected one of {STATUSES}")
+    now = time.time()
+    with self.lock, self.conn:
+      self.conn.executemany(
+          'INSERT OR REPLACE INTO video_manifest VALUES (?, ?, ?, ?, ?, ?, ?)',
+          [(str(e['video_filepath']), e['status'], e.get('num_segments', 0), e.get('first_row'), e.get('last_row'),
+            e.get('error'), now) for e in entries])
+
+  def get(self, video_filepath):
+    ''' returns: manifest entry dict, or None if the video was never recorded. '''
+    with self.lock:
+      row = self.conn.execute('SELECT * FROM video_manifest WHERE video_filepath = ?', (str(video_filepath),)).fetchone()
+    return self._row_to_dict(row) if row is not None else None
+
+  def videos_with_status(self, *statuses):
+    ''' returns: set of video_filepaths whose latest status is in `statuses`. '''
+    with self.lock:
+      rows = self.conn.execute(f"SELECT video_filepath FROM video_manifest WHERE status IN ({','.join('?' * len(statuses))})",
+                               statuses).fetchall()
+    return {row[0] for row in rows}
+
+  def finished_videos(self, retry_errors=True):
+    '''
+    The videos to skip on resume. 'done' and 'empty' are final. 'error' videos are retried unless retry_errors=False.
+    '''
+    if retry_errors:
+      return self.videos_with_status('done', 'empty')
+    return self.videos_with_status(*STATUSES)
+
+  def is_empty(self):
+    with self.lock:
+      return self.conn.execute('SELECT COUNT(*) FROM video_manifest').fetchone()[0] == 0
+
+  def bootstrap(self, ds=None, empty_jsonl_path=None, errors_jsonl_path=None):
+    '''
+    One-time migration for runs from before the manifest existed: ONE vectorized read of `video_filepath` from the
+    results dataset (rows of a video are contiguous, whisper appends a whole video at once), plus the old jsonl files.
+    '''
+    start_time = time.monotonic()
+    entries = {}
+    for jsonl_path, status in [(errors_jsonl_path, 'error'), (empty_jsonl_path, 'empty')]:
+      for line in _read_jsonl(jsonl_path):
+        video_filepath = json.loads(line['video_filepath'])  # was written with json.dumps(str(file))
+        entries[video_filepath] = {'video_filepath': video_filepath, 'status': status, 'error': line.get('error')}
+    if ds is not None and len(ds.video_filepath) > 0:
+      all_video_filepaths = ds.video_filepath.data()['value']
+      row = 0
+      for video_filepath, group in more_itertools.run_length.encode(all_video_filepaths):
+        entries[video_filepath] = {
+            'video_filepath': video_filepath,
+            'status': 'done',
+            'num_segments': group,
+            'first_row': row,
+            'last_row': row + group,
+        }
+        row += group
+    self.put_many(list(entries.values()))
+    print(colored(f"👉 Bootstrapped video manifest with {len(entries)} videos in {(time.monotonic() - start_time):.2f} seconds", "cyan", attrs=["reverse", "bold"]))
+
+  def _row_to_dict(self, row):
+    keys = ['video_filepath', 'status', 'num_segments', 'first_row', 'last_row', 'error', 'updated_at']
+    return dict(zip(keys, row))
+
+
+def _read_jsonl(jsonl_path):
+  if jsonl_path is None:
+    return []
+  try:
+    with jsonlines.open(jsonl_path) as reader:
+      return list(reader)
+  except FileNotFoundError:
+    return []
@@ -0,0 +1,166 @@
+'''
+Persistent per-video decode metadata (fps, frame count, duration, resolution, keyframes).
+
+Every pipeline used to open the video just to ask for its fps (decord in CLIP, cv2 in DataPreprocessor). On millions
+of YT-1B files that container probing adds up, and schedulers can't plan work without opening every video.
+This is a small SQLite table keyed by (video_filepath, mtime), built ONCE in parallel with Ray, then reused.
+If a file changes on disk (new mtime) it's treated as missing and re-probed.
+
+Usage:
+  index = VideoMetadataIndex('/mnt/teton/vpt/data/yt-1b_deeplake/video_metadata_index.sqlite')
+  index.build(all_video_filepaths)  # only probes videos that aren't indexed yet (needs ray.init() first)
+  metadata = index.get(video_filepath)  # {'fps': 29.97, 'frame_count': 1234, 'keyframes': [0, 250, ...], ...} or None
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import more_itertools
+import ray
+from termcolor import colored
+
+# pyright: reportPrivateImportUsage=false
+# pyright: reportOptionalMemberAccess=false
+# ^^ due to not understanding ray
+
+PROBE_BATCH_SIZE = 64  # videos per Ray task.
+
+
+class VideoMetadataIndex():
+
+  def __init__(self, db_path):
+    self.db_path = str(db_path)
+    # check_same_thread=False + lock, because ClipEncoder reads from its decode threads.
+    self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.lock, self.conn:
+      self.conn.execute('''CREATE TABLE IF NOT EXISTS video_metadata (
+                              video_filepath TEXT PRIMARY KEY,
+                              mtime REAL,
+                              fps REAL,
+                              frame_count INTEGER,
+                              duration REAL,
+                              width INTEGER,
+                              height INTEGER,
+                              keyframes TEXT,
+                              error TEXT)''')
+
+  def get(self, video_filepath):
+    '''
+    returns: metadata dict, or None if not indexed, stale (file changed), or the probe failed.
+    '''
+    return self.get_many([video_filepath]).get(str(video_filepath))
+
+  def get_many(self, video_filepaths):
+    '''
+    returns: dict of {video_filepath: metadata dict}. Only includes fresh, successfully probed videos.
+    '''
+    results = {}
+    video_filepaths = [str(filepath) for filepath in video_filepaths]
+    with self.lock:
+      for chunk in more_itertools.chunked(video_filepaths, 900):  # sqlite max variables is 999 on old versions
+        rows = self.conn.execute(
+            f"SELECT * FROM video_metadata WHERE video_filepath IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        for row in rows:
+          metadata = self._row_to_dict(row)
+          if metadata['error'] is None and _is_fresh(metadata):
+            results[metadata['video_filepath']] = metadata
+    return results
+
+  def missing(self, video_filepaths):
+    '''
+    returns: list of filepaths that need probing (not indexed yet, or the file changed since it was indexed).
+    Videos whose probe previously FAILED are not retried unless they change on disk.
+    '''
+    video_filepaths = [str(filepath) for filepath in video_filepaths]
+    indexed = {}
+    with self.lock:
+      for chunk in more_itertools.chunked(video_filepaths, 900):
+        rows = self.conn.execute(
+            f"SELECT video_filepath, mtime FROM video_metadata WHERE video_filepath IN ({','.join('?' * len(chunk))})",
+            chunk).fetchall()
+        indexed.update(dict(rows))
+    return [
+        filepath for filepath in video_filepaths
+        if filepath not in indexed or not _is_fresh({'video_filepath': filepath, 'mtime': indexed[filepath]})
+    ]
+
+  def put_many(self, metadata_list):
+    with self.lock, self.conn:
+      self.conn.executemany(
+          'INSERT OR REPLACE INTO video_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          [(m['video_filepath'], m['mtime'], m['fps'], m['frame_count'], m['duration'], m['width'], m['height'],
+            json.dumps(m['keyframes']) if m['keyframes'] is not None else None, m['error']) for m in metadata_list])
+
+  def build(self, video_filepaths, batch_size=PROBE_BATCH_SIZE):
+    '''
+    Probe every video that isn't indexed yet, in parallel Ray tasks (1 CPU each). Safe to call every run, it only
+    does new work. Requires ray.init() to have been called.
+    '''
+    todo = self.missing(video_filepaths)
+    print(colored(f"👉 Video metadata index: {len(video_filepaths) - len(todo)} cached, {len(todo)} to probe", "cyan", attrs=["reverse", "bold"]))
+    if len(todo) == 0:
+      return
+    start_time = time.monotonic()
+    futures = [probe_videos.remote(batch) for batch in more_itertools.chunked(todo, batch_size)]
+    total_errors = 0
+    while futures:
+      done, futures = ray.wait(futures, num_returns=1)
+      metadata_list = ray.get(done[0])
+      total_errors += sum(1 for m in metadata_list if m['error'] is not None)
+      self.put_many(metadata_list)
+    print(f"⏰ Time to probe {len(todo)} videos: {(time.monotonic() - start_time)/60:.2f} minutes. Unreadable videos: {total_errors}")
+
+  def _row_to_dict(self, row):
+    keys = ['video_filepath', 'mtime', 'fps', 'frame_count', 'duration', 'width', 'height', 'keyframes', 'error']
+    metadata = dict(zip(keys, row))
+    if metadata['keyframes'] is not None:
+      metadata['keyframes'] = json.loads(metadata['keyframes'])
+    return metadata
+
+
+def _is_fresh(metadata):
+  try:
+    return os.path.getmtime(metadata['video_filepath']) == metadata['mtime']
+  except OSError:
+    return False  # file is gone
+
+
+def probe_video(video_filepath):
+  '''
+  Open the video once with decord and collect everything the pipelines need.
+  returns: metadata dict. On failure, all fields are None and 'error' holds the message.
+  '''
+  from decord import VideoReader, cpu
+
+  video_filepath = str(video_filepath)
+  metadata = {
+      'video_filepath': video_filepath,
+      'mtime': None,
+      'fps': None,
+      'frame_count': None,
+      'duration': None,
+      'width': None,
+      'height': None,
+      'keyframes': None,
+      'error': None,
+  }
+  try:
+    metadata['mtime'] = os.path.getmtime(video_filepath)
+    vr = VideoReader(video_filepath, ctx=cpu(0), num_threads=1)
+    metadata['fps'] = float(vr.get_avg_fps())
+    metadata['frame_count'] = len(vr)
+    metadata['duration'] = metadata['frame_count'] / metadata['fps'] if metadata['fps'] else None
+    height, width, _ = vr[0].shape
+    metadata['width'], metadata['height'] = int(width), int(height)
+    metadata['keyframes'] = [int(idx) for idx in vr.get_key_indices()]
+  except Exception as e:
+    metadata['error'] = str(e)
+  return metadata
+
+
+@ray.remote(num_cpus=1)
+def probe_videos(video_filepaths):
+  return [probe_video(video_filepath) for video_filepath in video_filepaths]
@@ -0,0 +1,105 @@
+'''
+Visual token reduction for `clip_last_hidden_states` (CLIP ViT-L/14-336: 1 CLS token + a 24 x 24 grid of patch tokens = 577).
+
+The T5 encoder attends over every visual token, and attention cost grows quadratically with their count. Modes (the
+CLS token is always kept, first):
+  None / 'none': all 577 tokens.
+  'avgpool2':    2x2 average pooling over the patch grid -> 1 + 144 tokens.
+  'avgpool3':    3x3 average pooling -> 1 + 64 tokens.
+  'topk<k>':     e.g. 'topk144'. The k patch tokens with the largest L2 norm, kept in raster order -> 1 + k tokens.
+
+Apply it at CLIP-encode time (ClipEncoder(visual_token_reduction=...), also shrinks the dataset), or in the training
+collate (VPTBatchCollator(visual_token_reduction=...), to try several modes on one full dataset). Never both: the
+collate only reduces full 577-token hidden states. modeling_vpt_in_mosaicml.py imports reduce_visual_tokens() from here.
+
+Benchmark T5 encoder throughput per mode, on synthetic inputs (random weights, t5-v1_1-large shape):
+  python visual_token_reduction.py
+'''
+import math
+import time
+
+import torch
+
+VISUAL_TOKEN_REDUCTIONS = ['none', 'avgpool2', 'avgpool3', 'topk144', 'topk64']  # presets, any 'topk<k>' works.
+BENCHMARK_BATCH_SIZE = 8
+BENCHMARK_CAPTION_LENGTH = 32  # caption-half tokens appended after the visual tokens, like VPTBatchCollator.
+BENCHMARK_NUM_STEPS = 5
+
+
+def reduce_visual_tokens(hidden_states, mode):
+  '''
+  param hidden_states: torch.Tensor (batch_size, 1 + num_patches, hidden_size). Token 0 is CLS, patches in raster order.
+  param mode: None or one of the modes above.
+  returns: torch.Tensor (batch_size, 1 + num_reduced_patches, hidden_size), same dtype + device.
+  '''
+  if mode is None or mode == 'none':
+    return hidden_states
+  cls_token, patches = hidden_states[:, :1], hidden_states[:, 1:]
+  batch_size, num_patches, hidden_size = patches.shape
+  if mode.startswith('avgpool'):
+    kernel_size = int(mode[len('avgpool'):])
+    grid_size = math.isqrt(num_patches)
+    assert grid_size * grid_size == num_patches, print(f"{mode} needs a square patch grid, got {num_patches} patches (already reduced?)")
+    grid = patches.reshape(batch_size, grid_size, grid_size, hidden_size).permute(0, 3, 1, 2)
+    pooled = torch.nn.functional.avg_pool2d(grid.float(), kernel_size=kernel_size, stride=kernel_size, ceil_mode=True)
+    patches = pooled.flatten(2).transpose(1, 2).to(hidden_states.dtype)
+  elif mode.startswith('topk'):
+    k = min(int(mode[len('topk'):]), num_patches)
+    keep = patches.float().norm(dim=-1).topk(k, dim=1).indices.sort(dim=1).values  # sorted: keep raster order
+    patches = patches.gather(1, keep.unsqueeze(-1).expand(-1, -1, hidden_size))
+  else:
+    raise ValueError(f"Unknown visual token reduction {mode}, expected None, 'none', 'avgpool<k>' or 'topk<k>'")
+  return torch.cat([cls_token, patches], dim=1)
+
+
+def num_visual_tokens(mode, num_tokens=577):
+  ''' Number of tokens (incl. CLS) reduce_visual_tokens() returns for `num_tokens` input tokens. '''
+  return reduce_visual_tokens(torch.zeros(1, num_tokens, 1), mode).shape[1]
+
+
+def benchmark_encoder_throughput(modes=VISUAL_TOKEN_REDUCTIONS, batch_size=BENCHMARK_BATCH_SIZE, num_layers=24, device=None):
+  '''
+  Time one training step (forward + backward) of a randomly initialized T5 encoder (t5-v1_1-large shape) on
+  [pooled, reduced visual tokens, caption half] inputs.
+  returns: {mode: {num_tokens, seconds_per_step, speedup, hidden_state_MB_per_sample}}
+  '''
+  from transformers import T5Config, T5EncoderModel
+
+  device = device or ("cuda:0" if torch.cuda.is_available() else "cpu")
+  config = T5Config(d_model=1024, d_kv=64, d_ff=2816, num_layers=num_layers, num_heads=16, feed_forward_proj='gated-gelu')
+  encoder = T5EncoderModel(config).to(device)
+  hidden_states = torch.randn(batch_size, 577, 1024, device=device)
+  pooled = torch.randn(batch_size, 1, 1024, device=device)
+  caption = torch.randn(batch_size, BENCHMARK_CAPTION_LENGTH, 1024, device=device)
+
+  report = {}
+  for mode in modes:
+    inputs_embeds = torch.cat([pooled, reduce_visual_tokens(hidden_states, mode), caption], dim=1)
+    encoder(inputs_embeds=inputs_embeds).last_hidden_state.mean().backward()  # warmup
+    if device.startswith('cuda'):
+      torch.cuda.synchronize()
+    start_time = time.monotonic()
+    for _ in range(BENCHMARK_NUM_STEPS):
+      encoder.zero_grad(set_to_none=True)
+      encoder(inputs_embeds=inputs_embeds).last_hidden_state.mean().backward()
+    if device.startswith('cuda'):
+      torch.cuda.synchronize()
+    num_tokens = num_visual_tokens(mode)
+    report[mode] = {
+        'num_tokens': inputs_embeds.shape[1],
+        'seconds_per_step': (time.monotonic() - start_time) / BENCHMARK_NUM_STEPS,
+        'hidden_state_MB_per_sample': num_tokens * 1024 * 4 / 1e6,
+    }
+  baseline = report[modes[0]]['seconds_per_step']
+  for stats in report.values():
+    stats['speedup'] = baseline / stats['seconds_per_step']
+  return report
+
+
+if __name__ == '__main__':
+  device = "cuda:0" if torch.cuda.is_available() else "cpu"
+  num_layers = 24 if device.startswith('cuda') else 2  # full depth is very slow on CPU, the ratios hold.
+  print(f"👉 T5 encoder ({num_layers} layers) fwd+bwd on {device}, batch size {BENCHMARK_BATCH_SIZE}:")
+  for mode, stats in benchmark_encoder_throughput(num_layers=num_layers, device=device).items():
+    print(f"  {mode:>9}: {stats['num_tokens']:>4} tokens, {stats['seconds_per_step']*1000:.0f} ms/step, "
+          f"{stats['speedup']:.2f}x, {stats['hidden_state_MB_per_sample']:.2f} MB fp32 hidden states/sample")
@@ -0,0 +1,194 @@
+'''
+Chunk-aware shuffling for Deeplake training data.
+
+Random row access across Deeplake chunks is too slow (every row decompresses a whole chunk), so the dataloaders used
+shuffle=False and consecutive batches came from the same video and the same parallel_N shard. ChunkShuffledDataset:
+  1. splits the rows at chunk boundaries and randomly permutes the chunk order (new order every epoch),
+  2. reads each chunk with ONE slice read per tensor (sequential within the chunk),
+  3. mixes rows of many chunks through an in-memory shuffle buffer, yielding random rows from it.
+DataLoader workers each take a disjoint, equal share of the permuted rows (a whole number of batches, so there are no
+partial batches and len(DataLoader) is exact), and an equal share of the `buffer_size` rows: memory is set by
+buffer_size, not by the number of workers. Rows are the same dicts as ds.pytorch() gives, so batch them with VPTBatchCollator.
+
+Usage (batch_size and num_workers must match the DataLoader's):
+  dataset = ChunkShuffledDataset(dataset_path, tensors=columns_for_training, buffer_size=512, batch_size=8, num_workers=8)
+  train_dataloader = torch.utils.data.DataLoader(dataset, batch_size=8, collate_fn=VPTBatchCollator(), num_workers=8)
+
+Benchmark rows/sec (and batch mixing) of sequential vs chunk-shuffled vs fully random access:
+  python chunk_shuffle.py /mnt/teton/vpt/data/yt-1b_deeplake/feb_25_CLIP_encode_results_yt1b-val
+'''
+import random
+import sys
+import time
+
+import deeplake as dl
+import numpy as np
+import torch
+
+DEFAULT_BUFFER_SIZE = 1024  # rows held in memory IN TOTAL (split across workers), ~2.4 GB of fp32 clip_last_hidden_states. Hidden-state chunks hold only a few rows, so even 128 rows per worker span dozens of chunks.
+BENCHMARK_TENSORS = ['clip_pooled_embedding', 'caption_embedding', 'clip_last_hidden_states', 'caption']
+BENCHMARK_BATCH_SIZE = 32
+
+
+class ChunkShuffledDataset(torch.utils.data.IterableDataset):
+
+  def __init__(self, dataset_path, tensors, buffer_size=DEFAULT_BUFFER_SIZE, seed=None, return_index=False, batch_size=1, num_workers=1):
+    '''
+    param tensors: tensor names to read (same as ds.pytorch(tensors=...)).
+    param buffer_size: shuffle buffer, in rows, TOTAL over all DataLoader workers (each holds buffer_size // num_workers).
+                       0: no shuffling at all (chunks in order, rows in order).
+    param seed: fixed seed (same order every epoch). None: a new order every epoch, from the DataLoader's base seed.
+    param return_index: add 'row_index' to every row (for debugging / measuring mixing).
+    param batch_size, num_workers: the DataLoader's. Every worker yields the same whole number of batches, the last
+                                   < batch_size * num_workers rows of each epoch's order are dropped (like drop_last).
+    '''
+    super().__init__()
+    self.dataset_path = dataset_path
+    self.tensors = list(tensors)
+    self.buffer_size = buffer_size
+    self.seed = seed
+    self.return_index = return_index
+    self.num_workers = max(num_workers, 1)
+    ds = dl.load(dataset_path, read_only=True)
+    assert 'clip_source_index' not in ds.tensors and 'caption_embedding_source_index' not in ds.tensors, print(
+        "Lazily allocated results are in arrival order, not row order. Compact the dataset first (compress_and_delete_dataset).")
+    self.num_rows = ds.max_len
+    self.rows_per_worker = self.num_rows // (self.num_workers * batch_size) * batch_size
+    self.chunk_ranges = get_common_chunk_row_ranges(ds, self.tensors)
+
+  def __len__(self):
+    ''' Rows yielded per epoch, over all workers. Whole batches only, so composer's step count is exact. '''
+    return self.rows_per_worker * self.num_workers
+
+  def __iter__(self):
+    worker_info = torch.utils.data.get_worker_info()
+    num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info else (1, 0)
+    assert num_workers == self.num_workers, print(f"ChunkShuffledDataset was made for {self.num_workers} workers, the DataLoader has {num_workers}.")
+    # all workers must agree on the chunk permutation, so use the DataLoader's per-epoch base seed (not the worker seed).
+    if self.seed is not None:
+      seed = self.seed
+    elif worker_info:
+      seed = worker_info.seed - worker_info.id
+    else:
+      seed = int(torch.empty((), dtype=torch.int64).random_().item())
+    rng = random.Random(seed)
+    chunk_ranges = list(self.chunk_ranges)
+    if self.buffer_size:
+      rng.shuffle(chunk_ranges)
+    rng = random.Random(seed + worker_id + 1)  # each worker draws from its buffer independently.
+    buffer_size = max(self.buffer_size // num_workers, 1) if self.buffer_size else 0
+
+    ds = dl.load(self.dataset_path, read_only=True)
+    buffer = []
+    for first_idx, last_idx in self._worker_row_ranges(chunk_ranges, worker_id):
+      for row in self._read_rows(ds, first_idx, last_idx):
+        if not buffer_size:
+          yield row
+          continue
+        if len(buffer) < buffer_size:
+          buffer.append(row)
+          continue
+        # swap a random buffered row out for the new one. O(1), keeps the buffer full.
+        position = rng.randrange(buffer_size)
+        yield buffer[position]
+        buffer[position] = row
+    rng.shuffle(buffer)
+    yield from buffer
+
+  def _worker_row_ranges(self, chunk_ranges, worker_id):
+    '''
+    This worker's share: positions [worker_id * rows_per_worker, (worker_id + 1) * rows_per_worker) of the rows in
+    `chunk_ranges` order, as row ranges. Only the first and last range can be a partial chunk.
+    '''
+    first_position = worker_id * self.rows_per_worker
+    last_position = first_position + self.rows_per_worker
+    position = 0
+    for first_idx, last_idx in chunk_ranges:
+      next_position = position + last_idx - first_idx
+      if next_position > first_position:
+        yield first_idx + max(first_position - position, 0), last_idx - max(next_position - last_position, 0)
+      if next_position >= last_position:
+        return
+      position = next_position
+
+  def _read_rows(self, ds, first_idx, last_idx):
+    ''' One slice read per tensor for rows [first_idx, last_idx), split into per-row dicts. '''
+    columns = {}
+    for tensor_name in self.tensors:
+      if ds[tensor_name].htype == 'text':
+        values = ds[tensor_name][first_idx:last_idx].data()['value']
+        columns[tensor_name] = [values] if isinstance(values, str) else list(values)
+      else:
+        columns[tensor_name] = ds[tensor_name][first_idx:last_idx].numpy(aslist=True)
+    for offset in range(last_idx - first_idx):
+      row = {tensor_name: values[offset] for tensor_name, values in columns.items()}
+      if self.return_index:
+        row['row_index'] = first_idx + offset
+      yield row
+
+
+def get_common_chunk_row_ranges(ds, tensor_names):
+  '''
+  Row ranges [first_idx, last_idx) that never cross a chunk boundary of ANY of `tensor_names` (split at the union of
+  their boundaries), one range per piece, no grouping. Unlike deeplake_driver.get_chunk_row_ranges(), which groups
+  pieces up to max_rows for compaction work items.
+  '''
+  boundaries = {0, ds.max_len}
+  for tensor_name in tensor_names:
+    # chunk_id_encoder rows are [chunk_id, last_index_in_chunk]
+    last_indexes = ds[tensor_name].chunk_engine.chunk_id_encoder.array[:, 1]
+    boundaries.update(int(last_index) + 1 for last_index in last_indexes if int(last_index) + 1 < ds.max_len)
+  boundaries = sorted(boundaries)
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def benchmark_access_patterns(dataset_path, tensors=BENCHMARK_TENSORS, num_rows=2048, buffer_size=DEFAULT_BUFFER_SIZE):
+  '''
+  rows/sec for the first `num_rows` rows read (single process, no collate) in three access patterns, plus how well
+  batches are mixed: mean number of distinct chunks per batch of BENCHMARK_BATCH_SIZE rows.
+  returns: {pattern: {'rows_per_sec', 'chunks_per_batch'}}
+  '''
+  ds = dl.load(dataset_path, read_only=True)
+  tensors = [tensor_name for tensor_name in tensors if tensor_name in ds.tensors]
+  num_rows = min(num_rows, ds.max_len)
+  report = {}
+  for pattern, shuffle_buffer_size in [('sequential', 0), ('chunk_shuffled', buffer_size)]:
+    dataset = ChunkShuffledDataset(dataset_path, tensors, buffer_size=shuffle_buffer_size, seed=0, return_index=True)
+    chunk_of_row = _chunk_of_row(dataset.chunk_ranges)
+    start_time = time.monotonic()
+    row_indexes = []
+    for row in dataset:
+      row_indexes.append(row['row_index'])
+      if len(row_indexes) == num_rows:
+        break
+    report[pattern] = {
+        'rows_per_sec': num_rows / (time.monotonic() - start_time),
+        'chunks_per_batch': _chunks_per_batch(row_indexes, chunk_of_row),
+    }
+
+  # fully random: one read per row per tensor.
+  row_indexes = np.random.default_rng(0).permutation(ds.max_len)[:num_rows].tolist()
+  start_time = time.monotonic()
+  for row_index in row_indexes:
+    for tensor_name in tensors:
+      ds[tensor_name][row_index].numpy()
+  report['fully_random'] = {
+      'rows_per_sec': num_rows / (time.monotonic() - start_time),
+      'chunks_per_batch': _chunks_per_batch(row_indexes, chunk_of_row),
+  }
+  return report
+
+
+def _chunk_of_row(chunk_ranges):
+  chunk_starts = np.array([first_idx for first_idx, _ in chunk_ranges])
+  return lambda row_index: int(np.searchsorted(chunk_starts, row_index, side='right')) - 1
+
+
+def _chunks_per_batch(row_indexes, chunk_of_row):
+  batches = [row_indexes[i:i + BENCHMARK_BATCH_SIZE] for i in range(0, len(row_indexes), BENCHMARK_BATCH_SIZE)]
+  return float(np.mean([len({chunk_of_row(row_index) for row_index in batch}) for batch in batches]))
+
+
+if __name__ == '__main__':
+  for pattern, stats in benchmark_access_patterns(sys.argv[1]).items():
+    print(f"  {pattern:>14}: {stats['rows_per_sec']:.1f} rows/sec, {stats['chunks_per_batch']:.1f} distinct chunks per batch of {BENCHMARK_BATCH_SIZE}")
@@ -0,0 +1,55 @@
+'''
+Zero-copy torch Dataset over the memmap shards written by data_preprocessing/parallel_processing/export_memmap_shards.py.
+
+Samples have the same keys and layout as deeplake's ds.pytorch() rows (clip_pooled_embedding, clip_last_hidden_states,
+clip_last_hidden_states_scale for int8, caption_embedding, caption_token_ids), as views of np.load(mmap_mode='c') arrays:
+reads come straight from the page cache and nothing is loaded up front. Batch them with VPTBatchCollator, same as
+the Deeplake dataloaders, without Deeplake decompression or re-tokenizing captions every step.
+
+Usage:
+  dataset = MemmapShardDataset('/mnt/teton/vpt/data/yt-1b_memmap_shards/CLIP_encode_results_handpicked_downloads')
+  train_dataloader = torch.utils.data.DataLoader(dataset, batch_size=8, collate_fn=VPTBatchCollator(), num_workers=psutil.cpu_count(), pin_memory=True)
+'''
+import bisect
+import json
+import pathlib
+
+import numpy as np
+import torch
+
+RAGGED_KEYS = {'caption_embedding': 'caption_embedding_offsets', 'caption_token_ids': 'caption_token_offsets'}  # {key: its offsets array}
+
+
+class MemmapShardDataset(torch.utils.data.Dataset):
+
+  def __init__(self, shards_dir):
+    '''
+    param shards_dir: directory containing shard_00000, shard_00001, ... Only finished shards (with metadata.json) are used.
+    '''
+    self.shard_dirs = sorted(path.parent for path in pathlib.Path(shards_dir).glob('shard_*/metadata.json'))
+    assert self.shard_dirs, print(f"No finished memmap shards in {shards_dir}. Run export_memmap_shards.py first.")
+    self.shard_metadata = [json.loads((shard_dir / 'metadata.json').read_text()) for shard_dir in self.shard_dirs]
+    self.shard_starts = np.cumsum([0] + [metadata['num_rows'] for metadata in self.shard_metadata]).tolist()
+    self._shards = None  # opened lazily, so each DataLoader worker gets its own file handles.
+
+  def __len__(self):
+    return self.shard_starts[-1]
+
+  def __getitem__(self, idx):
+    shard_idx = bisect.bisect_right(self.shard_starts, idx) - 1
+    row = idx - self.shard_starts[shard_idx]
+    shard = self._get_shards()[shard_idx]
+    sample = {}
+    for key, values in shard.items():
+      if key in RAGGED_KEYS:
+        start, end = shard[RAGGED_KEYS[key]][row:row + 2]
+        sample[key] = values[start:end]
+      elif key not in RAGGED_KEYS.values():
+        sample[key] = values[row]
+    return sample
+
+  def _get_shards(self):
+    if self._shards is None:
+      # mmap_mode='c' (copy-on-write) gives writable arrays, so torch.from_numpy doesn't warn. Nothing is ever written back.
+      self._shards = [{path.stem: np.load(path, mmap_mode='c') for path in shard_dir.glob('*.npy')} for shard_dir in self.shard_dirs]
+    return self._shards
@@ -1,9 +1,14 @@
 # Instantiate CustomT5
 import os
+import pathlib
+import sys
 from typing import Any, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 import wandb
+from composer.core import Callback, State
+from composer.loggers import Logger
 from composer.metrics import LanguageCrossEntropy  # , LanguagePerplexity
 from composer.models import ComposerModel, HuggingFaceModel
 from datasets import load_metric
@@ -12,6 +17,172 @@ from torchmetrics import Metric, MetricCollection
 from transformers import (AutoModelForSeq2SeqLM, AutoTokenizer,
                           T5ForConditionalGeneration, T5Tokenizer)
 
+# storage formats are shared with the data pipeline, import them from there instead of keeping copies.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[3] / 'data_preprocessing' / 'parallel_processing'))
+from embedding_codec import EMBEDDING_TENSOR_NAMES, maybe_decode_embedding  # embeddings may be stored byte-shuffle + zstd encoded
+from hidden_state_quantization import SCALE_TENSOR_NAME, dequantize_hidden_states
+from visual_token_reduction import reduce_visual_tokens
+
+# int8 datasets store per-token scales here, see data_preprocessing/parallel_processing/hidden_state_quantization.py
+CLIP_HIDDEN_STATE_SCALE_KEY = SCALE_TENSOR_NAME
+
+# pre-tokenized caption column, written at text-encode time (see add_caption_token_columns in deeplake_driver.py).
+CAPTION_TOKEN_IDS_KEY = 'caption_token_ids'
+
+# index maps of lazily allocated datasets, see RESULT_INDEX_TENSORS in deeplake_driver.py.
+LAZY_RESULT_INDEX_KEYS = ('clip_source_index', 'caption_embedding_source_index')
+
+
+def assert_rows_aligned(ds):
+  '''
+  ds.pytorch() reads row i of every tensor together. Lazily allocated results are stored in arrival order, not row
+  order, so they would be paired with the wrong captions: those datasets have to be compacted first.
+  '''
+  lazy_index_tensors = [tensor_name for tensor_name in LAZY_RESULT_INDEX_KEYS if tensor_name in ds.tensors]
+  assert not lazy_index_tensors, print(
+      f"Dataset has lazily allocated results ({lazy_index_tensors}), rows aren't aligned. Compact it first (compress_and_delete_dataset in deeplake_driver.py).")
+
+
+def training_tensor_names(ds):
+  '''
+  Tensors to read from `ds` for VPTBatchCollator (ds.pytorch(tensors=...) or ChunkShuffledDataset).
+  '''
+  tensor_names = ['clip_pooled_embedding', 'caption_embedding', 'clip_last_hidden_states', 'caption']
+  if CLIP_HIDDEN_STATE_SCALE_KEY in ds.tensors:  # int8 clip_last_hidden_states, dequantized in the collator
+    tensor_names.append(CLIP_HIDDEN_STATE_SCALE_KEY)
+  if CAPTION_TOKEN_IDS_KEY in ds.tensors:  # pre-tokenized labels, no tokenizing in the dataloader
+    tensor_names[tensor_names.index('caption')] = CAPTION_TOKEN_IDS_KEY
+  return tensor_names
+
+def visual_token_reduction_for_dataset(ds, visual_token_reduction):
+  '''
+  The reduction VPTBatchCollator still has to apply to `ds`. Datasets reduced at CLIP-encode time record their mode in
+  ds.clip_last_hidden_states.info['visual_token_reduction'] (see parallel_clip.py), those are used as stored.
+  '''
+  stored_reduction = ds.clip_last_hidden_states.info.get('visual_token_reduction')
+  if stored_reduction in (None, 'none'):
+    return visual_token_reduction
+  assert visual_token_reduction in (None, 'none', stored_reduction), print(
+      f"Dataset is already reduced with {stored_reduction} at CLIP-encode time, can't apply {visual_token_reduction} on top of it.")
+  return None
+
+
+# fixed layout of every pretraining example: 1 pooled + 577 hidden state + 446 caption embedding positions = 1024.
+VPT_SEQUENCE_LENGTH = 1024
+CLIP_SEQUENCE_LENGTH = 578  # pooled embedding + 577 hidden states
+CAPTION_EMBEDDING_LENGTH = VPT_SEQUENCE_LENGTH - CLIP_SEQUENCE_LENGTH
+LABELS_LENGTH = 512
+
+
+class VPTBatchCollator():
+  '''
+  Batched replacement for vpt_transform_dataset_to_batch: use as `collate_fn` of ds.pytorch() (with no transform).
+  Builds the whole batch into preallocated tensors, ready for VPT_model.forward:
+    inputs_embeds:  (batch_size, sequence_length, 1024) float32. [pooled embedding, clip hidden states, first half of caption embedding, zero padding]
+    attention_mask: (batch_size, sequence_length) int64
+    labels:         (batch_size, labels_length) int64, 2nd half of the tokenized caption, padded with -100.
+  Samples with `caption_token_ids` aren't tokenized at all. Otherwise the tokenizer is loaded once per dataloader
+  worker (on first call), not per sample.
+
+  dynamic_length=True: sequence_length / labels_length are the longest example in the batch (rounded up to a multiple of
+  `pad_to_multiple_of`, for tensor cores), instead of the fixed 1024 / 512. Padding is masked out (-100 in labels), so
+  the loss is the same, but the T5 encoder no longer attends over hundreds of empty caption positions.
+  visual_token_reduction: e.g. 'avgpool2', see reduce_visual_tokens(). The clip hidden states take 1 + 144 positions
+  instead of 577. Only for full 577-token hidden states: datasets already reduced at CLIP-encode time work as-is, pick the
+  collate mode with visual_token_reduction_for_dataset().
+  '''
+
+  def __init__(self,
+               model_huggingface_name: str = "google/t5-v1_1-large",
+               dynamic_length: bool = True,
+               pad_to_multiple_of: Optional[int] = 8,
+               visual_token_reduction: Optional[str] = None):
+    self.model_huggingface_name = model_huggingface_name
+    self.dynamic_length = dynamic_length
+    self.pad_to_multiple_of = pad_to_multiple_of
+    self.visual_token_reduction = visual_token_reduction
+    self._tokenizer = None
+
+  def __getstate__(self):
+    # don't ship the tokenizer to dataloader workers, each loads its own.
+    state = self.__dict__.copy()
+    state['_tokenizer'] = None
+    return state
+
+  @property
+  def tokenizer(self):
+    if self._tokenizer is None:
+      self._tokenizer = AutoTokenizer.from_pretrained(self.model_huggingface_name, return_special_tokens_mask=True)
+    return self._tokenizer
+
+  def __call__(self, samples):
+    '''
+    param samples: list of dicts (one per segment), numpy arrays keyed by deeplake tensor name.
+    '''
+    if all(CAPTION_TOKEN_IDS_KEY in sample for sample in samples):
+      full_captions_tokenized = [np.asarray(sample[CAPTION_TOKEN_IDS_KEY]).reshape(-1).tolist() for sample in samples]
+    else:
+      captions = [_caption_string(sample['caption']) for sample in samples]
+      full_captions_tokenized = self.tokenizer(captions, padding=False, truncation=True).input_ids  # one batched call
+
+    hidden_states = torch.from_numpy(
+        np.stack([
+            dequantize_hidden_states(maybe_decode_embedding(np.asarray(sample['clip_last_hidden_states'])), sample.get(CLIP_HIDDEN_STATE_SCALE_KEY))
+            for sample in samples
+        ]))
+    if self.visual_token_reduction not in (None, 'none'):
+      # pooling an already reduced grid again still "works" (145 -> 37 tokens), refuse instead.
+      assert hidden_states.shape[1] == CLIP_SEQUENCE_LENGTH - 1, print(
+          f"visual_token_reduction={self.visual_token_reduction} needs all {CLIP_SEQUENCE_LENGTH - 1} visual tokens, got {hidden_states.shape[1]} (already reduced at CLIP-encode time?)")
+      hidden_states = reduce_visual_tokens(hidden_states, self.visual_token_reduction)
+    clip_length = 1 + hidden_states.shape[1]  # pooled embedding + visual tokens
+    caption_embeddings = [maybe_decode_embedding(np.asarray(sample['caption_embedding'])) for sample in samples]
+    # keep only the first HALF of caption embedding, and only the 2nd half of the caption tokens as labels.
+    s_halves = [min(caption_embedding.shape[0] // 2, CAPTION_EMBEDDING_LENGTH) for caption_embedding in caption_embeddings]
+    all_label_ids = [caption_token_ids[len(caption_token_ids) // 2:][:LABELS_LENGTH] for caption_token_ids in full_captions_tokenized]
+    if self.dynamic_length:
+      sequence_length = min(self._round_up(clip_length + max(s_halves)), clip_length + CAPTION_EMBEDDING_LENGTH)
+      labels_length = min(self._round_up(max(len(label_ids) for label_ids in all_label_ids)), LABELS_LENGTH)
+    else:
+      sequence_length, labels_length = clip_length + CAPTION_EMBEDDING_LENGTH, LABELS_LENGTH
+
+    batch_size = len(samples)
+    inputs_embeds = torch.zeros((batch_size, sequence_length, 1024), dtype=torch.float32)
+    attention_mask = torch.zeros((batch_size, sequence_length), dtype=torch.int64)
+    labels = torch.full((batch_size, labels_length), -100, dtype=torch.int64)
+
+    inputs_embeds[:, 1:clip_length] = hidden_states
+    for row, (sample, caption_embedding, s_half, label_ids) in enumerate(zip(samples, caption_embeddings, s_halves, all_label_ids)):
+      inputs_embeds[row, 0] = torch.from_numpy(maybe_decode_embedding(np.asarray(sample['clip_pooled_embedding'])).reshape(-1))
+      inputs_embeds[row, clip_length:clip_length + s_half] = torch.from_numpy(caption_embedding[0:s_half])
+      attention_mask[row, 0:clip_length + s_half] = 1
+      labels[row, :len(label_ids)] = torch.tensor(label_ids, dtype=torch.int64)
+
+    return {'inputs_embeds': inputs_embeds, 'attention_mask': attention_mask, 'labels': labels}
+
+  def _round_up(self, length):
+    if not self.pad_to_multiple_of:
+      return length
+    return -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+
+def _caption_string(caption):
+  ''' deeplake gives text samples as a str, or a single-element array / list. '''
+  if isinstance(caption, str):
+    return caption
+  return str(np.asarray(caption).reshape(-1)[0])
+
+
+def inputs_embeds_and_attention_mask(batch):
+  '''
+  Accepts batches from VPTBatchCollator (already concatenated) or from vpt_transform_dataset_to_batch (concatenated here).
+  '''
+  if 'inputs_embeds' in batch:
+    return batch['inputs_embeds'], batch['attention_mask']
+  input_embeds_arr = torch.cat([batch['clip_pooled_embedding'], batch['clip_last_hidden_states'], batch['caption_embedding']],
+                               dim=1)  # concat along sequence dimension
+  return input_embeds_arr, batch['attn_mask_arr']
+
 
 class VPT_model(ComposerModel):
   '''
@@ -33,40 +204,25 @@ class VPT_model(ComposerModel):
     self.val_cross_entropy = LanguageCrossEntropy(vocab_size=32128, ignore_index=-100)
 
   def forward(self, batch):
-    input_embeds_arr = torch.cat([batch['clip_pooled_embedding'], batch['clip_last_hidden_states'], batch['caption_embedding']],
-                                 dim=1)  # concat along sequence dimension
-    return self.model.forward(inputs_embeds=input_embeds_arr, attention_mask=batch['attn_mask_arr'], labels=batch['labels'])
+    input_embeds_arr, attention_mask = inputs_embeds_and_attention_mask(batch)
+    return self.model.forward(inputs_embeds=input_embeds_arr, attention_mask=attention_mask, labels=batch['labels'])
 
   def eval_forward(self, batch, outputs=None):
     '''
     Docs: https://docs.mosaicml.com/en/v0.11.1/api_reference/generated/composer.ComposerModel.html#composer.ComposerModel.eval_forward
-    
-    Todo: re-write this to use a pre-computed validation set (yt-1b-val). Use same pre-processing as training.
-    '''
-    ground_truth_labels = batch['labels'][0][batch['labels'][0] != -100]
-    num_new_tokens = ground_truth_labels.shape[0]
-
-    input_embeds_arr = torch.cat([batch['clip_pooled_embedding'], batch['clip_last_hidden_states'], batch['caption_embedding']],
-                                 dim=1)  # concat along sequence dimension
-
-    self.model.eval()
-    with torch.no_grad():
-      outputs = self.model.forward(inputs_embeds=input_embeds_arr,
-                                   attention_mask=batch['attn_mask_arr'],
-                                   labels=batch['labels'],
-                                   return_dict=True)
-
-    # generated vs actual tokens.
-    # todo: just pass logits and labels, no edits at all. Works cuz I already set Ignore index = -100, so they match.
-    # self.val_cross_entropy.update(outputs.logits, batch['labels']) # this should work, is simpler, but untested
-    self.val_cross_entropy.update(outputs.logits[0][0:num_new_tokens], batch['labels'][0][0:num_new_tokens])
-
-    # print("Cross entropy: ", self.val_cross_entropy.compute())
-    wandb.log({"val_loss_cross_entropy": self.val_cross_entropy.compute()})
 
-    return outputs
+    Full batches, on a held-out split (e.g. yt1b-val) built with the same VPTBatchCollator as training. Composer already
+    puts the model in eval mode for the whole evaluation. update_metric() accumulates val cross entropy over every row,
+    Composer computes it once per evaluation, and LogValidationLoss logs it to wandb once.
+    '''
+    if outputs is not None:
+      return outputs
+    input_embeds_arr, attention_mask = inputs_embeds_and_attention_mask(batch)
+    with torch.inference_mode():
+      return self.model.forward(inputs_embeds=input_embeds_arr, attention_mask=attention_mask, labels=batch['labels'], return_dict=True)
 
   def update_metric(self, batch: Any, outputs: Any, metric: Metric) -> None:
+    # labels are -100 on padding, which the metric ignores. So this is per-token cross entropy over all rows of the batch.
     return metric.update(outputs.logits, batch['labels'])
 
   # todo: UNTESTED
@@ -97,7 +253,8 @@ class VPT_model(ComposerModel):
     
     caption embedding: keep only the first HALF of caption embedding. 
     label:             only keep 2nd half of caption to use as labels.
-    clip_last_hidden_states: All clip hidden states.
+    clip_last_hidden_states: All clip hidden states. Dequantized to float32 if stored as fp16/int8 (int8 needs the
+                             `clip_last_hidden_states_scale` tensor in the dataloader too).
     clip_pooled_embedding: 
     
     
@@ -105,17 +262,21 @@ class VPT_model(ComposerModel):
     returns: batch dictionary.  Keys: input_embeds_arr, attn_mask_arr, labels_tokenized
                                 Values: batched Torch Tensors of shape <1, 1024, 1024>. These are stacked to create a batch.
     '''
+    # Prefer VPTBatchCollator as the dataloader's collate_fn, it's much faster (tokenizer loaded once, batched).
     # todo: remove all mention of cuda from this functino (no .todevice), then use pin=True.
     # device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
     # print("👉👉👉👉👉👉👉👉👉👉👉👉👉👉👉👉👉 SEGMENT BATCH", flush=True)
     batch = {}  # keys: input_embeds_arr, attn_mask_arr, labels
 
     tokenizer = AutoTokenizer.from_pretrained(self.huggingface_model_name, return_special_tokens_mask=True)
+    hidden_state_scales = segment_batch[CLIP_HIDDEN_STATE_SCALE_KEY] if CLIP_HIDDEN_STATE_SCALE_KEY in segment_batch.keys() else None
 
     # maybe don't loop here??? just do it once. Not sure how it works on ds.batch_size setting.
     # Loop over BATCH_SIZE. Create dictionary where key = name, value = batched tensor
     for key, numpy_array in zip(segment_batch.keys(), segment_batch):
       # print("------------- PRINTING SEGMENT --------- ")
+      if key in EMBEDDING_TENSOR_NAMES:
+        numpy_array = maybe_decode_embedding(numpy_array)
       if key == 'clip_pooled_embedding':
         # print("⭐️1️⃣ pooled embedding")
         numpy_array = numpy_array.reshape(1, -1)  # for batch size purposes.
@@ -149,6 +310,7 @@ class VPT_model(ComposerModel):
 
       elif key == 'clip_last_hidden_states':
         # print("⭐️3️⃣ clip last hidden states")
+        numpy_array = dequantize_hidden_states(numpy_array, hidden_state_scales)
         if key in batch.keys():
           batch[key] = torch.cat((batch[key], torch.from_numpy(numpy_array)), dim=0)
         else:
@@ -173,6 +335,18 @@ class VPT_model(ComposerModel):
     return batch
 
 
+class LogValidationLoss(Callback):
+  '''
+  Log the val cross entropy to wandb ONCE per evaluation (after Composer computed it over the whole eval set), under
+  `val_loss_cross_entropy`, the name the wandb sweeps minimize.
+  '''
+
+  def eval_end(self, state: State, logger: Logger) -> None:
+    metrics = state.eval_metrics.get(state.dataloader_label, {})
+    if 'val_loss_cross_entropy' in metrics:
+      wandb.log({'val_loss_cross_entropy': metrics['val_loss_cross_entropy'].compute().item()})
+
+
 '''
 def log_gradient_norm():
 # practitioners recommend logging the average norm of the grad. 
@@ -29,8 +29,14 @@ from composer.loggers import WandBLogger
 from composer.models import HuggingFaceModel
 from composer.profiler import JSONTraceHandler, cyclic_schedule
 from composer.profiler.profiler import Profiler
+from chunk_shuffle import ChunkShuffledDataset
+from memmap_shard_dataset import MemmapShardDataset
 from modeling_vpt_in_mosaicml import VPT_model  # original work
-from modeling_vpt_in_mosaicml import vpt_transform_dataset_to_batch
+from modeling_vpt_in_mosaicml import LogValidationLoss
+from modeling_vpt_in_mosaicml import VPTBatchCollator
+from modeling_vpt_in_mosaicml import assert_rows_aligned
+from modeling_vpt_in_mosaicml import training_tensor_names
+from modeling_vpt_in_mosaicml import visual_token_reduction_for_dataset
 from termcolor import colored
 
 lt.monkey_patch()
@@ -41,6 +47,20 @@ global MODEL_VERSION_NAME
 global MODEL_SAVE_PATH
 global DATABASE_FILEPATH
 
+# Set to the output of data_preprocessing/parallel_processing/export_memmap_shards.py to train from memmap shards instead of Deeplake.
+MEMMAP_SHARDS_DIR = None
+# e.g. 'avgpool2': 1 + 144 instead of 577 visual tokens per example, in the collate. See reduce_visual_tokens(). Skipped for
+# datasets already reduced at CLIP-encode time (see visual_token_reduction_for_dataset).
+VISUAL_TOKEN_REDUCTION = None
+# chunk-aware shuffling of the training rows, see chunk_shuffle.py. None: sequential ds.pytorch(shuffle=False).
+SHUFFLE_BUFFER_SIZE = 1024  # rows in total, split across the SHUFFLE_NUM_WORKERS dataloader workers (~2.4 GB of fp32 hidden states).
+SHUFFLE_NUM_WORKERS = 8  # each worker holds SHUFFLE_BUFFER_SIZE / SHUFFLE_NUM_WORKERS rows.
+EVAL_DATASET_PATH = '/mnt/teton/vpt/data/yt-1b_deeplake/feb_25_CLIP_encode_results_yt1b-val'
+# validation: held-out split, full batches, a fixed subset every EVAL_INTERVAL. See VPT_model.eval_forward.
+EVAL_BATCH_SIZE = 32
+EVAL_INTERVAL = "500ba"
+EVAL_SUBSET_NUM_BATCHES = 100  # 3.2k rows per evaluation. -1: the whole split.
+
 
 def main():
   print("CPU count:", psutil.cpu_count())
@@ -116,18 +136,58 @@ def train():
   with wandb.init(config=config) as run:
     config = wandb.config
     # create dataloader
-    ds = dl.load(DATABASE_FILEPATH)
-    columns_for_training = ['clip_pooled_embedding', 'caption_embedding', 'clip_last_hidden_states', 'caption']
-
-    train_dataloader = ds.pytorch(
-        tensors=columns_for_training,
-        transform=vpt_transform_dataset_to_batch,
+    if MEMMAP_SHARDS_DIR:
+      train_dataloader = torch.utils.data.DataLoader(
+          MemmapShardDataset(MEMMAP_SHARDS_DIR),
+          collate_fn=VPTBatchCollator(config.model_huggingface_name, visual_token_reduction=VISUAL_TOKEN_REDUCTION),
+          num_workers=psutil.cpu_count(),
+          batch_size=config.batch_size,
+          pin_memory=True,
+          shuffle=False,
+          drop_last=False,
+      )
+    else:
+      ds = dl.load(DATABASE_FILEPATH)
+      assert_rows_aligned(ds)
+      columns_for_training = training_tensor_names(ds)
+
+    if not MEMMAP_SHARDS_DIR and SHUFFLE_BUFFER_SIZE:
+      train_dataloader = torch.utils.data.DataLoader(
+          ChunkShuffledDataset(DATABASE_FILEPATH,
+                               tensors=columns_for_training,
+                               buffer_size=SHUFFLE_BUFFER_SIZE,
+                               batch_size=config.batch_size,
+                               num_workers=min(psutil.cpu_count(), SHUFFLE_NUM_WORKERS)),
+          collate_fn=VPTBatchCollator(config.model_huggingface_name, visual_token_reduction=visual_token_reduction_for_dataset(ds, VISUAL_TOKEN_REDUCTION)),
+          num_workers=min(psutil.cpu_count(), SHUFFLE_NUM_WORKERS),
+          batch_size=config.batch_size,
+          pin_memory=True,
+          drop_last=False,
+      )
+    elif not MEMMAP_SHARDS_DIR:
+      train_dataloader = ds.pytorch(
+          tensors=columns_for_training,
+          collate_fn=VPTBatchCollator(config.model_huggingface_name, visual_token_reduction=visual_token_reduction_for_dataset(ds, VISUAL_TOKEN_REDUCTION)),
+          num_workers=psutil.cpu_count(),
+          batch_size=config.batch_size,
+          pin_memory=True,
+          shuffle=False,
+          drop_last=False,
+          use_local_cache=False,  # downloads to ~/.deeplake, good when using S3.
+      )
+
+    ds_eval = dl.load(EVAL_DATASET_PATH, read_only=True)
+    assert_rows_aligned(ds_eval)
+    columns_for_eval = training_tensor_names(ds_eval)
+    eval_dataloader = ds_eval.pytorch(
+        tensors=columns_for_eval,
+        collate_fn=VPTBatchCollator(config.model_huggingface_name, visual_token_reduction=visual_token_reduction_for_dataset(ds_eval, VISUAL_TOKEN_REDUCTION)),
         num_workers=psutil.cpu_count(),
-        batch_size=config.batch_size,
+        batch_size=EVAL_BATCH_SIZE,
         pin_memory=True,
         shuffle=False,
         drop_last=False,
-        use_local_cache=False,  # downloads to ~/.deeplake, good when using S3.
+        use_local_cache=False,
     )
 
     model = VPT_model(model_huggingface_name=config.model_huggingface_name, model_version_name=config.model_version_name)
@@ -193,7 +253,7 @@ def train():
     trainer = Trainer(
         model=model,
         train_dataloader=train_dataloader,
-        eval_dataloader=train_dataloader,
+        eval_dataloader=eval_dataloader,
         optimizers=optimizer,
         max_duration=3,  # epochs
         device="gpu" if torch.cuda.is_available() else "cpu",
@@ -204,9 +264,11 @@ def train():
         save_num_checkpoints_to_keep=2,
         schedulers=[cosine_lr_schedule],
         loggers=[wandb_logger],
+        callbacks=[LogValidationLoss()],
         device_train_microbatch_size='auto',
         precision='amp_bf16',  # also works: fp32
-        # eval_interval=0,
+        eval_interval=EVAL_INTERVAL,
+        eval_subset_num_batches=EVAL_SUBSET_NUM_BATCHES,
 
         # grad_accum=10, # requires multiple GPUs I guess
         # algorithms=[alibi],  # FusedLayerNorm() -- use NGC
@@ -29,7 +29,13 @@ from composer.loggers import WandBLogger
 from composer.models import HuggingFaceModel
 from composer.profiler import JSONTraceHandler, cyclic_schedule
 from composer.profiler.profiler import Profiler
+from chunk_shuffle import ChunkShuffledDataset
 from modeling_vpt_in_mosaicml import VPT_model  # original work
+from modeling_vpt_in_mosaicml import LogValidationLoss
+from modeling_vpt_in_mosaicml import VPTBatchCollator
+from modeling_vpt_in_mosaicml import assert_rows_aligned
+from modeling_vpt_in_mosaicml import training_tensor_names
+from modeling_vpt_in_mosaicml import visual_token_reduction_for_dataset
 # from modeling_vpt_in_mosaicml import vpt_transform_dataset_to_batch
 from termcolor import colored
 
@@ -72,6 +78,16 @@ elif '103ai' in hostname:
 BATCH_NAME = "handpicked_downloads"
 MODEL_VERSION_NAME = 'feb_25_half_half_handpicked'
 MAX_SWEEP_RUNS_TO_TRY = 50
+# e.g. 'avgpool2': 1 + 144 instead of 577 visual tokens per example, in the collate. See reduce_visual_tokens(). Skipped for
+# datasets already reduced at CLIP-encode time (see visual_token_reduction_for_dataset).
+VISUAL_TOKEN_REDUCTION = None
+# chunk-aware shuffling of the training rows, see chunk_shuffle.py. None: sequential ds.pytorch(shuffle=False).
+SHUFFLE_BUFFER_SIZE = 1024  # rows in total, split across the SHUFFLE_NUM_WORKERS dataloader workers (~2.4 GB of fp32 hidden states).
+SHUFFLE_NUM_WORKERS = 8  # each worker holds SHUFFLE_BUFFER_SIZE / SHUFFLE_NUM_WORKERS rows.
+# validation: held-out split, full batches, a fixed subset every EVAL_INTERVAL. See VPT_model.eval_forward.
+EVAL_BATCH_SIZE = 32
+EVAL_INTERVAL = "500ba"
+EVAL_SUBSET_NUM_BATCHES = 100  # 3.2k rows per evaluation. -1: the whole split.
 
 
 def main():
@@ -156,27 +172,43 @@ def train(config=None):
 
     # dataloader
     ds = dl.load(config.train_dataset_filepath)
-    columns_for_training = ['clip_pooled_embedding', 'caption_embedding', 'clip_last_hidden_states', 'caption']
-    train_dataloader = ds.pytorch(
-        tensors=columns_for_training,
-        transform=model.vpt_transform_dataset_to_batch,
-        num_workers=psutil.cpu_count(),
-        batch_size=config.batch_size,
-        pin_memory=True,
-        shuffle=False,
-        drop_last=False,
-        use_local_cache=False,  # downloads to ~/.deeplake, good when using S3.
-    )
+    assert_rows_aligned(ds)
+    columns_for_training = training_tensor_names(ds)
+    if SHUFFLE_BUFFER_SIZE:
+      train_dataloader = torch.utils.data.DataLoader(
+          ChunkShuffledDataset(config.train_dataset_filepath,
+                               tensors=columns_for_training,
+                               buffer_size=SHUFFLE_BUFFER_SIZE,
+                               batch_size=config.batch_size,
+                               num_workers=min(psutil.cpu_count(), SHUFFLE_NUM_WORKERS)),
+          collate_fn=VPTBatchCollator(model.huggingface_model_name, visual_token_reduction=visual_token_reduction_for_dataset(ds, VISUAL_TOKEN_REDUCTION)),
+          num_workers=min(psutil.cpu_count(), SHUFFLE_NUM_WORKERS),
+          batch_size=config.batch_size,
+          pin_memory=True,
+          drop_last=False,
+      )
+    else:
+      train_dataloader = ds.pytorch(
+          tensors=columns_for_training,
+          collate_fn=VPTBatchCollator(model.huggingface_model_name, visual_token_reduction=visual_token_reduction_for_dataset(ds, VISUAL_TOKEN_REDUCTION)),
+          num_workers=psutil.cpu_count(),
+          batch_size=config.batch_size,
+          pin_memory=True,
+          shuffle=False,
+          drop_last=False,
+          use_local_cache=False,  # downloads to ~/.deeplake, good when using S3.
+      )
 
     ds_eval = dl.load(config.eval_dataset_filepath)
+    assert_rows_aligned(ds_eval)
     # ds_eval.config.update(allow_val_changes=True)
     # ds_eval = ds_eval[0:48]
-    columns_for_training = ['clip_pooled_embedding', 'caption_embedding', 'clip_last_hidden_states', 'caption']
+    columns_for_eval = training_tensor_names(ds_eval)
     eval_dataloader = ds_eval.pytorch(
-        tensors=columns_for_training,
-        transform=model.vpt_transform_dataset_to_batch,
+        tensors=columns_for_eval,
+        collate_fn=VPTBatchCollator(model.huggingface_model_name, visual_token_reduction=visual_token_reduction_for_dataset(ds_eval, VISUAL_TOKEN_REDUCTION)),
         num_workers=psutil.cpu_count(),
-        batch_size=config.batch_size,
+        batch_size=EVAL_BATCH_SIZE,
         pin_memory=True,
         shuffle=False,
         drop_last=False,
@@ -270,10 +302,11 @@ def train(config=None):
         save_num_checkpoints_to_keep=0,
         schedulers=[cosine_lr_schedule],
         # loggers=[wandb_logger],
-        callbacks=[SpeedMonitor(), early_stopper, threshold_stopper],
+        callbacks=[SpeedMonitor(), early_stopper, threshold_stopper, LogValidationLoss()],
         device_train_microbatch_size=1,  #'auto',
         precision='amp_bf16',  # also works: fp32
-        eval_interval="4ep",  # NEVER EVAL
+        eval_interval=EVAL_INTERVAL,
+        eval_subset_num_batches=EVAL_SUBSET_NUM_BATCHES,
 
         # grad_accum=10, # requires multiple GPUs I guess
         # algorithms=[alibi],  # FusedLayerNorm() -- use NGC